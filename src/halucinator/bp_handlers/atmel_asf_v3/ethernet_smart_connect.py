@@ -3,7 +3,6 @@
 # certain rights in this software.
 
 
-import IPython
 from ...peripheral_models.ethernet import EthernetModel
 from ..intercepts import tx_map, rx_map
 from ..bp_handler import BPHandler, bp_handler
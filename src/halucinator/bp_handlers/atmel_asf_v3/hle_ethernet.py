@@ -3,10 +3,10 @@
 # certain rights in this software.
 
 
-import IPython
 from ...peripheral_models.ethernet import EthernetModel
 from ..intercepts import tx_map, rx_map
 from ..bp_handler import BPHandler, bp_handler
+from ... import hal_clock
 from collections import defaultdict, deque
 import struct
 import binascii
@@ -58,7 +58,7 @@ class Ksz8851HLE(BPHandler):
     def __init__(self, model=EthernetModel):
         BPHandler.__init__(self)
         self.model = model
-        self.last_rx_time = time.time()
+        self.last_rx_time = hal_clock.now()
         self.last_exec_time = time.time()
         self.dev_ptr = None
         self.netif_ptr = None
@@ -119,7 +119,7 @@ class Ksz8851HLE(BPHandler):
                 # and this one to be freed by stack
                 qemu.write_memory(self.dev_ptr + DEVICE_RX_PBUF, 4, 0, 1)
 
-                self.last_rx_time = time.time()
+                self.last_rx_time = hal_clock.now()
 
                 # Get payload_ptr
                 payload_ptr = qemu.read_memory(rx_pbuf_ptr+PBUF_PAYLOAD, 4, 1)
@@ -143,7 +143,7 @@ class Ksz8851HLE(BPHandler):
                 self.dev_ptr = None
                 self.netif_ptr = None
                 log.info("Got Frame: LATENCY %f, inter packet time %f" %
-                         (time.time()-rx_time, (time.time() - self.last_rx_time)))
+                         (hal_clock.now()-rx_time, (hal_clock.now() - self.last_rx_time)))
                 log.info("Execution Time rx_packet %f " %
                          (time.time()-start_time))
                 return False, None
@@ -86,12 +86,14 @@ class RF233Radio(BPHandler):
     def get_channel(self, qemu, bp_addr):
         # int rf_get_channel(void);
         log.debug("rf_get_channel")
-        return True, 0
+        return True, self.model.channel
 
     @bp_handler(['rf_set_channel'])  # used
     def set_channel(self, qemu, bp_addr):
         # int rf_set_channel(uint8_t ch);
-        log.debug("rf_set_channel")
+        channel = qemu.regs.r0 & 0xFF
+        log.debug("rf_set_channel %i" % channel)
+        self.model.set_channel(self.get_id(qemu), channel)
         return True, 0
 
     @bp_handler(['SetIEEEAddr'])
@@ -0,0 +1,490 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+BPStruct, a compiled description of a C structure for use in BP Handlers
+
+The FORMAT of a BPStruct class is compiled once when the class is created
+into struct.Struct objects (one per run of fields with the same explicit
+byte order, and one per native field), so parsing and building a structure
+is a single unpack/pack.
+"""
+
+import re
+import struct
+
+_ORDER_RE = re.compile(r"^([@=<>!]?)(.*)$", re.DOTALL)
+
+# Names BPStruct uses on its own instances, which fields can't shadow
+_RESERVED_NAMES = {"FORMAT", "parse_buffer", "build_buffer"}
+
+# Field kinds
+_SCALAR = 0
+_ARRAY = 1
+_STRUCT = 2
+_STRUCT_ARRAY = 3
+_PAD = 4
+
+
+class BPPointer:  # pylint: disable=too-few-public-methods
+    """
+    FORMAT entry for a pointer to another BPStruct.  The field value is the
+    address, use BPStruct.deref to read the structure it points to
+
+    :param struct_cls: BPStruct subclass pointed to
+    :param fmt:  struct format of the pointer
+    """
+
+    def __init__(self, struct_cls, fmt="<I"):
+        self.struct_cls = struct_cls
+        self.fmt = fmt
+
+
+class _Layout:
+    """
+    Compiled layout of a FORMAT dictionary
+    """
+
+    def __init__(self, fields):
+        # Atoms are (order, code, num_values), merged into segments below
+        self.atoms = []
+        self.fields = []  # (name, kind, first value, num values, offset, extra)
+        self.field_structs = {}
+        num_values = 0
+        offset = 0
+        bad_fields = {}
+        for name, spec in fields.items():
+            try:
+                kind, atoms, extra = self._compile_field(spec)
+            except (struct.error, TypeError, ValueError):
+                bad_fields[name] = spec
+                continue
+            count = sum(atom[2] for atom in atoms)
+            size = sum(struct.calcsize(atom[0] + atom[1]) for atom in atoms)
+            self.fields.append((name, kind, num_values, count, offset, extra))
+            if kind in (_SCALAR, _ARRAY, _PAD):
+                self.field_structs[name] = struct.Struct(atoms[0][0] + atoms[0][1])
+            self.atoms.extend(atoms)
+            num_values += count
+            offset += size
+        if bad_fields:
+            raise ValueError(
+                f"Entry Values must be valid struct format strings."
+                f"Bad Fields: {bad_fields}"
+            )
+        self.num_values = num_values
+        self.size = offset
+
+        self.segments = []
+        for order, code, count in self.atoms:
+            # Native fields keep their own size and alignment, merging them
+            # would align each field against the previous ones
+            if self.segments and self.segments[-1][0] == order != "@":
+                self.segments[-1][1].append(code)
+                self.segments[-1][2] += count
+            else:
+                self.segments.append([order, [code], count])
+        self.segments = [
+            (struct.Struct(order + "".join(codes)), count)
+            for order, codes, count in self.segments
+        ] or [(struct.Struct(""), 0)]
+        self.names = tuple(field[0] for field in self.fields)
+        self.single = self.segments[0][0] if len(self.segments) == 1 else None
+
+    @staticmethod
+    def _compile_field(spec):
+        """
+        Returns (kind, atoms, extra) for a FORMAT entry
+        """
+        if isinstance(spec, BPPointer):
+            order, code, count = _parse_fmt(spec.fmt)
+            if count != 1:
+                raise ValueError("Pointer must be a single value")
+            return _SCALAR, [(order, code, 1)], spec.struct_cls
+        if isinstance(spec, type) and issubclass(spec, BPStruct):
+            return _STRUCT, list(spec._layout.atoms), spec
+        if isinstance(spec, (list, tuple)):
+            elem, length = spec
+            if isinstance(elem, type) and issubclass(elem, BPStruct):
+                return _STRUCT_ARRAY, list(elem._layout.atoms) * length, elem
+            order, code, count = _parse_fmt(elem)
+            if count != 1:
+                raise ValueError("Array elements must be a single value")
+            return _ARRAY, [(order, f"{length}{code}", length)], None
+        order, code, count = _parse_fmt(spec)
+        if count == 0:
+            return _PAD, [(order, code, 0)], None
+        if count == 1:
+            return _SCALAR, [(order, code, 1)], None
+        return _ARRAY, [(order, code, count)], None
+
+    def unpack(self, buffer, offset=0):
+        """
+        Unpacks all values in the buffer
+        """
+        if self.single is not None:
+            return self.single.unpack_from(buffer, offset)
+        values = []
+        for seg, _ in self.segments:
+            values.extend(seg.unpack_from(buffer, offset))
+            offset += seg.size
+        return values
+
+    def pack_into(self, buffer, offset, values):
+        """
+        Packs a flat list of values into buffer at offset
+        """
+        if self.single is not None:
+            self.single.pack_into(buffer, offset, *values)
+            return
+        idx = 0
+        for seg, count in self.segments:
+            seg.pack_into(buffer, offset, *values[idx : idx + count])
+            offset += seg.size
+            idx += count
+
+
+def _parse_fmt(fmt):
+    """
+    Splits a struct format string into byte order, code and number of values.
+    Native order, size and alignment ("@") is used if no order is given
+    """
+    order, code = _ORDER_RE.match(fmt).groups()
+    order = order or "@"
+    size = struct.calcsize(order + code)
+    count = len(struct.unpack(order + code, bytes(size)))
+    return order, code, count
+
+
+class _BPStructMeta(type):
+    """
+    Adds __slots__ for the FORMAT fields and compiles the layout
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        fmt = namespace.get("FORMAT")
+        if fmt is not None:
+            reserved = set(namespace) | _RESERVED_NAMES
+            for base in bases:
+                reserved.update(attr for attr in dir(base) if attr.startswith("_"))
+            overlapping_keys = reserved & set(fmt)
+            if overlapping_keys:
+                raise KeyError(f"Invalid field names {overlapping_keys}")
+            namespace["__slots__"] = tuple(fmt)
+        else:
+            namespace.setdefault("__slots__", ())
+        cls = super().__new__(mcs, name, bases, namespace)
+        if fmt is not None:
+            cls._layout = _Layout(fmt)
+        elif not hasattr(cls, "_layout"):
+            cls._layout = None
+        return cls
+
+
+_ANONYMOUS_STRUCTS = {}
+
+
+def _anonymous_struct(fields):
+    key = tuple(
+        (name, tuple(spec) if isinstance(spec, list) else spec)
+        for name, spec in fields.items()
+    )
+    cls = _ANONYMOUS_STRUCTS.get(key)
+    if cls is None:
+        cls = _BPStructMeta("BPStruct", (BPStruct,), {"FORMAT": dict(fields)})
+        _ANONYMOUS_STRUCTS[key] = cls
+    return cls
+
+
+class BPStruct(metaclass=_BPStructMeta):
+    """
+    This creates a class that will defining a structure and allow using the `.` notation
+    to access its members for use with in BP Handlers
+    Note requires python>3.6 so **kwargs is ordered
+
+    To create pass names of struct members with a python package struct strings
+    as parameters
+
+    example:
+        struct example{
+            uint32_t  le_32;      // Little Endian 32 bit unsigned int
+            uint16_t  be_int16;   // Big Endian 16 bit int
+            uint64_t  le_uint64;  // Little Endian 64 bit unsigned int
+            char [64]  internal_string;
+            char *     name;      // Example assumes LE 32 bit
+        }
+        example_struct = BPStruct(le_32='<I', be_int16='>h', le_uint64='<Q',
+                                    internal_string='64s', name='<I')
+
+        example_struct.read(qemu, addr)
+        print(example_struct)
+
+        Its recommended to subclass this class as follows and just define FORMAT in the class
+        as a dictionary
+        ExampleStruct(BP_Struct):
+            FORMAT = {
+                le_32: "<I",
+                be_16: ">h",
+                internal_string: "64s",
+                p_name: ">I"
+            }
+        es = ExampleStruct()
+        es.internal_string = "Test Struct"
+        es.build_buffer()
+
+    FORMAT values may also be
+        "<4I"                   A list of 4 values
+        ("<H", 8)               A list of 8 values
+        OtherStruct             A nested BPStruct subclass
+        (OtherStruct, 4)        A list of 4 nested structs
+        BPPointer(OtherStruct)  Pointer that can be followed with deref
+        "4x"                    Padding, always None
+
+    Fields are packed without alignment, use padding to match the C layout.
+    ExampleStruct.read_array(qemu, addr, count) reads a table of structures
+    with a single memory read.
+    """
+
+    def __new__(cls, **kwargs):
+        if kwargs:
+            cls = _anonymous_struct(kwargs)
+        elif cls._layout is None:
+            cls = _anonymous_struct({})
+        return super().__new__(cls)
+
+    def __init__(self, **kwargs):  # pylint: disable=unused-argument
+        for name in self._layout.names:
+            setattr(self, name, None)
+
+    @classmethod
+    def sizeof(cls):
+        """
+        Size of the structure in bytes
+        """
+        return cls._layout.size
+
+    @classmethod
+    def _from_values(cls, values, base):
+        inst = cls.__new__(cls)
+        inst._set_values(values, base)
+        return inst
+
+    def _set_values(self, values, base):
+        for name, kind, first, count, _, extra in self._layout.fields:
+            idx = base + first
+            if kind == _SCALAR:
+                setattr(self, name, values[idx])
+            elif kind == _ARRAY:
+                setattr(self, name, list(values[idx : idx + count]))
+            elif kind == _STRUCT:
+                setattr(self, name, extra._from_values(values, idx))
+            elif kind == _STRUCT_ARRAY:
+                elem_count = extra._layout.num_values
+                setattr(
+                    self,
+                    name,
+                    [
+                        extra._from_values(values, pos)
+                        for pos in range(idx, idx + count, elem_count)
+                    ],
+                )
+            else:
+                setattr(self, name, None)
+
+    def _get_values(self, out):
+        """
+        Appends all values to out, raises ValueError if a field is None
+        """
+        for name, kind, _, _, _, _ in self._layout.fields:
+            value = getattr(self, name)
+            if kind == _PAD:
+                continue
+            if value is None:
+                raise ValueError(name)
+            if kind == _SCALAR:
+                out.append(value)
+            elif kind == _ARRAY:
+                out.extend(value)
+            elif kind == _STRUCT:
+                value._get_values(out)
+            else:
+                for elem in value:
+                    elem._get_values(out)
+        return out
+
+    def read(self, qemu, pointer):
+        """
+        Reads the structure from QEMU using the pointer.
+        """
+        buffer = qemu.read_memory(pointer, 1, len(self), raw=True)
+        self.parse_buffer(buffer)
+
+    @classmethod
+    def read_array(cls, qemu, pointer, count):
+        """
+        Reads count consecutive structures with a single memory read
+
+        :returns: list of structures
+        """
+        if count == 0:
+            return []
+        size = cls._layout.size
+        buffer = qemu.read_memory(pointer, 1, size * count, raw=True)
+        return cls.parse_array(buffer, count)
+
+    @classmethod
+    def parse_array(cls, buffer, count=None):
+        """
+        Parses consecutive structures from buffer
+
+        :param count: Number of structures, default as many as fit in buffer
+        """
+        layout = cls._layout
+        if count is None:
+            count = len(buffer) // layout.size
+        if layout.single is not None:
+            return [
+                cls._from_values(values, 0)
+                for values in layout.single.iter_unpack(
+                    memoryview(buffer)[: layout.size * count]
+                )
+            ]
+        return [
+            cls._from_values(layout.unpack(buffer, idx * layout.size), 0)
+            for idx in range(count)
+        ]
+
+    @classmethod
+    def numpy_dtype(cls):
+        """
+        Returns a NumPy dtype matching the structure (requires numpy)
+        """
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        names = []
+        formats = []
+        offsets = []
+        for name, kind, _, count, offset, extra in cls._layout.fields:
+            if kind == _PAD:
+                continue
+            if kind in (_STRUCT, _STRUCT_ARRAY):
+                dtype = extra.numpy_dtype()
+                if kind == _STRUCT_ARRAY:
+                    dtype = np.dtype((dtype, (count // extra._layout.num_values,)))
+            else:
+                fmt = cls._layout.field_structs[name].format
+                order, code = fmt[0], fmt[1:]
+                # NumPy has no "@", its "=" also uses native sizes
+                order = "=" if order == "@" else order
+                if kind == _ARRAY and not code.endswith("s"):
+                    dtype = np.dtype((order + code.lstrip("0123456789"), (count,)))
+                elif code.endswith("s"):
+                    dtype = np.dtype("S" + (code[:-1] or "1"))
+                else:
+                    dtype = np.dtype(order + code)
+            names.append(name)
+            formats.append(dtype)
+            offsets.append(offset)
+        return np.dtype(
+            {
+                "names": names,
+                "formats": formats,
+                "offsets": offsets,
+                "itemsize": cls._layout.size,
+            }
+        )
+
+    @classmethod
+    def read_numpy(cls, qemu, pointer, count):
+        """
+        Reads count consecutive structures into a NumPy structured array
+        with a single memory read (requires numpy)
+        """
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        buffer = qemu.read_memory(pointer, 1, cls._layout.size * count, raw=True)
+        return np.frombuffer(buffer, dtype=cls.numpy_dtype(), count=count)
+
+    def deref(self, qemu, field_name, count=1):
+        """
+        Reads the structure(s) the BPPointer field_name points to
+
+        :returns: the structure, or list of structures if count != 1
+        """
+        for name, _, _, _, _, extra in self._layout.fields:
+            if name == field_name and isinstance(extra, type):
+                if count == 1:
+                    inst = extra()
+                    inst.read(qemu, getattr(self, name))
+                    return inst
+                return extra.read_array(qemu, getattr(self, name), count)
+        raise KeyError(f"{field_name} is not a pointer")
+
+    def parse_buffer(self, buffer):
+        """
+        Parses the buffer into the fields
+        """
+        self._set_values(self._layout.unpack(buffer), 0)
+
+    def write(self, qemu, pointer, default=None):
+        """
+        Writes the structure to QEMU at pointer
+        """
+        buffer = self.build_buffer(default)
+        qemu.write_memory(pointer, 1, buffer, len(buffer), raw=True)
+
+    def build_buffer(self, default_value=None):
+        """
+        Builds a flat buffer suitable for writing to memory
+
+        :param default_value:  byte to fill fields that are None with
+        """
+        buffer = bytearray(self._layout.size)
+        self._pack_into(buffer, 0, b"\00" if default_value is None else default_value)
+        return bytes(buffer)
+
+    def _pack_into(self, buffer, offset, def_value):
+        layout = self._layout
+        try:
+            layout.pack_into(buffer, offset, self._get_values([]))
+            return
+        except ValueError:
+            pass
+        # Some fields are None, pack field by field
+        for name, kind, _, count, field_offset, extra in layout.fields:
+            value = getattr(self, name)
+            start = offset + field_offset
+            if kind in (_STRUCT, _STRUCT_ARRAY):
+                size = (
+                    extra._layout.size * (count // extra._layout.num_values)
+                    if kind == _STRUCT_ARRAY
+                    else extra._layout.size
+                )
+            else:
+                size = layout.field_structs[name].size
+            if value is None or kind == _PAD:
+                buffer[start : start + size] = (def_value * size)[:size]
+            elif kind == _SCALAR:
+                layout.field_structs[name].pack_into(buffer, start, value)
+            elif kind == _ARRAY:
+                layout.field_structs[name].pack_into(buffer, start, *value)
+            elif kind == _STRUCT:
+                value._pack_into(buffer, start, def_value)
+            else:
+                for elem in value:
+                    elem._pack_into(buffer, start, def_value)
+                    start += extra._layout.size
+
+    def __len__(self):
+        return self._layout.size
+
+    def __repr__(self):
+        out = [f"{self.__class__.__name__} {{"]
+        for field_name in self._layout.names:
+            value = getattr(self, field_name)
+            if isinstance(value, int):
+                out.append(f"  {field_name}: {value} ({value:#x})")
+            else:
+                out.append(f"  {field_name}: {value}")
+        out.append("}")
+        return "\n".join(out)
@@ -3,33 +3,39 @@
 # certain rights in this software.
 
 from ..bp_handler import BPHandler, bp_handler
-import re
-from binascii import hexlify
-from os import path
-import sys
+import atexit
 
 import logging
 from ... import hal_log
+from ...util.arg_trace import ArgTraceRecorder
+from ...util.printf_engine import get_args
 
 log = logging.getLogger(__name__)
 hal_log = hal_log.getHalLogger()
 
 class ArgumentLogger(BPHandler):
     '''
-        Logs function arguments to standard out or input file
+        Logs function arguments to the hal log or a binary trace file
 
         Halucinator configuration usage:
         - class: halucinator.bp_handlers.ArgumentLogger
+          class_args: {filename: <trace file>, max_args: 6, ring_size: 65536}
           function: <func_name>
           symbol: <symbol> or
           addr: <addr> 
           registration_args:{num_args: <int>, log_ret_addr:true,
                              intercept:false, ret_value:null}
+
+        If filename is given each call is appended as a fixed width record
+        to the trace file (see halucinator.util.arg_trace) instead of being
+        logged as text.  Decode it with
+            hal_arg_trace <trace file> -e <elf>
     '''
-    def __init__(self, filename=None):
-        self.fd = None
-        if filename != None:
-            self.fd = open(filename, 'wt')
+    def __init__(self, filename=None, max_args=6, ring_size=65536):
+        self.recorder = None
+        if filename is not None:
+            self.recorder = ArgTraceRecorder(filename, max_args, ring_size)
+            atexit.register(self.recorder.close)
         self.loggers = {}
 
     def register_handler(self, target, addr, func_name, num_args=0,
@@ -48,12 +54,14 @@ class ArgumentLogger(BPHandler):
         log.debug("Registration Args: Fun: %s, num_args %i, log_ret_addr %s intercept %s, ret_value %s, silent %s " % \
                                 (func_name, num_args, log_ret_addr, intercept, ret_value_str, silent))
         self.loggers[addr] = ArgumentLogger.Logger(target,func_name, num_args, 
-                                                  log_ret_addr, intercept, ret_value, silent)
+                                                  log_ret_addr, intercept, ret_value, silent,
+                                                  self.recorder, addr)
         return ArgumentLogger.log_handler
     
     class Logger():
         def __init__(self, target, func_name, num_args, 
-                     log_caller, intercept,ret_value, silent):
+                     log_caller, intercept,ret_value, silent,
+                     recorder=None, addr=0):
             self.func_name = func_name
             self.num_args = num_args
             self.target = target
@@ -61,16 +69,26 @@ class ArgumentLogger(BPHandler):
             self.silent = silent
             self.ret_value = ret_value
             self.intercept = intercept
+            self.recorder = recorder
+            if recorder is not None:
+                self.intercept_id = recorder.add_intercept(func_name, addr)
 
+        def get_args(self):
+            if self.num_args == 0:
+                return []
+            return get_args(self.target, self.num_args)
 
         def log(self):
-            hal_log.info("###### Arg Logger ######")
-            hal_log.info("Func: %s" % self.func_name)
-            if self.num_args > 0:
-                args = [hex(self.target.get_arg(i)) for i in range(self.num_args)]
-                hal_log.info("Args: %s,".join(args))
-            if self.log_caller:
-                hal_log.info("Return addr: %#x" % self.target.get_ret_addr())
+            args = self.get_args()
+            ret_addr = self.target.get_ret_addr() if self.log_caller else 0
+            if self.recorder is not None:
+                self.recorder.append(self.intercept_id, ret_addr, args)
+            elif self.log_caller:
+                hal_log.info("Arg Logger: %s(%s) Return addr: %#x", self.func_name,
+                             ", ".join(hex(arg) for arg in args), ret_addr)
+            else:
+                hal_log.info("Arg Logger: %s(%s)", self.func_name,
+                             ", ".join(hex(arg) for arg in args))
 
     @bp_handler  # bp_handler no args, can intercept any function
     def log_handler(self, target, addr):
@@ -8,8 +8,10 @@ BP Handlers primarily used for debugging
 from os import system
 
 import logging
-import IPython
 from ..bp_handler import BPHandler, bp_handler
+from ...util.lazy_import import lazy_import
+
+IPython = lazy_import("IPython")
 
 
 log = logging.getLogger(__name__)
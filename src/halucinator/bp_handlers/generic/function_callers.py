@@ -4,10 +4,11 @@
 from os import path, system
 from ..bp_handler import BPHandler, bp_handler
 from ..intercepts import register_bp_handler
-import IPython
 import logging
 import avatar2
 from ... import hal_config
+from ...util.lazy_import import lazy_import
+IPython = lazy_import("IPython")
 log = logging.getLogger(__name__)
 from ... import hal_log
 hal_log = hal_log.getHalLogger()
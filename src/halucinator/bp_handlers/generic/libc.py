@@ -1,72 +1,50 @@
 """Libc function break points"""
+
 import logging
-import re
+from halucinator import console
 from halucinator.bp_handlers.bp_handler import BPHandler, bp_handler
+from halucinator.util.printf_engine import PrintfEngine
 
 log = logging.getLogger(__name__)
 
 
 class Libc6(BPHandler):
-    """This class holds generic libc functionality, such as printf and puts"""
+    """This class holds generic libc functionality, such as printf and puts
+
+    :param max_string: Maximum length of strings read from the guest
+    :param stream: Name of the console stream output is written to
+    :param float_words: Floating point varargs are passed in argument words,
+        defaults to the target's calling convention (set True for soft
+        float PowerPC firmware)
+    """
+
+    def __init__(self, max_string=256, stream="stdout", float_words=None):
+        self.max_string = max_string
+        self.float_words = float_words
+        self.engine = None
+        self.out = console.get_stream(stream)
+
+    def _get_engine(self, qemu):
+        if self.engine is None or self.engine.target is not qemu:
+            self.engine = PrintfEngine(
+                qemu, max_string=self.max_string, float_words=self.float_words
+            )
+        return self.engine
 
     @bp_handler(["puts"])
-    def puts(self, qemu, addr):  # pylint: disable=no-self-use,unused-argument
+    def puts(self, qemu, addr):  # pylint: disable=unused-argument
         """int puts(const char *str)"""
         log.debug("puts 0x%08x", addr)
-        print_string = qemu.read_string(qemu.get_arg(0))
-        print(print_string)
+        print_string = self._get_engine(qemu).read_string(qemu.get_arg(0))
+        self.out.write(print_string + "\n")
         return True, 1
 
     @bp_handler(["printf"])
-    def printf(self, qemu, bp_addr):  # pylint: disable=no-self-use,unused-argument
+    def printf(self, qemu, bp_addr):  # pylint: disable=unused-argument
         """int printf(const char *format, ...)
-        handles most formats, but we don't do anything special
-        for length or for the n. The n should never have been created"""
-        # pylint: disable=too-many-branches
-        fmt = qemu.read_string(qemu.get_arg(0))
-
-        formats = []  # We aren't handling anything fancy or even length args
-        strsplit = re.split(r"(\W)", fmt)
-        for i, element in enumerate(strsplit):
-            if element == "%" and len(strsplit) > i + 1:
-                if i >= 1 and strsplit[i - 1] != "\\":
-                    formats.append(strsplit[i + 1])
-        printf_args = []
-        for i, form in enumerate(formats):
-            arg_int = i + 1
-            value = qemu.get_arg(arg_int)
-            if "i" in form or "d" in form or "u" in form:  # int
-                value = int(value)
-            elif "f" in form or "F" in form:  # double in normal form
-                value = float(value)
-            elif "x" in form or "X" in form:  # hexidecimal
-                value = int(value)
-            elif "s" in form:  # null terminated string
-                value = qemu.read_string(value)
-            elif "c" in form:  # character
-                value = qemu.read_string(value)[0]
-            elif "e" in form or "E" in form:  # double in standard form
-                value = float(value)
-            elif "g" in form or "G" in form:  # double in normal or exponential form
-                value = float(value)
-            elif "o" in form:  # unsigned int in octal
-                value = int(value)
-            elif "a" in form or "A" in form:  # double in dex notation
-                value = float(value)
-            # elif "p" in form: #void pointer
-            #     print("Void pointer")
-            # # elif "n" in form:
-            # # print nothing but writes the number of characters written so
-            #   far into integer pointer parameter
-            else:
-                print("Unhandled format")
-                print(f"format: {fmt}\n")
-                return True, 1
-            printf_args.append(value)
-
-        print_string = fmt % tuple(printf_args)
-        print(str(print_string), end="")
-        log.info("%s", print_string)
+        handles flags, width, precision and length modifiers, %n is ignored"""
+        print_string = self._get_engine(qemu).format(0)
+        self.out.write(print_string)
         return True, len(print_string)
 
     @bp_handler(["exit"])
@@ -1,4 +1,5 @@
 from halucinator.bp_handlers import BPHandler, bp_handler
+from halucinator import console
 from halucinator import hal_log
 import logging, sys
 
@@ -8,15 +9,23 @@ hal_log = hal_log.getHalLogger()
 class NewLibSysCalls(BPHandler):
     '''
         Break point handlers for NewLibSysCalls
+
+        :param stdout: console stream written for fd 1 (and unknown fds)
+        :param stderr: console stream written for fd 2
     '''
+    def __init__(self, stdout="stdout", stderr="stderr"):
+        self.stdout = console.get_stream(stdout)
+        self.stderr = console.get_stream(stderr, "stderr")
 
     @bp_handler(['_write'])
     def _write(self, qemu, addr):
         '''
-            Just print data to the screen and return
+            Write data to the console and return
         '''
+        fd = qemu.get_arg(0)
         addr = qemu.get_arg(1)
         l = qemu.get_arg(2)
         data = qemu.read_memory(addr, 1, l, raw=True)
-        print(data.decode('ascii'),end="")
+        stream = self.stderr if fd == 2 else self.stdout
+        stream.write(data)
         return True, l
\ No newline at end of file
@@ -9,9 +9,15 @@ working with breakpoints
 import sys
 from functools import wraps
 import importlib
+import inspect
 import logging
+import time
 from .. import hal_log as hal_log_conf
+from .. import hal_checkpoint
+from .. import hal_clock
+from .. import hal_metrics
 from .. import hal_stats
+from ..util import startup_profile
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +27,13 @@ hal_log = hal_log_conf.getHalLogger()
 hal_stats.stats["used_intercepts"] = set()
 hal_stats.stats["bypassed_funcs"] = set()
 
+INTERCEPT_HITS = hal_metrics.counter(
+    "halucinator_intercept_hits_total", "Intercept hits", ["function"]
+)
+HANDLER_SECONDS = hal_metrics.histogram(
+    "halucinator_handler_seconds", "Time executing bp_handlers", ["function"]
+)
+
 # LUT to map bp to addr
 __bp_addr_lut = {}
 
@@ -109,16 +122,14 @@ def get_bp_handler(intercept):
     return bp_class
 
 
-def register_bp_handler(qemu, intercept):
+def _resolve_handler(qemu, intercept):
     """
-    Registers a BP handler for specific address
+    Gets the bp_handler class instance and handler method for intercept
 
     :param qemu:    Avatar qemu target
     :param intercept: HALInterceptConfig
+    :returns: (bp_cls, handler)
     """
-    if intercept.bp_addr is None:
-        log.debug("No address specified for %s ignoring intercept", intercept)
-        return None
     bp_cls = get_bp_handler(intercept)
 
     try:
@@ -134,7 +145,7 @@ def register_bp_handler(qemu, intercept):
                 qemu,
                 intercept.bp_addr,
                 intercept.function,
-                **intercept.registration_args
+                **intercept.registration_args,
             )
         else:
             log.info(
@@ -152,31 +163,156 @@ def register_bp_handler(qemu, intercept):
         hal_log.error("Input registration args are %s", intercept.registration_args)
         # exit(-1)
         sys.exit(-1)
+    return bp_cls, handler
 
-    if intercept.run_once:
-        bp_temp = True
-        log.debug("Setting as Tempory")
-    else:
-        bp_temp = False
 
+def _break_call(intercept):
+    """
+    Returns (target method, avatar watched type, args, kwargs) of the target
+    API call that inserts the break/watch point for intercept
+    """
+    if intercept.watchpoint:
+        kwargs = {
+            "write": intercept.watchpoint != "r",
+            "read": intercept.watchpoint != "w",
+        }
+        return "set_watchpoint", "TargetSetWatchPoint", (intercept.bp_addr,), kwargs
+    kwargs = {"temporary": bool(intercept.run_once)}
+    return "set_breakpoint", "TargetSetBreakpoint", (intercept.bp_addr,), kwargs
+
+
+def _gdb_break_request(intercept):
+    """
+    Returns the GDB MI command that inserts the break/watch point for intercept,
+    the same command Avatar's GDBProtocol sends for _break_call
+    """
     if intercept.watchpoint:
         if intercept.watchpoint == "r":
-            breakpoint_num = qemu.set_watchpoint(
-                intercept.bp_addr, write=False, read=True
-            )
+            cmd = ["-break-watch", "-r"]
         elif intercept.watchpoint == "w":
-            breakpoint_num = qemu.set_watchpoint(
-                intercept.bp_addr, write=True, read=False
-            )
-
+            cmd = ["-break-watch"]
         else:
-            breakpoint_num = qemu.set_watchpoint(
-                intercept.bp_addr, write=True, read=True
+            cmd = ["-break-watch", "-a"]
+    elif intercept.run_once:
+        cmd = ["-break-insert", "-t"]
+    else:
+        cmd = ["-break-insert"]
+    cmd.append(f"*0x{intercept.bp_addr:x}")
+    return cmd
+
+
+def _set_break(qemu, intercept):
+    """
+    Inserts the break/watch point for intercept using the target's API
+    """
+    if intercept.run_once:
+        log.debug("Setting as Tempory")
+    method, _, args, kwargs = _break_call(intercept)
+    return getattr(qemu, method)(*args, **kwargs)
+
+
+def _break_number(response):
+    """
+    Returns the break/watch point number from a GDB MI response, -1 on failure
+    """
+    if response is None or response.get("message") != "done":
+        return -1
+    payload = response.get("payload") or {}
+    for key, value in payload.items():
+        # bkpt for breakpoints, [hw-][a|r]wpt for watchpoints
+        if key == "bkpt" or key.endswith("wpt"):
+            return int(value["number"])
+    return -1
+
+
+def _pipeline_requests(protocol, requests, batch_size, timeout=5):
+    """
+    Sends GDB MI requests without waiting on each response, then collects the
+    responses in order.  Requests are written the way GDBProtocol's
+    _sync_request writes them, so they share its token sequence
+
+    :param protocol: Avatar GDBProtocol
+    :param requests: List of GDB MI commands (lists of strings)
+    :param batch_size: Max requests outstanding at once
+    :returns: List of responses, None for requests that timed out
+    """
+    # pylint: disable=protected-access
+    communicator = protocol._communicator
+    responses = []
+    for idx in range(0, len(requests), batch_size):
+        tokens = []
+        for request in requests[idx : idx + batch_size]:
+            token = communicator.get_token()
+            protocol._gdbmi.write(
+                str(token) + " ".join(request), read_response=False, timeout_sec=0
             )
+            tokens.append(token)
+        for token in tokens:
+            try:
+                responses.append(communicator.get_sync_response(token, timeout))
+            except TimeoutError:
+                responses.append(None)
+    return responses
 
-    else:
-        breakpoint_num = qemu.set_breakpoint(intercept.bp_addr, temporary=bp_temp)
 
+def _insert_breaks(qemu, intercepts, batch_size):
+    """
+    Inserts the break/watch points for intercepts
+
+    GDB MI requests are pipelined when the target uses Avatar's GDBProtocol,
+    otherwise they are set one at a time with the target's API.  Pipelined
+    requests bypass the target's set_breakpoint/set_watchpoint, so the
+    avatar watchmen those methods trigger (@watch) are triggered here, before
+    and after each request, with the same arguments and return value
+
+    :returns: List of break/watch point numbers
+    """
+    protocol = getattr(getattr(qemu, "protocols", None), "execution", None)
+    watchmen = getattr(getattr(qemu, "avatar", None), "watchmen", None)
+    if not (
+        hasattr(protocol, "_communicator")
+        and hasattr(protocol, "_gdbmi")
+        and watchmen is not None
+    ):
+        return [_set_break(qemu, intercept) for intercept in intercepts]
+
+    from avatar2.watchmen import (  # pylint: disable=import-outside-toplevel
+        AFTER,
+        BEFORE,
+    )
+
+    calls = [_break_call(intercept) for intercept in intercepts]
+    for _, watched_type, args, kwargs in calls:
+        watchmen.t(watched_type, BEFORE, *args, watched_target=qemu, **kwargs)
+
+    requests = [_gdb_break_request(intercept) for intercept in intercepts]
+    responses = _pipeline_requests(protocol, requests, batch_size)
+
+    breakpoint_nums = []
+    for (_, watched_type, args, kwargs), response in zip(calls, responses):
+        breakpoint_num = _break_number(response)
+        cb_ret = watchmen.t(
+            watched_type,
+            AFTER,
+            *args,
+            watched_target=qemu,
+            watched_return=breakpoint_num,
+            **kwargs,
+        )
+        breakpoint_nums.append(breakpoint_num if cb_ret is None else cb_ret)
+    return breakpoint_nums
+
+
+def _add_handler(breakpoint_num, intercept, bp_cls, handler):
+    """
+    Maps breakpoint_num to the handler
+
+    :returns: False if the break point wasn't set (breakpoint_num < 0), the
+        intercept is then skipped
+    """
+    if breakpoint_num is None or breakpoint_num < 0:
+        hal_log.error("Failed to set BP for %s, skipping the intercept", intercept)
+        return False
     hal_stats.stats[breakpoint_num] = {
         "function": intercept.function,
         "desc": str(intercept),
@@ -186,10 +322,62 @@ def register_bp_handler(qemu, intercept):
 
     __bp_addr_lut[breakpoint_num] = intercept.bp_addr
     bp2handler_lut[breakpoint_num] = (bp_cls, handler)
+    return True
+
+
+def register_bp_handler(qemu, intercept):
+    """
+    Registers a BP handler for specific address
+
+    :param qemu:    Avatar qemu target
+    :param intercept: HALInterceptConfig
+    :returns: The break point number, None if it wasn't set
+    """
+    if intercept.bp_addr is None:
+        log.debug("No address specified for %s ignoring intercept", intercept)
+        return None
+    bp_cls, handler = _resolve_handler(qemu, intercept)
+    breakpoint_num = _set_break(qemu, intercept)
+    if not _add_handler(breakpoint_num, intercept, bp_cls, handler):
+        return None
     log.info("BP is %i", breakpoint_num)
     return breakpoint_num
 
 
+def register_bp_handlers(qemu, intercepts, batch_size=256):
+    """
+    Registers the BP handlers for many intercepts.  All handlers are
+    resolved, then all break/watch points are inserted in one batch of
+    GDB requests
+
+    :param qemu:    Avatar qemu target
+    :param intercepts: List of HALInterceptConfig
+    :param batch_size: Max GDB requests outstanding at once
+    :returns: List of break point numbers, in the order of intercepts with
+        a bp_addr, None for intercepts whose break point wasn't set
+    """
+    intercepts = [i for i in intercepts if i.bp_addr is not None]
+    handlers = []
+    for intercept in intercepts:
+        log.info("Registering Intercept: %s", intercept)
+        with startup_profile.phase("register_intercept", function=intercept.function):
+            handlers.append(_resolve_handler(qemu, intercept))
+
+    with startup_profile.phase("insert_breakpoints", count=len(intercepts)):
+        breakpoint_nums = _insert_breaks(qemu, intercepts, batch_size)
+
+    registered = []
+    for intercept, (bp_cls, handler), breakpoint_num in zip(
+        intercepts, handlers, breakpoint_nums
+    ):
+        if _add_handler(breakpoint_num, intercept, bp_cls, handler):
+            registered.append(breakpoint_num)
+        else:
+            registered.append(None)
+    log.info("Registered %i BPs", len(registered) - registered.count(None))
+    return registered
+
+
 def interceptor(avatar, message):  # pylint: disable=unused-argument
     """
     Callback for Avatar2 break point watchman.  It then dispatches to
@@ -214,9 +402,20 @@ def interceptor(avatar, message):  # pylint: disable=unused-argument
     except KeyError:
         log.info("BP Has no handler")
         return
+    function = hal_stats.stats[breakpoint_num]["function"]
+    INTERCEPT_HITS.inc(function=function)
+    # Taken before the handler and tick, so a resumed run repeats both
+    hal_checkpoint.poll(target)
+    hal_clock.tick()
     # print method
     try:
-        intercept, ret_value = method(cls, target, prog_counter)
+        start = time.perf_counter()
+        result = method(cls, target, prog_counter)
+        if inspect.isgenerator(result):
+            # Handler makes firmware calls, see qemu_targets.firmware_rpc
+            result = target.rpc.start(result)
+        HANDLER_SECONDS.observe(time.perf_counter() - start, function=function)
+        intercept, ret_value = result
 
         if intercept:
             hal_stats.write_on_update(
@@ -2,8 +2,8 @@
 # Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains 
 # certain rights in this software.
 
-from time import sleep
 from ..bp_handler import BPHandler, bp_handler
+from ... import hal_clock
 import struct
 import logging
 log = logging.getLogger(__name__)
@@ -20,7 +20,7 @@ class MbedTimer(BPHandler):
         param0 = qemu.regs.r0  # a floating point value
         value = struct.pack("<I", param0)
         stuff = struct.unpack("<f", value)[0]
-        sleep(stuff)
+        hal_clock.sleep(stuff)
         return False, 0  # , (param0,)
 
 # TODO: Timer-based callbacks
@@ -8,6 +8,7 @@ from ..bp_handler import BPHandler, bp_handler
 import logging
 log = logging.getLogger(__name__)
 
+from ... import console
 from ... import hal_log
 hal_log = hal_log.getHalLogger()
 
@@ -38,7 +39,7 @@ class STM32F4UART(BPHandler):
         buf_addr = qemu.get_arg(1)
         buf_len = qemu.get_arg(2)
         data = qemu.read_memory(buf_addr, 1, buf_len, raw=True)
-        hal_log.info("UART %i TX:%s" % (hw_addr, data))
+        console.get_stream("UART %i TX" % hw_addr, "log").write(data)
         self.model.write(hw_addr, data)
         return True, 0
 
@@ -10,6 +10,7 @@ import re
 
 from halucinator.bp_handlers.vxworks.ios_dev import IosDev
 from halucinator.peripheral_models.dos_fs_model import DosFsModel
+from halucinator.peripheral_models.ram_fs_model import get_fs_model
 from halucinator.bp_handlers.bp_handler import BPHandler, bp_handler
 
 log = logging.getLogger(__name__)
@@ -20,13 +21,20 @@ class DosFsLib(BPHandler):
         This implements the DOS FS intercepts
         Usage:
            - class: halucinator.bp_handlers.vxworks.dos_fs.DosFsLib
-             class_args: (optional) {dd_dirent_offset: Offset to dir entry in structure)
+             class_args: (optional) {dd_dirent_offset: Offset to dir entry in structure,
+                          fs_backend: host or ram (default host),
+                          fs_image: dir or tar/zip archive to seed ram backend,
+                          fs_export: dir or .tar file to write ram backend to at exit}
              function:
              symbol: <BOARD_SPECIFIC> or
              addr:
     '''
-    def __init__(self, impl=DosFsModel,dd_dirent_offset=8):
-        self.model = impl
+    def __init__(self, impl=DosFsModel,dd_dirent_offset=8, fs_backend="host",
+                 fs_image=None, fs_export=None):
+        self.model = get_fs_model(impl, fs_backend, fs_image, fs_export)
+        if fs_backend == "ram":
+            # Device directories are made in the RAM tree, not on the host
+            IosDev.fs_model = self.model
         self.dd_dirent_offset = dd_dirent_offset
 
     def fio_move(self, qemu, bp_addr, fd, arg):
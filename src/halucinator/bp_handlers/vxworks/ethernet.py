@@ -6,7 +6,7 @@
 import logging
 import types
 
-from halucinator.bp_handlers.bp_handler import BPHandler, bp_handler
+from halucinator.bp_handlers.bp_handler import BPHandler, BPStruct, bp_handler
 from halucinator.peripheral_models.ethernet import EthernetModel
 
 log = logging.getLogger(__name__)
@@ -14,6 +14,54 @@ log = logging.getLogger(__name__)
 # pylint: disable=fixme
 
 
+def _mblk_struct(order):
+    """
+    Returns the MBlk BPStruct for a target with byte order ("<" or ">")
+    """
+
+    class MBlkHdr(BPStruct):
+        """
+        M_BLK_HDR, offsets match the target's mBlk layout
+        """
+
+        FORMAT = {
+            "mNext": order + "I",
+            "mNextPkt": order + "I",
+            "m_data": order + "I",
+            "m_len": order + "I",
+            "mType": order + "B",
+            "pad0": order + "x",
+            "mflags": order + "B",
+            "pad1": order + "x",
+            "reserved": order + "H",
+            "pad2": order + "6x",
+        }
+
+    class MBlk(BPStruct):
+        """
+        M_BLK, only the fields used by the handlers are named
+        """
+
+        FORMAT = {
+            "mBlkHdr": MBlkHdr,
+            "mBlkPktHdr": order + "I",
+            "pad0": order + "16x",
+            "p_cl_blk": order + "I",
+        }
+
+    return MBlk
+
+
+MBLK_BY_ORDER = {order: _mblk_struct(order) for order in "<>"}
+
+
+def mblk_struct(qemu):
+    """
+    Returns the MBlk BPStruct in the byte order of the qemu target
+    """
+    return MBLK_BY_ORDER[">" if getattr(qemu, "BIG_ENDIAN", False) else "<"]
+
+
 class Ethernet(BPHandler):
     """
     Ethernet class for handling bp and interactions
@@ -135,29 +183,27 @@ class Ethernet(BPHandler):
         """
         Reads the packet data from the mblk
         """
-        mblk_out = {}
-        mblk_out["addr"] = hex(mblk)
-        mblk_out["mBlkHdr"] = {}
-
-        mblk_out["mBlkPktHdr"] = qemu.read_memory((mblk + 0x1C), 4, 1)
-        mblk_out["mBlkPktHdr_hex"] = hex(mblk_out["mBlkPktHdr"])
-        mblk_out["mBlkHdr"]["m_data_hex"] = hex(mblk_out["mBlkHdr"]["m_data"])
-        mblk_out["mBlkHdr"]["mNext"] = qemu.read_memory((mblk + 0x0), 4, 1)
-        mblk_out["mBlkHdr"]["mNextPkt"] = qemu.read_memory((mblk + 0x4), 4, 1)
-        mblk_out["mBlkHdr"]["m_data"] = qemu.read_memory((mblk + 0x8), 4, 1)
-        mblk_out["mBlkHdr"]["m_len"] = qemu.read_memory((mblk + 0xC), 4, 1)
-        mblk_out["mBlkHdr"]["mType"] = qemu.read_memory((mblk + 0x10), 1, 1)
-        mblk_out["mBlkHdr"]["mflags"] = qemu.read_memory((mblk + 0x12), 1, 1)
-        mblk_out["mBlkHdr"]["reserved"] = qemu.read_memory((mblk + 0x14), 2, 1)
-        mblk_out["mBlkHdr"]["PKT_DATA"] = qemu.read_memory(
-            mblk_out["mBlkHdr"]["m_data"], 1, mblk_out["mBlkHdr"]["m_len"], raw=True
-        )
-        mblk_out["p_cl_blk"] = qemu.read_memory(
-            (mblk + 0x30),
-            4,
-            1,
-        )
-        mblk_out["p_cl_blk_hex"] = hex(mblk_out["p_cl_blk"])
+        m_blk = mblk_struct(qemu)()
+        m_blk.read(qemu, mblk)
+        hdr = m_blk.mBlkHdr
+        mblk_out = {
+            "addr": hex(mblk),
+            "mBlkPktHdr": m_blk.mBlkPktHdr,
+            "mBlkPktHdr_hex": hex(m_blk.mBlkPktHdr),
+            "mBlkHdr": {
+                "mNext": hdr.mNext,
+                "mNextPkt": hdr.mNextPkt,
+                "m_data": hdr.m_data,
+                "m_data_hex": hex(hdr.m_data),
+                "m_len": hdr.m_len,
+                "mType": hdr.mType,
+                "mflags": hdr.mflags,
+                "reserved": hdr.reserved,
+                "PKT_DATA": qemu.read_memory(hdr.m_data, 1, hdr.m_len, raw=True),
+            },
+            "p_cl_blk": m_blk.p_cl_blk,
+            "p_cl_blk_hex": hex(m_blk.p_cl_blk),
+        }
         return mblk_out
 
     @bp_handler(["xSend"])
@@ -19,6 +19,8 @@ class IosDev(BPHandler):
     drivers = {}
     localDir = "tmp/HALucinator/FS"
     models = [UTTYModel]
+    # Filesystem model device directories are made in, None for localDir
+    fs_model = None
 
     @classmethod
     def get_driver(cls, drv):
@@ -35,13 +37,16 @@ class IosDev(BPHandler):
         log.debug("\tDEV_HDR:  0x%08x", qemu.get_arg(0))
         log.debug("\tName:     %s", name)
         log.debug("\tDriver:   %s", qemu.get_arg(2))
-        prev_dir = ""
-        for sub_dir in name.split("/"):
-            _dir = os.path.abspath(self.localDir + "/" + prev_dir + sub_dir)
-            if not os.path.exists(_dir):
-                log.debug(self.drivers)
-                os.mkdir(_dir)
-            prev_dir = prev_dir + "/" + sub_dir
+        if self.fs_model is not None:
+            self.fs_model.make_dir(name)
+        else:
+            prev_dir = ""
+            for sub_dir in name.split("/"):
+                _dir = os.path.abspath(self.localDir + "/" + prev_dir + sub_dir)
+                if not os.path.exists(_dir):
+                    log.debug(self.drivers)
+                    os.mkdir(_dir)
+                prev_dir = prev_dir + "/" + sub_dir
         self.drivers[qemu.get_arg(0)] = name
         for model in self.models:
             model.attach_interface(name)
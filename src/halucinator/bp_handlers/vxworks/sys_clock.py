@@ -16,8 +16,10 @@ class SysClock(BPHandler):
     def __init__(self, irq_num, name='sysClk', scale=10, rate=1, delay=0):
         '''
             :param irq_num:  The Irq Number to trigger
-            :param scale:
-            :param rate:    Float( rate to fire irq in seconds)
+            :param scale:   Multiplies the tick period the firmware sets, to
+                            scale all guest time use the clock option
+                            (hal_clock) instead
+            :param rate:    Float( rate to fire irq in guest seconds)
         '''
         self.irq_num = irq_num
         self.name = name
@@ -6,6 +6,7 @@
 import logging
 import types
 
+from halucinator import console
 from halucinator.bp_handlers.vxworks.ios_dev import IosDev
 from halucinator.bp_handlers.bp_handler import BPHandler, bp_handler
 from halucinator.peripheral_models.utty import UTTYModel
@@ -59,6 +60,7 @@ class TYDev(BPHandler):
 
         self.ird = ird
         self.use_rx_task = use_rx_task
+        # Used by the qemu.call chains of isr_execute_read/task_execute_read
         self.state_stack = []
         self.done_stack = []
         self.ioctl_options = 0
@@ -85,6 +87,18 @@ class TYDev(BPHandler):
                                 " ios_dev.IosDev.iosDevAdd")
         return driver
 
+    def _ird_calls(self, qemu, dev_id, tty_dev_struct, num_chars):
+        """
+        Returns the firmware calls that pass num_chars rx chars to the ird
+        function
+        """
+        return [
+            qemu.rpc.call(
+                self.ird, [tty_dev_struct, self.utty_model.get_rx_char(dev_id)]
+            )
+            for _ in range(num_chars)
+        ]
+
     @bp_handler(["tyISR"])
     def ty_isr(self, qemu, bp_addr):  # pylint: disable=unused-argument
         """ty_isr"""
@@ -101,33 +115,25 @@ class TYDev(BPHandler):
         # This structure is needed for the underlying ird functions that are called
         tty_dev_struct = qemu.read_memory((p_ty_dev + self.tty_dev_offset), 4, 1)
 
-        if sema_val == 0 or not self.use_rx_task:
-            # Generate a state for the current device
-            isr_state = TYIsrState(tty_dev_struct, dev_id, num_chars_rx)
-
-            if num_chars_rx > 0:
-                char = self.utty_model.get_rx_char(dev_id)
-                isr_state.read_limit = isr_state.read_limit - 1
-                if isr_state.read_limit == 0:
-                    return qemu.call(
-                        self.ird, [tty_dev_struct, char], self, "receive_done"
-                    )
-                # Add State to stack to ensure the correct state is retreived when
-                # isr_execute_read is called
-                self.state_stack.append(isr_state)
-                return qemu.call(
-                    self.ird, [tty_dev_struct, char], self, "isr_execute_read"
-                )
+        if (sema_val == 0 or not self.use_rx_task) and num_chars_rx > 0:
+            # All chars are passed to ird in one resume of the target
+            yield self._ird_calls(qemu, dev_id, tty_dev_struct, num_chars_rx)
+            log.debug("DONE With Receive ISR")
+            return True, None
 
         # Just release the semaphore so the RxTask will run which will
         # actually read the data
         log.debug("Giving Sem to task")
         qemu.irq_disable_bp(self.utty_model.interfaces[dev_id].irq_num)
-        return qemu.call("semGive", [sema_val], self, "receive_done")
+        yield qemu.rpc.call("semGive", [sema_val])
+        return True, None
 
     @bp_handler(["isr_execute_read"])
     def isr_execute_read(self, qemu, bp_addr):  # pylint: disable=unused-argument
-        """isr_execute_read"""
+        """
+        isr_execute_read, passes the next rx char of the state on the top of
+        state_stack to ird with qemu.call chains (ty_isr uses qemu.rpc)
+        """
         log.debug("isr_execute_read")
         # Get the last device's state that added to the state stack(last device that interrupted)
         isr_state = self.state_stack.pop()
@@ -199,21 +205,12 @@ class TYDev(BPHandler):
         num_chars_rx = self.utty_model.get_rx_buff_size(dev_id)
 
         tty_dev_struct = qemu.read_memory((qemu.get_arg(0) + 0x10), 4, 1)
-        isr_state = TYIsrState(tty_dev_struct, dev_id, num_chars_rx)
 
         if num_chars_rx > 0:
-            char = self.utty_model.get_rx_char(dev_id)
-            isr_state.read_limit = isr_state.read_limit - 1
-
-            if isr_state.read_limit == 0:
-                self.done_stack.append(isr_state)
-                return qemu.call(
-                    self.ird, [tty_dev_struct, char], self, "task_receive_done"
-                )
-            self.state_stack.append(isr_state)
-            return qemu.call(
-                self.ird, [tty_dev_struct, char], self, "task_execute_read"
-            )
+            yield self._ird_calls(qemu, dev_id, tty_dev_struct, num_chars_rx)
+            log.debug("DONE With Task Receive")
+            qemu.irq_enable_bp(self.utty_model.interfaces[dev_id].irq_num)
+            return True, None
 
         log.debug(
             " ........................NO DATA TO PROCESS............................"
@@ -247,11 +244,7 @@ class TYDev(BPHandler):
         buf_ptr = qemu.get_arg(1)
         buf_size = qemu.get_arg(2)
         buf = qemu.read_memory(buf_ptr, 1, buf_size, raw=True)
-        try:
-            log.debug("In tyWrite sending: %s to %s", buf.decode("ascii"), dev_id)
-        except UnicodeError:
-            log.debug("In tyWrite sending non-ascii bytes to %s", dev_id)
-
+        console.get_stream("tyWrite %s" % dev_id, "debug").write(buf)
         self.utty_model.tx_buf(dev_id, buf)
         return True, buf_size
 
@@ -2,7 +2,10 @@ from elftools.elf.elffile import ELFFile
 from halucinator.config.memory_config import HalMemConfig
 from halucinator.config.symbols_config import HalSymbolConfig
 from halucinator import hal_log as hal_log_conf
+import glob
+import hashlib
 import os
+import pickle
 import subprocess
 import logging
 import math
@@ -12,6 +15,62 @@ import importlib
 log = logging.getLogger(__name__)
 hal_log = hal_log_conf.getHalLogger()
 
+# Files hashed to decide if the build command must run, relative to its dir
+DEFAULT_BUILD_INPUTS = ['**/*.c', '**/*.h', '**/*.S', '**/*.s', '**/*.ld',
+                        '**/Makefile', '**/*.mk', '**/CMakeLists.txt']
+
+
+def cache_dir():
+    '''
+        Returns the directory halucinator caches data across runs in
+    '''
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'halucinator')
+
+
+def file_hash(filename, digest=None):
+    '''
+        Returns the hex digest of the contents of filename, or adds them
+        to digest
+    '''
+    own = digest is None
+    if own:
+        digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest() if own else digest
+
+
+def read_elf_symbols(elf_filename):
+    '''
+        Returns list of (name, addr, size) of the .symtab of elf_filename.
+        The table is read with pyelftools once and cached by the ELF's hash
+    '''
+    cache_file = os.path.join(cache_dir(), 'symbols',
+                              file_hash(elf_filename) + '.pickle')
+    try:
+        with open(cache_file, 'rb') as infile:
+            return pickle.load(infile)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    with open(elf_filename, 'rb') as infile:
+        elf = ELFFile(infile)
+        symtab = elf.get_section_by_name('.symtab')
+        symbols = [(sym.name, sym['st_value'], sym['st_size'])
+                   for sym in symtab.iter_symbols()]
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}"
+        with open(tmp_file, 'wb') as outfile:
+            pickle.dump(symbols, outfile, protocol=4)
+        os.replace(tmp_file, cache_file)
+    except OSError as err:
+        log.debug(f"Not caching symbols of {elf_filename}: {err}")
+    return symbols
+
 class ELFProgram(object):
     '''
         Handles parsing the elf_program section of the halucinator
@@ -88,9 +147,28 @@ class ELFProgram(object):
                 base_dir = os.path.dirname(config_path)
             return os.path.join(base_dir, file_str)
 
+    def build_hash(self, path):
+        '''
+            Returns the hash of the build command and the build inputs,
+            the files in path matching the build's `inputs` globs
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr(self.build['cmd']).encode('utf-8'))
+        inputs = set()
+        for pattern in self.build.get('inputs', DEFAULT_BUILD_INPUTS):
+            inputs.update(os.path.abspath(filename) for filename in
+                          glob.glob(os.path.join(path, pattern), recursive=True))
+        inputs.discard(os.path.abspath(self.elf_filename))
+        for filename in sorted(inputs):
+            if os.path.isfile(filename):
+                digest.update(os.path.relpath(filename, path).encode('utf-8'))
+                file_hash(filename, digest)
+        return digest.hexdigest()
+
     def run_build_cmd(self):
         '''
-            Runs the program build command 
+            Runs the program build command, unless the elf was built from
+            the same inputs (see build_hash)
             :param path(str):  Path to execute command from. 
                                Either full path, make relative to config file
             :param cmd(str):  Command to execute
@@ -100,6 +178,13 @@ class ELFProgram(object):
         if self.build is not None:
             #If build specified execute it
             path = self.get_fullpath('', self.build['dir'], self.build['module_relative'])
+            build_hash = self.build_hash(path)
+            hash_file = self.elf_filename + '.build_hash'
+            if os.path.exists(self.elf_filename) and os.path.exists(hash_file):
+                with open(hash_file, 'r') as infile:
+                    if infile.read().strip() == build_hash:
+                        log.info(f"Build of {self.elf_filename} is up to date")
+                        return
             log.info(f"Building program with: {path}/{self.build['cmd']}")
             try:
                 result = subprocess.run(self.build['cmd'], 
@@ -108,6 +193,8 @@ class ELFProgram(object):
             except subprocess.CalledProcessError:
                 log.error("Error building elf program\n")
                 exit(-1)
+            with open(hash_file, 'w') as outfile:
+                outfile.write(build_hash)
 
     def add_memories_configs(self):
         '''
@@ -174,6 +261,7 @@ class ELFProgram(object):
         '''
         log.debug("In Elf Program setting symbols")
         no_error = True
+        branches = {}
         for intercept in self._intercepts:
             handler_addr = self.get_function_addr(intercept['handler'])
             if handler_addr is None:
@@ -191,8 +279,13 @@ class ELFProgram(object):
             if 'symbol' in intercept:
                 symbol = intercept['symbol'] if 'symbol' in intercept else None
                 hal_log.info(f"Setting C intercept Handler: {intercept['handler']} ({hex(handler_addr)}) intercepting: {symbol}({hex(put_addr)})")
-            qemu_target.write_branch(put_addr, handler_addr)
+            branches[put_addr] = handler_addr
 
+        if hasattr(qemu_target, 'write_branches'):
+            qemu_target.write_branches(branches)
+        else:
+            for put_addr, handler_addr in branches.items():
+                qemu_target.write_branch(put_addr, handler_addr)
         return no_error
 
     def load_segments(self, qemu_target):
@@ -246,17 +339,12 @@ class ELFProgram(object):
             Adds the symbols in the elf file to halucinators
             config list of symbols so they can be looked up
         '''
-        with open(self.elf_filename, 'rb') as infile:
-            elf = ELFFile(infile)
-            symtab = elf.get_section_by_name('.symtab')
-            log.debug(f"Adding {symtab.num_symbols} from {self.elf_filename}")
-            for sym in symtab.iter_symbols():
-                addr = sym['st_value']
-                size = sym['st_size']
-                sym_name = self.get_sym_name(sym.name)
-                sym = HalSymbolConfig(self.elf_filename, name=sym_name, addr=addr, size=size)
-                
-                self.hal_config.symbols.append(sym)
+        symbols = read_elf_symbols(self.elf_filename)
+        log.debug(f"Adding {len(symbols)} from {self.elf_filename}")
+        self.hal_config.symbols.extend(
+            HalSymbolConfig(self.elf_filename, name=self.get_sym_name(name),
+                            addr=addr, size=size)
+            for name, addr, size in symbols)
     
     def get_entry_addr(self):
         '''
@@ -11,7 +11,7 @@ class HalMemConfig(object):
     '''
     def __init__(self, name, config_filename, base_addr, size, 
                  permissions='rwx', file=None, emulate=None, 
-                 qemu_name=None, properties=None, irq=None):
+                 qemu_name=None, properties=None, irq=None, shared=None):
         '''
             Reads in config
         '''
@@ -26,6 +26,8 @@ class HalMemConfig(object):
         self.qemu_name = qemu_name
         self.irq_config = irq
         self.properties = properties
+        # Map file from a shared image, None follows options.shared_memory
+        self.shared = shared
 
         if self.file != None:
             self.get_full_path()
@@ -61,6 +63,11 @@ class HalMemConfig(object):
             hal_log.error("Memory/Peripheral: has invalid size, must be multiple of 4kB\n\t%s" % self)
             valid = False
 
+        if self.shared and (self.file is None or 'w' in self.permissions):
+            hal_log.error("Memory/Peripheral: shared requires a file and "
+                          "permissions without w\n\t%s" % self)
+            valid = False
+
         if self.emulate_required and self.emulate is None:
             hal_log.error("Memory/Peripheral: requires emulate field\n\t%s" % self)
             valid = False
@@ -1,3 +1,6 @@
+import bisect
+
+
 class HalSymbolConfig(object):
     '''
         Description of a symbol for halucinators config
@@ -17,3 +20,106 @@ class HalSymbolConfig(object):
     def __repr__(self):
         return "SymConfig(%s){%s, %s(%i),%i}" % \
                 (self.config_file, self.name, hex(self.addr), self.addr, self.size)
+
+
+class HalSymbolStore(list):
+    '''
+        List of HalSymbolConfig indexed by name and address, lookups
+        return the first matching symbol added, as a search of the list would
+    '''
+    def __init__(self, symbols=()):
+        super().__init__()
+        self._by_name = {}
+        # Sorted (addr, position, size, name), built on the first lookup
+        self._by_addr = None
+        self._max_size = 0
+        self.extend(symbols)
+
+    def _reindex(self):
+        # Other changes than appends can move the first symbol of a name
+        self._by_name = {}
+        for sym in self:
+            self._by_name.setdefault(sym.name, sym)
+        self._by_addr = None
+
+    def append(self, sym):
+        self._by_name.setdefault(sym.name, sym)
+        self._by_addr = None
+        super().append(sym)
+
+    def extend(self, symbols):
+        for sym in symbols:
+            self.append(sym)
+
+    def __iadd__(self, symbols):
+        self.extend(symbols)
+        return self
+
+    def insert(self, index, sym):
+        super().insert(index, sym)
+        self._reindex()
+
+    def remove(self, sym):
+        super().remove(sym)
+        self._reindex()
+
+    def pop(self, index=-1):
+        sym = super().pop(index)
+        self._reindex()
+        return sym
+
+    def clear(self):
+        super().clear()
+        self._reindex()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self):
+        super().reverse()
+        self._reindex()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._reindex()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._reindex()
+
+    def __imul__(self, count):
+        super().__imul__(count)
+        self._reindex()
+        return self
+
+    def get_addr(self, name):
+        '''
+            Returns the address of the symbol name or None
+        '''
+        sym = self._by_name.get(name)
+        return None if sym is None else sym.addr
+
+    def get_name(self, addr):
+        '''
+            Returns the name of the symbol containing addr (its last byte
+            included) or None
+        '''
+        if self._by_addr is None:
+            self._by_addr = sorted((sym.addr, idx, sym.size, sym.name)
+                                   for idx, sym in enumerate(self))
+            self._max_size = max((sym.size for sym in self), default=0)
+        # Only symbols starting within the largest size before addr can
+        # contain it
+        pos = bisect.bisect_right(self._by_addr, (addr, len(self)))
+        found_idx = len(self)
+        found_name = None
+        while pos > 0:
+            pos -= 1
+            sym_addr, idx, size, name = self._by_addr[pos]
+            if sym_addr < addr - self._max_size:
+                break
+            if addr <= sym_addr + size and idx < found_idx:
+                found_idx = idx
+                found_name = name
+        return found_name
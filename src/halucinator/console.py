@@ -0,0 +1,368 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+
+"""
+Console output for guest data printed by bp_handlers (printf, _write, UART tx)
+
+Each named stream keeps a byte buffer that is flushed when a newline is
+written, when it reaches max_buffer bytes, or when it has been idle for
+flush_timeout seconds.  Flushed chunks are queued to a background thread,
+which blocks on the queue and writes them to the stream's routes, so
+handlers do not wait on terminal or file I/O.
+
+Routes are set with the `console` entry of the config file `options`
+    options:
+      console:
+        flush_timeout: 0.05
+        max_buffer: 4096
+        routes:
+          stdout: [stdout, file:guest_stdout.log]
+          UART 1073811456 TX: uart:0x40011000
+
+Streams are named by the handler writing to them, the STM32 UART handler
+names its streams "UART <hw_addr in decimal> TX" (0x40011000 above).
+Valid routes are stdout, stderr, log (HAL_LOG info), debug (debug log),
+null, file:<path> and uart:<uart id>.  Streams without a route use the
+default route given by the handler that created them.
+"""
+
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+
+from halucinator import hal_log as hal_log_conf
+
+log = logging.getLogger(__name__)
+hal_log = hal_log_conf.getHalLogger()
+
+DEFAULT_FLUSH_TIMEOUT = 0.05
+DEFAULT_MAX_BUFFER = 4096
+
+# Queued to stop the writer thread
+_STOP = object()
+
+
+class StdioSink:
+    """Writes to sys.stdout or sys.stderr"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, tag, data):
+        stream = getattr(sys, self.name)
+        if hasattr(stream, "buffer"):
+            stream.buffer.write(data)
+        else:
+            stream.write(data.decode("utf-8", "replace"))
+        stream.flush()
+
+
+class LogSink:
+    """Logs each line of output"""
+
+    def __init__(self, logger, level):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, tag, data):
+        text = data.decode("utf-8", "replace")
+        for line in text.splitlines():
+            self.logger.log(self.level, "%s: %s", tag, line)
+
+
+class FileSink:
+    """Appends output to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.outfile = None
+
+    def __call__(self, tag, data):
+        if self.outfile is None:
+            self.outfile = open(self.path, "ab")  # pylint: disable=consider-using-with
+        self.outfile.write(data)
+        self.outfile.flush()
+
+
+class UARTSink:
+    """Publishes output through the UARTPublisher peripheral model"""
+
+    def __init__(self, uart_id):
+        self.uart_id = uart_id
+
+    def __call__(self, tag, data):
+        # pylint: disable=import-outside-toplevel
+        from halucinator.peripheral_models.uart import UARTPublisher
+
+        UARTPublisher.write(self.uart_id, data)
+
+
+def make_sink(route):
+    """
+    Creates the sink for a route string
+    """
+    if callable(route):
+        return route
+    if route in ("stdout", "stderr"):
+        return StdioSink(route)
+    if route == "log":
+        return LogSink(hal_log, logging.INFO)
+    if route == "debug":
+        return LogSink(log, logging.DEBUG)
+    if route == "null":
+        return lambda tag, data: None
+    kind, _, arg = route.partition(":")
+    if kind == "file" and arg:
+        return FileSink(arg)
+    if kind == "uart" and arg:
+        return UARTSink(int(arg, 0))
+    raise ValueError(f"Invalid console route {route}")
+
+
+class ConsoleStream:
+    """
+    A named, buffered output stream.  Use Console.get_stream to create
+    """
+
+    def __init__(self, console, name, sinks):
+        self.console = console
+        self.name = name
+        self.sinks = sinks
+        self.buffer = bytearray()
+        self.last_write = 0.0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        """
+        Buffers data (bytes or str), returns number of bytes buffered
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.lock:
+            was_empty = not self.buffer
+            self.buffer += data
+            self.last_write = time.monotonic()
+            if len(self.buffer) >= self.console.max_buffer:
+                chunk = bytes(self.buffer)
+                self.buffer.clear()
+            elif b"\n" in data:
+                end = self.buffer.rindex(b"\n") + 1
+                chunk = bytes(self.buffer[:end])
+                del self.buffer[:end]
+            else:
+                chunk = None
+        if chunk:
+            self.console.submit(self, chunk)
+        elif was_empty and data:
+            # Wakes the writer to time the idle flush of the partial line
+            self.console.submit(self, None)
+        return len(data)
+
+    def take(self):
+        """
+        Removes and returns all buffered data
+        """
+        with self.lock:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+        return chunk
+
+    def flush(self):
+        """
+        Submits any buffered data to be written
+        """
+        chunk = self.take()
+        if chunk:
+            self.console.submit(self, chunk)
+
+
+class Console:
+    """
+    Collection of ConsoleStreams and the background thread that writes them
+    """
+
+    def __init__(
+        self, flush_timeout=DEFAULT_FLUSH_TIMEOUT, max_buffer=DEFAULT_MAX_BUFFER
+    ):
+        self.flush_timeout = flush_timeout
+        self.max_buffer = max_buffer
+        self.routes = {}
+        self.streams = {}
+        self.queue = queue.Queue()
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def configure(self, routes=None, flush_timeout=None, max_buffer=None):
+        """
+        Sets the routes for streams and the flush parameters
+
+        :param routes: dict of stream name to a route or list of routes
+        """
+        if flush_timeout is not None:
+            self.flush_timeout = flush_timeout
+        if max_buffer is not None:
+            self.max_buffer = max_buffer
+        for name, route in (routes or {}).items():
+            self.routes[name] = route if isinstance(route, list) else [route]
+            if name in self.streams:
+                self.streams[name].sinks = [make_sink(r) for r in self.routes[name]]
+
+    def get_stream(self, name, default_route="stdout"):
+        """
+        Returns the stream name, creating it if needed
+
+        :param default_route: Route used if the config does not set one
+        """
+        with self.lock:
+            stream = self.streams.get(name)
+            if stream is None:
+                routes = self.routes.get(name, [default_route])
+                stream = ConsoleStream(self, name, [make_sink(r) for r in routes])
+                self.streams[name] = stream
+        return stream
+
+    def submit(self, stream, chunk):
+        """
+        Queues chunk to be written to stream's sinks, None only wakes the
+        writer
+        """
+        if not self.running:
+            self._start()
+        self.queue.put((stream, chunk))
+
+    def _start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(
+                target=self._run, name="halucinator-console", daemon=True
+            )
+            self.thread.start()
+
+    def _write(self, stream, chunk):
+        for sink in stream.sinks:
+            try:
+                sink(stream.name, chunk)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Console sink failed for %s", stream.name)
+
+    def _next_idle_flush(self):
+        """
+        Seconds until the first partial line must be flushed, None if there
+        are none
+        """
+        deadlines = [
+            stream.last_write + self.flush_timeout
+            for stream in list(self.streams.values())
+            if stream.buffer
+        ]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _flush_idle(self):
+        now = time.monotonic()
+        for stream in list(self.streams.values()):
+            if stream.buffer and now - stream.last_write >= self.flush_timeout:
+                chunk = stream.take()
+                if chunk:
+                    # Queued behind the stream's earlier chunks
+                    self.queue.put((stream, chunk))
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._next_idle_flush())
+            except queue.Empty:
+                self._flush_idle()
+                continue
+            try:
+                if item is _STOP:
+                    return
+                stream, chunk = item
+                if chunk:
+                    self._write(stream, chunk)
+            finally:
+                self.queue.task_done()
+            self._flush_idle()
+
+    def _drain(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP and item[1]:
+                self._write(*item)
+            self.queue.task_done()
+
+    def flush(self):
+        """
+        Writes all buffered output, blocking until complete
+        """
+        for stream in list(self.streams.values()):
+            chunk = stream.take()
+            if chunk:
+                self.queue.put((stream, chunk))
+        thread = self.thread
+        if thread is not None and thread.is_alive():
+            if thread is not threading.current_thread():
+                self.queue.join()
+        else:
+            self._drain()
+
+    def stop(self):
+        """
+        Stops the background thread and flushes all output
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.running = False
+        if thread is not None:
+            self.queue.put(_STOP)
+            if thread is not threading.current_thread():
+                thread.join()
+        self.flush()
+
+
+_CONSOLE = Console()
+atexit.register(_CONSOLE.stop)
+
+
+def get_console():
+    """
+    Returns the global Console
+    """
+    return _CONSOLE
+
+
+def configure(options):
+    """
+    Configures the global console from the `console` config option dict
+    """
+    if options:
+        _CONSOLE.configure(
+            options.get("routes"),
+            options.get("flush_timeout"),
+            options.get("max_buffer"),
+        )
+
+
+def get_stream(name, default_route="stdout"):
+    """
+    Returns the global console's stream name
+    """
+    return _CONSOLE.get_stream(name, default_route)
+
+
+def flush():
+    """
+    Writes all buffered console output
+    """
+    _CONSOLE.flush()
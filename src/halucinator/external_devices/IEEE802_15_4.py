@@ -5,6 +5,7 @@
 import binascii
 from .ioserver import IOServer
 from .trigger_interrupt import SendInterrupt
+from halucinator import hal_capture
 import logging
 import time
 import socket
@@ -12,12 +13,14 @@ log = logging.getLogger(__name__)
 
 
 class IEEE802_15_4(object):
-    def __init__(self, ioservers=[]):
+    def __init__(self, ioservers=[], capture=None):
         '''
             args:
             ioserver:  list of ioservers to bridge together
+            capture:   hal_capture.PcapngWriter frames are captured to
         '''
         self.ioservers = []
+        self.capture = capture
         self.host_socket = None
         for server in ioservers:
             self.add_server(server)
@@ -28,6 +31,11 @@ class IEEE802_15_4(object):
                                 self.received_frame)
 
     def received_frame(self, from_server, msg):
+        if self.capture is not None:
+            port = self.ioservers.index(from_server) if from_server in self.ioservers else "input"
+            self.capture.write("port%s" % port,
+                               hal_capture.LINKTYPE_IEEE802_15_4_NOFCS,
+                               msg['frame'], hal_capture.INBOUND)
         for server in self.ioservers:
             if server != from_server:
                 log.info('Forwarding, msg')
@@ -50,6 +58,8 @@ def main():
                    help='Port numbers to send IO messages via zmq, length must match --rx_ports')
     p.add_argument('-l', '--logs', nargs='+', default=['Receiver.txt', 'Sender.txt'],
                    help='Log files to write IO frames to, length must match --rx_ports')
+    p.add_argument('-w', '--pcap', required=False, default=None,
+                   help='Capture forwarded frames to this pcapng file')
     args = p.parse_args()
 
     if len(args.rx_ports) != len(args.tx_ports):
@@ -60,7 +70,10 @@ def main():
     import halucinator.hal_log as hal_log
     hal_log.setLogConfig()
 
-    hub = IEEE802_15_4()
+    capture = None
+    if args.pcap is not None:
+        capture = hal_capture.PcapngWriter(args.pcap)
+    hub = IEEE802_15_4(capture=capture)
 
     for idx, rx_port in enumerate(args.rx_ports):
         print(idx)
@@ -79,6 +92,8 @@ def main():
         pass
     log.info("Shutting Down")
     hub.shutdown()
+    if capture is not None:
+        capture.close()
     # io_server.join()
 
 
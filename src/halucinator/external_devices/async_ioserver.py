@@ -0,0 +1,459 @@
+"""
+asyncio IOServer for connecting external devices to HALucinator's ZMQ sockets
+"""
+
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+#
+# AsyncIOServer has the register_topic/send_msg/start/shutdown interface of
+# IOServer so existing devices can use it unchanged, and adds awaitable
+# send/recv for devices written with asyncio
+#
+#     async with AsyncIOServer(5556, 5555) as server:
+#         server.register_topic("Peripheral.EthernetModel.tx_frame")
+#         topic, msg = await server.recv()
+#         await server.send("Peripheral.EthernetModel.rx_frame", msg)
+#
+# Outgoing messages are queued and sent by one task.  Consecutive small
+# messages to the same UART are coalesced into one message (see COALESCE),
+# and send() waits while more than `hwm` messages are queued so producers
+# are slowed down instead of frames being dropped by the PUB socket.
+
+from argparse import ArgumentParser
+import asyncio
+import collections
+import inspect
+import logging
+import struct
+import threading
+import time
+
+import zmq
+import zmq.asyncio
+
+from halucinator.peripheral_models.peripheral_server import (
+    encode_zmq_msg,
+    decode_zmq_msg,
+    topic_prefix,
+    zmq_endpoint,
+    HAL2IO,
+    IO2HAL,
+)
+from halucinator.external_devices.ioserver import IOServer
+from halucinator import hal_log
+
+log = logging.getLogger(__name__)
+
+# Topics whose messages are merged when queued back to back,
+# topic: (field identifying the UART, field with the data)
+COALESCE = {
+    "Peripheral.UTTYModel.rx_char_or_buf": ("interface_id", "char"),
+    "Peripheral.UARTPublisher.rx_data": ("id", "chars"),
+}
+
+CAPTURE_MAGIC = b"HALCAP01"
+# time, direction (0 from HALucinator, 1 to HALucinator), topic length,
+# message length
+CAPTURE_RECORD = struct.Struct("<dBHI")
+CAPTURE_RX = 0
+CAPTURE_TX = 1
+
+
+class CaptureLog:
+    """
+    Buffered binary log of the messages sent and received by an IOServer
+
+    The file starts with CAPTURE_MAGIC followed by records of
+    CAPTURE_RECORD, the topic and the encoded message, all utf-8
+    """
+
+    def __init__(self, filename, buffer_size=1 << 16):
+        # pylint: disable=consider-using-with
+        self.outfile = open(filename, "wb", buffering=buffer_size)
+        self.outfile.write(CAPTURE_MAGIC)
+        self.lock = threading.Lock()
+
+    def write(self, direction, topic, encoded):
+        """
+        Adds a record, encoded is the message as sent on the socket
+        """
+        topic = topic.encode("utf-8")
+        data = encoded.encode("utf-8")[len(topic) + 1 :]
+        header = CAPTURE_RECORD.pack(time.time(), direction, len(topic), len(data))
+        with self.lock:
+            self.outfile.write(header + topic + data)
+
+    def flush(self):
+        """
+        Writes buffered records to the file
+        """
+        with self.lock:
+            self.outfile.flush()
+
+    def close(self):
+        """
+        Flushes and closes the file
+        """
+        with self.lock:
+            self.outfile.close()
+
+
+def read_capture(filename):
+    """
+    Reads a CaptureLog file
+
+    :returns: Generator of (time, direction, topic, message)
+    """
+    with open(filename, "rb") as infile:
+        if infile.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{filename} is not an IOServer capture")
+        while True:
+            header = infile.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            timestamp, direction, topic_len, data_len = CAPTURE_RECORD.unpack(header)
+            topic = infile.read(topic_len).decode("utf-8")
+            data = infile.read(data_len).decode("utf-8")
+            yield timestamp, direction, *decode_zmq_msg(f"{topic} {data}")
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _as_list(value):
+    if isinstance(value, (bytes, str)):
+        return list(value)
+    if isinstance(value, int):
+        return [value]
+    return list(value)
+
+
+def _merge(first, second):
+    """
+    Returns the data of two coalesced messages joined together
+    """
+    if isinstance(first, (bytes, str)) and type(first) is type(second):
+        return first + second
+    return _as_list(first) + _as_list(second)
+
+
+class AsyncIOServer:
+    """
+    asyncio IO Server, connects to the ZMQ sockets of a HALucinator
+    peripheral server
+
+    :param hwm: Max queued outgoing (and unhandled incoming) messages before
+        send (recv) waits
+    :param coalesce_delay: Seconds to wait for more data before sending a
+        coalescable message, 0 only merges messages that are already queued
+    :param coalesce_max: Max data length of a coalesced message
+    """
+
+    RX_PORT_ARG_STR = IOServer.RX_PORT_ARG_STR
+    TX_PORT_ARG_STR = IOServer.TX_PORT_ARG_STR
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+        self,
+        rx_port=5556,
+        tx_port=5555,
+        log_file=None,
+        parser_args=None,
+        hwm=1024,
+        coalesce_delay=0.0,
+        coalesce_max=4096,
+        transport="ipc",
+        host="127.0.0.1",
+        namespace=None,
+    ):
+        if parser_args is not None:
+            rx_port = getattr(parser_args, self.RX_PORT_ARG_STR)
+            tx_port = getattr(parser_args, self.TX_PORT_ARG_STR)
+            transport, host, namespace = IOServer.endpoint_args(parser_args)
+        self.transport = transport
+        self.prefix = topic_prefix(namespace)
+        self.hal2io_pipe = zmq_endpoint(transport, HAL2IO, rx_port, host)
+        self.io2hal_pipe = zmq_endpoint(transport, IO2HAL, tx_port, host)
+        self.hwm = hwm
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max = coalesce_max
+        self.handlers = {}
+        self.capture = CaptureLog(log_file) if log_file is not None else None
+
+        self.context = None
+        self.rx_socket = None
+        self.tx_socket = None
+        self.loop = None
+        self._tx_queue = collections.deque()
+        self._tx_ready = None
+        self._tx_space = None
+        self._rx_queue = None
+        self._tasks = []
+        self._thread = None
+        self._started = threading.Event()
+        self._closing = False
+        self._stopped = None
+
+    def register_topic(self, topic, method=None):
+        """
+        Register the ZMQ `topic` and call `method(server, msg)` when it is
+        received.  Method may be a coroutine function.  Messages of topics
+        without a method are returned by recv()
+        """
+        log.debug("Registering Topic: %s", topic)
+        self.handlers[topic] = method
+        if self.rx_socket is not None:
+            self._call_in_loop(
+                self.rx_socket.setsockopt,
+                zmq.SUBSCRIBE,
+                (self.prefix + topic).encode("utf-8"),
+            )
+
+    def _in_loop(self):
+        return _running_loop() is self.loop
+
+    def _call_in_loop(self, func, *args):
+        if self._in_loop():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    async def open(self):
+        """
+        Connects the sockets and starts the rx and tx tasks on the running loop
+        """
+        self.loop = asyncio.get_running_loop()
+        if self.transport == "inproc":
+            # inproc endpoints are only reachable from the same context
+            self.context = zmq.asyncio.Context.shadow(zmq.Context.instance().underlying)
+        else:
+            self.context = zmq.asyncio.Context()
+        self.rx_socket = self.context.socket(zmq.SUB)
+        self.rx_socket.setsockopt(zmq.RCVHWM, self.hwm)
+        self.rx_socket.connect(self.hal2io_pipe)
+        for topic in self.handlers:
+            self.rx_socket.setsockopt(
+                zmq.SUBSCRIBE, (self.prefix + topic).encode("utf-8")
+            )
+        log.info("Connected to %s", self.hal2io_pipe)
+
+        self.tx_socket = self.context.socket(zmq.PUB)
+        self.tx_socket.setsockopt(zmq.SNDHWM, self.hwm)
+        self.tx_socket.connect(self.io2hal_pipe)
+        log.info("Connected to %s", self.io2hal_pipe)
+
+        self._tx_ready = asyncio.Event()
+        self._tx_space = asyncio.Event()
+        self._tx_space.set()
+        self._rx_queue = asyncio.Queue(self.hwm)
+        self._stopped = asyncio.Event()
+        self._tasks = [
+            asyncio.ensure_future(self._rx_task()),
+            asyncio.ensure_future(self._tx_task()),
+        ]
+        if self._tx_queue:
+            self._tx_ready.set()
+        return self
+
+    async def close(self):
+        """
+        Sends the queued messages, then stops the tasks and closes the sockets
+        """
+        if self._stopped is None or self._closing:
+            return
+        self._closing = True
+        while self._tx_queue and not self._tasks[1].done():
+            self._tx_ready.set()
+            await asyncio.sleep(0.001)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.rx_socket.close(linger=0)
+        self.tx_socket.close(linger=1000)
+        if self.transport != "inproc":
+            self.context.term()
+        if self.capture is not None:
+            self.capture.close()
+        self._stopped.set()
+        log.debug("IO Server Stopped")
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def wait_closed(self):
+        """
+        Waits until the server is closed
+        """
+        await self._stopped.wait()
+
+    async def _rx_task(self):
+        while True:
+            msg = (await self.rx_socket.recv_string())[len(self.prefix) :]
+            topic, data = decode_zmq_msg(msg)
+            log.debug("Received: %s", topic)
+            if self.capture is not None:
+                self.capture.write(CAPTURE_RX, topic, msg)
+            method = self.handlers.get(topic)
+            if method is None:
+                await self._rx_queue.put((topic, data))
+                continue
+            try:
+                result = method(self, data)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Handler for %s failed", topic)
+
+    async def recv(self):
+        """
+        Returns the next (topic, msg) received for a topic registered
+        without a method
+        """
+        return await self._rx_queue.get()
+
+    def _coalesce(self, topic, data):
+        """
+        Merges data into the last queued message if it is to the same UART
+        """
+        if not self._tx_queue or topic not in COALESCE:
+            return False
+        last_topic, last_data = self._tx_queue[-1]
+        id_field, data_field = COALESCE[topic]
+        if (
+            last_topic != topic
+            or last_data.get(id_field) != data.get(id_field)
+            or data_field not in data
+            or data_field not in last_data
+            or len(_as_list(last_data[data_field])) >= self.coalesce_max
+        ):
+            return False
+        last_data[data_field] = _merge(last_data[data_field], data[data_field])
+        return True
+
+    def send_nowait(self, topic, data):
+        """
+        Queues a message without waiting for space, must be called from the
+        server's loop
+        """
+        if topic in COALESCE:
+            data = dict(data)
+        if not self._coalesce(topic, data):
+            self._tx_queue.append((topic, data))
+        if self._tx_ready is not None:
+            self._tx_ready.set()
+            if len(self._tx_queue) >= self.hwm:
+                self._tx_space.clear()
+
+    async def send(self, topic, data):
+        """
+        Queues a message, waiting while hwm messages are already queued
+        """
+        while len(self._tx_queue) >= self.hwm:
+            await self._tx_space.wait()
+        self.send_nowait(topic, data)
+
+    async def drain(self):
+        """
+        Waits until the queued messages have been sent
+        """
+        while self._tx_queue:
+            await asyncio.sleep(0.001)
+
+    def send_msg(self, topic, data):
+        """
+        Sends a zmq message using `topic`.  From a thread without an event
+        loop this waits while the send queue is full, from other loops (e.g.
+        a handler of another AsyncIOServer) it never waits so servers
+        forwarding to each other cannot deadlock
+        """
+        if self.loop is None or self._in_loop():
+            self.send_nowait(topic, data)
+        elif _running_loop() is not None:
+            self.loop.call_soon_threadsafe(self.send_nowait, topic, data)
+        else:
+            asyncio.run_coroutine_threadsafe(self.send(topic, data), self.loop).result()
+
+    async def _tx_task(self):
+        while True:
+            await self._tx_ready.wait()
+            if not self._tx_queue:
+                self._tx_ready.clear()
+                continue
+            if self.coalesce_delay and self._tx_queue[-1][0] in COALESCE:
+                await asyncio.sleep(self.coalesce_delay)
+            self._tx_ready.clear()
+            while self._tx_queue:
+                topic, data = self._tx_queue.popleft()
+                msg = encode_zmq_msg(topic, data)
+                await self.tx_socket.send_string(self.prefix + msg)
+                if self.capture is not None:
+                    self.capture.write(CAPTURE_TX, topic, msg)
+                if len(self._tx_queue) < self.hwm:
+                    self._tx_space.set()
+            if self.capture is not None:
+                self.capture.flush()
+
+    def _run(self):
+        async def serve():
+            await self.open()
+            self._started.set()
+            await self.wait_closed()
+
+        try:
+            asyncio.run(serve())
+        finally:
+            self._started.set()
+
+    def start(self):
+        """
+        Runs the server on an event loop in a new thread, like IOServer.start
+        """
+        self._thread = threading.Thread(
+            target=self._run, name="AsyncIOServer", daemon=True
+        )
+        self._thread.start()
+        self._started.wait()
+
+    def shutdown(self):
+        """
+        Stops a server started with start
+        """
+        log.debug("Stopping Host IO Server")
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self._thread.join()
+        self._thread = None
+
+    @classmethod
+    def add_args(cls, parser):
+        """
+        Adds args to an ArgumentParser to enable easily integrating into external devices
+        """
+        IOServer.add_args(parser)
+
+
+def main():
+    """
+    Prints the messages in a capture log
+    """
+    parser = ArgumentParser()
+    parser.add_argument("capture", help="Capture log written with log_file")
+    args = parser.parse_args()
+
+    hal_log.setLogConfig()
+    for timestamp, direction, topic, msg in read_capture(args.capture):
+        direction = "Received" if direction == CAPTURE_RX else "Sent"
+        print(f"{timestamp:.6f} {direction} {topic} {msg}")
+
+
+if __name__ == "__main__":
+    main()
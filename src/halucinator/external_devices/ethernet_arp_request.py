@@ -10,8 +10,9 @@ from threading import Thread, Event
 import logging
 import time
 import socket
-import scapy.all as scapy
+from ..util.lazy_import import lazy_import
 import os
+scapy = lazy_import("scapy.all")
 
 log = logging.getLogger(__name__)
 
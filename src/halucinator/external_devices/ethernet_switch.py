@@ -0,0 +1,523 @@
+"""
+MAC learning virtual Ethernet switch connecting HALucinator instances
+"""
+
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+#
+# Unlike VirtualEthHub, which floods every frame to every IOServer, the
+# switch learns the source MAC of each frame per port and VLAN, forwards
+# unicast frames to the one port that has the destination, and floods only
+# broadcast, multicast and unknown destinations.  Frames are forwarded as the
+# raw message text: the Ethernet header is read from the first base64 chars
+# of the frame and the message is re-encoded only when a VLAN tag has to be
+# added or removed.
+#
+# Each port is a pair of ZMQ sockets to one emulator.  With a hal_zmq_broker
+# all ports connect to the broker, one namespace per emulator, so the broker
+# is the only hop in the data path:
+#     hal_dev_eth_switch --transport tcp --host broker -n board1 board2 board3
+#
+# host_bridge.HostPort connects a port to a host TAP device or interface.
+
+import abc
+from argparse import ArgumentParser
+import base64
+import binascii
+import collections
+import logging
+import re
+import select
+import threading
+import time
+
+import yaml
+import zmq
+
+from halucinator.peripheral_models.peripheral_server import (
+    topic_prefix,
+    zmq_endpoint,
+    HAL2IO,
+    IO2HAL,
+    TRANSPORTS,
+)
+from halucinator import hal_capture
+from halucinator import hal_log
+
+log = logging.getLogger(__name__)
+
+TX_TOPIC = "Peripheral.EthernetModel.tx_frame"
+RX_TOPIC = "Peripheral.EthernetModel.rx_frame"
+VLAN_TPID = b"\x81\x00"
+# dst, src, 802.1Q tag
+HEADER_LEN = 16
+
+# yaml.safe_dump writes bytes as base64 lines indented by two spaces
+_BINARY_FRAME = re.compile(r"frame: !!binary \|\n((?:  [A-Za-z0-9+/=]+\n)+)")
+
+
+def peek_frame(body):
+    """
+    Reads the start of the frame from a yaml encoded message without
+    decoding the message
+
+    :returns: (first HEADER_LEN (or fewer) bytes, frame length) or None if
+        the frame is not encoded as expected
+    """
+    match = _BINARY_FRAME.search(body)
+    if match is None:
+        return None
+    encoded = match.group(1)
+    # Enough whole base64 groups for the header, all on the first line
+    head = encoded[2 : 2 + -(-HEADER_LEN // 3) * 4].split("\n", 1)[0]
+    num_chars = len(encoded) - encoded.count(" ") - encoded.count("\n")
+    length = num_chars // 4 * 3 - encoded.count("=")
+    return binascii.a2b_base64(head)[:HEADER_LEN], length
+
+
+def body_frame(body):
+    """
+    Returns the frame of a yaml encoded message, decoding only the frame
+    """
+    match = _BINARY_FRAME.search(body)
+    if match is None:
+        return yaml.safe_load(body)["frame"]
+    # a2b_base64 skips the indentation and newlines
+    return binascii.a2b_base64(match.group(1))
+
+
+def frame_body(frame, interface_id):
+    """
+    Returns the yaml encoded message of frame, the same as
+    yaml.safe_dump({"interface_id": interface_id, "frame": frame})
+    """
+    if not frame:
+        return yaml.safe_dump({"interface_id": interface_id, "frame": frame})
+    lines = base64.encodebytes(frame).decode("ascii").splitlines(True)
+    return (
+        "frame: !!binary |\n  "
+        + "  ".join(lines)
+        + yaml.safe_dump({"interface_id": interface_id})
+    )
+
+
+def _multicast(mac):
+    return mac[0] & 1
+
+
+def _mac_str(mac):
+    return ":".join(f"{b:02x}" for b in mac)
+
+
+class PortBase(abc.ABC):
+    """
+    Switch port, subclasses connect it to an emulator or the host
+
+    :param name: Port name used in logs and stats
+    :param vlan: Access VLAN, or native (untagged) VLAN of a trunk port
+    :param trunk: Carry 802.1Q tagged frames of the VLANs in vlans
+    :param vlans: VLANs allowed on a trunk port, None for all
+    """
+
+    def __init__(self, name, vlan=1, trunk=False, vlans=None):
+        self.name = name
+        self.vlan = vlan
+        self.trunk = trunk
+        self.vlans = set(vlans) if vlans is not None else None
+        self.counters = collections.Counter()
+
+    def carries(self, vlan):
+        """
+        Returns True if frames of vlan are sent and received on this port
+        """
+        if vlan == self.vlan:
+            return True
+        return self.trunk and (self.vlans is None or vlan in self.vlans)
+
+    def tagged(self, vlan):
+        """
+        Returns True if frames of vlan are tagged on this port
+        """
+        return vlan != self.vlan
+
+    @abc.abstractmethod
+    def fileno(self):
+        """
+        Returns the file descriptor that is readable when frames may be
+        waiting
+        """
+
+    @abc.abstractmethod
+    def recv_batch(self, max_frames):
+        """
+        Returns up to max_frames received frame message bodies (the encoded
+        message after the topic) without waiting
+        """
+
+    @abc.abstractmethod
+    def send(self, body, length):
+        """
+        Sends a frame message body out of the port
+        """
+
+    def flush(self):
+        """
+        Retries sends that would have blocked, returns True if some are
+        still pending
+        """
+        return False
+
+    def close(self):
+        """
+        Closes the port
+        """
+
+
+class SwitchPort(PortBase):
+    """
+    Switch port connected to one emulator's ethernet model
+
+    :param rx_port: Port the emulator publishes on (its tx_port)
+    :param tx_port: Port the emulator receives on (its rx_port)
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        name,
+        rx_port=5556,
+        tx_port=5555,
+        transport="ipc",
+        host="127.0.0.1",
+        namespace=None,
+        vlan=1,
+        trunk=False,
+        vlans=None,
+        context=None,
+    ):
+        super().__init__(name, vlan, trunk, vlans)
+        self.prefix = topic_prefix(namespace)
+        context = context if context is not None else zmq.Context.instance()
+        self.rx_socket = context.socket(zmq.SUB)
+        self.rx_socket.connect(zmq_endpoint(transport, HAL2IO, rx_port, host))
+        self.rx_socket.setsockopt_string(zmq.SUBSCRIBE, self.prefix + TX_TOPIC)
+        self.tx_socket = context.socket(zmq.PUB)
+        self.tx_socket.connect(zmq_endpoint(transport, IO2HAL, tx_port, host))
+
+    def fileno(self):
+        # Edge triggered, only re-armed by receiving until zmq.Again
+        return self.rx_socket.getsockopt(zmq.FD)
+
+    def recv_batch(self, max_frames):
+        bodies = []
+        try:
+            while len(bodies) < max_frames:
+                string = self.rx_socket.recv_string(zmq.NOBLOCK)
+                bodies.append(string.split(" ", 1)[1])
+        except zmq.Again:
+            pass
+        return bodies
+
+    def send(self, body, length):
+        self.tx_socket.send_string(f"{self.prefix}{RX_TOPIC} {body}")
+        self.counters["tx_frames"] += 1
+        self.counters["tx_bytes"] += length
+
+    def close(self):
+        self.rx_socket.close(linger=0)
+        self.tx_socket.close(linger=100)
+
+
+def _retag(body, vlan):
+    """
+    Returns body with the frame's 802.1Q tag set to vlan, or removed if
+    vlan is None
+    """
+    msg = yaml.safe_load(body)
+    frame = msg["frame"]
+    if frame[12:14] == VLAN_TPID:
+        frame = frame[:12] + frame[16:]
+    if vlan is not None:
+        frame = frame[:12] + VLAN_TPID + vlan.to_bytes(2, "big") + frame[12:]
+    msg["frame"] = frame
+    return yaml.safe_dump(msg), len(frame)
+
+
+class EthernetSwitch:
+    """
+    MAC learning switch forwarding frames between SwitchPorts
+
+    :param ageing_time: Seconds a learned MAC address is kept
+    :param capture: hal_capture.PcapngWriter frames received on the ports
+        are captured to, one pcapng interface per port
+    """
+
+    # Max frames read from a port before reading the next one
+    BATCH = 64
+
+    def __init__(self, ageing_time=300.0, capture=None):
+        self.ports = []
+        self.ageing_time = ageing_time
+        self.capture = capture
+        # (vlan, mac): (port, time last seen)
+        self.mac_table = {}
+        self.__stop = threading.Event()
+        self._thread = None
+
+    def add_port(self, port):
+        """
+        Adds a PortBase, must be called before start
+        """
+        self.ports.append(port)
+        return port
+
+    def _lookup(self, vlan, mac, now):
+        entry = self.mac_table.get((vlan, mac))
+        if entry is None:
+            return None
+        port, last_seen = entry
+        if now - last_seen > self.ageing_time:
+            del self.mac_table[(vlan, mac)]
+            return None
+        return port
+
+    def handle_frame(self, in_port, body):
+        """
+        Learns the source and forwards the frame message body from in_port
+        """
+        peeked = peek_frame(body)
+        if peeked is None:
+            frame = yaml.safe_load(body).get("frame")
+            if not isinstance(frame, bytes):
+                in_port.counters["dropped"] += 1
+                return
+            peeked = frame[:HEADER_LEN], len(frame)
+        header, length = peeked
+        in_port.counters["rx_frames"] += 1
+        in_port.counters["rx_bytes"] += length
+        if len(header) < 14:
+            in_port.counters["dropped"] += 1
+            return
+        if self.capture is not None:
+            self.capture.write(
+                in_port.name,
+                hal_capture.LINKTYPE_ETHERNET,
+                body_frame(body),
+                hal_capture.INBOUND,
+            )
+
+        dst, src = header[:6], header[6:12]
+        is_tagged = header[12:14] == VLAN_TPID and len(header) >= 16
+        vlan = (
+            int.from_bytes(header[14:16], "big") & 0xFFF if is_tagged else in_port.vlan
+        )
+        if not in_port.carries(vlan) or (is_tagged and not in_port.trunk):
+            in_port.counters["dropped"] += 1
+            return
+
+        now = time.monotonic()
+        if not _multicast(src):
+            old = self._lookup(vlan, src, now)
+            if old is not in_port:
+                log.debug("Learned %s vlan %i on %s", _mac_str(src), vlan, in_port.name)
+            self.mac_table[(vlan, src)] = (in_port, now)
+
+        out_port = None if _multicast(dst) else self._lookup(vlan, dst, now)
+        if out_port is in_port:
+            in_port.counters["filtered"] += 1
+            return
+        if out_port is not None:
+            out_ports = [out_port] if out_port.carries(vlan) else []
+        else:
+            in_port.counters["flooded"] += 1
+            out_ports = [p for p in self.ports if p is not in_port and p.carries(vlan)]
+
+        # Message bodies keyed by tagged, only re-encoded if a tag changes
+        bodies = {is_tagged: (body, length)}
+        for port in out_ports:
+            tagged = port.tagged(vlan)
+            if tagged not in bodies:
+                bodies[tagged] = _retag(body, vlan if tagged else None)
+            port.send(*bodies[tagged])
+
+    def run(self):
+        """
+        Forwards frames until shutdown
+        """
+        epoll = select.epoll()
+        for port in self.ports:
+            epoll.register(port.fileno(), select.EPOLLIN)
+        pending = False
+        while not self.__stop.is_set():
+            # Sends that would have blocked are retried soon
+            epoll.poll(0.01 if pending else 1.0)
+            # ZMQ's fds are edge triggered, so every port is read until
+            # a round receives nothing
+            received = True
+            while received:
+                received = False
+                for port in self.ports:
+                    for body in port.recv_batch(self.BATCH):
+                        received = True
+                        try:
+                            self.handle_frame(port, body)
+                        except Exception:  # pylint: disable=broad-except
+                            log.exception("Error forwarding frame from %s", port.name)
+            pending = False
+            for port in self.ports:
+                pending = port.flush() or pending
+        epoll.close()
+        for port in self.ports:
+            port.close()
+        log.debug("Switch Stopped")
+
+    def start(self):
+        """
+        Runs the switch in a new thread
+        """
+        self._thread = threading.Thread(target=self.run, name="EthernetSwitch")
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stops the switch
+        """
+        self.__stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def mac_table_str(self):
+        """
+        Returns the learned addresses as a table
+        """
+        lines = [f"{'vlan':>5} {'mac':<17} port"]
+        for (vlan, mac), (port, _) in sorted(
+            self.mac_table.items(), key=lambda e: (e[0][0], e[1][0].name)
+        ):
+            lines.append(f"{vlan:>5} {_mac_str(mac):<17} {port.name}")
+        return "\n".join(lines)
+
+    def stats(self):
+        """
+        Returns the per port counters as a table
+        """
+        names = (
+            "rx_frames",
+            "rx_bytes",
+            "tx_frames",
+            "tx_bytes",
+            "flooded",
+            "filtered",
+            "dropped",
+        )
+        lines = [f"{'port':<12}" + "".join(f"{name:>12}" for name in names)]
+        for port in self.ports:
+            lines.append(
+                f"{port.name:<12}"
+                + "".join(f"{port.counters[name]:>12}" for name in names)
+            )
+        return "\n".join(lines)
+
+
+def main():
+    """
+    Runs the switch until interrupted
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-r",
+        "--rx_ports",
+        nargs="+",
+        type=int,
+        default=[5556, 5558],
+        help="Ports the emulators publish on (their tx_port), one per switch port",
+    )
+    parser.add_argument(
+        "-t",
+        "--tx_ports",
+        nargs="+",
+        type=int,
+        default=[5555, 5557],
+        help="Ports the emulators receive on (their rx_port), one per switch port",
+    )
+    parser.add_argument(
+        "-n",
+        "--namespaces",
+        nargs="+",
+        default=None,
+        help="Emulator namespaces on a broker, one switch port each using the "
+        "first rx and tx port",
+    )
+    parser.add_argument("--transport", default="ipc", choices=TRANSPORTS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--vlans",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Access VLAN of each port, default 1",
+    )
+    parser.add_argument(
+        "--trunks",
+        nargs="+",
+        type=int,
+        default=[],
+        help="Indexes of ports that carry tagged frames of all VLANs",
+    )
+    parser.add_argument(
+        "--ageing", type=float, default=300.0, help="MAC address ageing time"
+    )
+    parser.add_argument(
+        "-w", "--pcap", default=None, help="Capture switched frames to this file"
+    )
+    args = parser.parse_args()
+
+    if not args.namespaces and len(args.rx_ports) != len(args.tx_ports):
+        parser.error("Number of rx_ports and number of tx_ports must match")
+    if args.namespaces:
+        ports = [(ns, args.rx_ports[0], args.tx_ports[0], ns) for ns in args.namespaces]
+    else:
+        ports = [
+            (f"port{idx}", rx_port, tx_port, None)
+            for idx, (rx_port, tx_port) in enumerate(zip(args.rx_ports, args.tx_ports))
+        ]
+    vlans = args.vlans or [1] * len(ports)
+    if len(vlans) != len(ports):
+        parser.error("Number of vlans must match the number of ports")
+
+    hal_log.setLogConfig()
+    capture = None
+    if args.pcap is not None:
+        capture = hal_capture.PcapngWriter(args.pcap)
+    switch = EthernetSwitch(args.ageing, capture)
+    for idx, (name, rx_port, tx_port, namespace) in enumerate(ports):
+        switch.add_port(
+            SwitchPort(
+                name,
+                rx_port,
+                tx_port,
+                args.transport,
+                args.host,
+                namespace,
+                vlan=vlans[idx],
+                trunk=idx in args.trunks,
+            )
+        )
+    switch.start()
+    try:
+        while True:
+            time.sleep(10)
+            log.info("Switch stats\n%s", switch.stats())
+    except KeyboardInterrupt:
+        pass
+    switch.shutdown()
+    if capture is not None:
+        capture.close()
+    print(switch.stats())
+    print(switch.mac_table_str())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,27 @@
 # Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains 
 # certain rights in this software.
 
-from .ioserver import IOServer
+from .async_ioserver import AsyncIOServer
 from .trigger_interrupt import SendInterrupt
 from threading import Thread, Event
 import logging
 import time
 import socket
-import scapy.all as scapy
 import os
 from .host_ethernet_server import HostEthernetServer
+from halucinator import hal_capture
 log = logging.getLogger(__name__)
 
 
 class VirtualEthHub(object):
-    def __init__(self, ioservers=[]):
+    def __init__(self, ioservers=[], capture=None):
         '''
             args:
             ioserver:  list of ioservers to bridge together
+            capture:   hal_capture.PcapngWriter frames are captured to
         '''
         self.ioservers = []
+        self.capture = capture
         self.host_socket = None
         self.host_interface = None
         for server in ioservers:
@@ -32,6 +34,10 @@ class VirtualEthHub(object):
                                 self.received_frame)
 
     def received_frame(self, from_server, msg):
+        if self.capture is not None:
+            port = self.ioservers.index(from_server) if from_server in self.ioservers else "input"
+            self.capture.write("port%s" % port, hal_capture.LINKTYPE_ETHERNET,
+                               msg['frame'], hal_capture.INBOUND)
         for server in self.ioservers:
             log.info('Forwarding, msg')
             if server != from_server:
@@ -55,6 +61,8 @@ def main():
     p.add_argument('-p', '--enable_host_rx', required=False, default=False,
                    action='store_true',
                    help='Enable Receiving data from host interface, requires -i')
+    p.add_argument('-w', '--pcap', required=False, default=None,
+                   help='Capture forwarded frames to this pcapng file')
     args = p.parse_args()
 
     if len(args.rx_ports) != len(args.tx_ports):
@@ -66,7 +74,10 @@ def main():
     #log = logging.getLogger()
     log.setLevel(logging.DEBUG)
 
-    hub = VirtualEthHub()
+    capture = None
+    if args.pcap is not None:
+        capture = hal_capture.PcapngWriter(args.pcap)
+    hub = VirtualEthHub(capture=capture)
 
     if args.interface is not None:
         host_eth = HostEthernetServer(args.interface, args.enable_host_rx)
@@ -75,7 +86,7 @@ def main():
 
     for idx, rx_port in enumerate(args.rx_ports):
         print(idx)
-        server = IOServer(rx_port, args.tx_ports[idx])
+        server = AsyncIOServer(rx_port, args.tx_ports[idx])
         hub.add_server(server)
         if idx == 0:
             interrupter = SendInterrupt(server)
@@ -94,6 +105,8 @@ def main():
         pass
     log.info("Shutting Down")
     hub.shutdown()
+    if capture is not None:
+        capture.close()
     # io_server.join()
 
 if __name__ == '__main__':
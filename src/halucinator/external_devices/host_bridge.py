@@ -0,0 +1,300 @@
+"""
+Bridges HALucinator's ethernet models to a host TAP device or interface
+"""
+
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+#
+# The host side is opened once and used non-blocking: HostPort is an
+# EthernetSwitch port, so the switch's epoll loop reads frames from the host
+# fd in batches alongside the emulators' ZMQ sockets, and frames that can't be
+# written yet are queued and retried.  Python has no sendmmsg/recvmmsg, so a
+# batch is the frames read until EAGAIN on one wakeup.
+#
+# Bridge one emulator to a new TAP device
+#     sudo hal_dev_host_bridge --tap hal0
+# or to an existing interface, e.g. one end of a veth pair, with test tools on
+# the other end
+#     sudo ip link add hal0 type veth peer name hal1
+#     sudo hal_dev_host_bridge -i hal0
+# Frames the host sends out of the AF_PACKET interface itself are not bridged
+# (like a Linux bridge), use a TAP or veth for tools on the same host.
+
+from argparse import ArgumentParser
+import collections
+import errno
+import fcntl
+import logging
+import os
+import socket
+import struct
+import subprocess
+import time
+
+from halucinator.external_devices.ethernet_switch import (
+    EthernetSwitch,
+    PortBase,
+    SwitchPort,
+    body_frame,
+    frame_body,
+)
+from halucinator.peripheral_models.peripheral_server import TRANSPORTS
+from halucinator import hal_capture
+from halucinator import hal_log
+
+log = logging.getLogger(__name__)
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_PROMISC = 1
+PACKET_OUTGOING = 4
+PACKET_IGNORE_OUTGOING = 23
+TUNSETIFF = 0x400454CA
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+# Largest frame read, jumbo frames plus tags
+MAX_FRAME = 9234
+SOCKET_BUFFER = 16 << 20
+SO_SNDBUFFORCE = 32
+SO_RCVBUFFORCE = 33
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+class HostInterface:
+    """
+    Non-blocking frame I/O on a TAP device or AF_PACKET socket, use tap or
+    packet to open one
+    """
+
+    def __init__(self, name, fd, sock=None):
+        self.name = name
+        self.fd = fd
+        self.sock = sock
+
+    @classmethod
+    def tap(cls, name):
+        """
+        Creates (or attaches to) TAP device name and brings it up
+        """
+        fd = os.open("/dev/net/tun", os.O_RDWR | os.O_NONBLOCK)
+        ifreq = struct.pack("16sH", name.encode("utf-8"), IFF_TAP | IFF_NO_PI)
+        try:
+            fcntl.ioctl(fd, TUNSETIFF, ifreq)
+            subprocess.run(["ip", "link", "set", name, "up"], check=True)
+        except (OSError, subprocess.CalledProcessError):
+            os.close(fd)
+            raise
+        log.info("Attached to TAP %s", name)
+        return cls(name, fd)
+
+    @classmethod
+    def packet(cls, interface, promisc=True):
+        """
+        Opens a raw AF_PACKET socket on interface
+        """
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        sock.bind((interface, 0))
+        sock.setblocking(False)
+        for force_opt, opt in (
+            (SO_RCVBUFFORCE, socket.SO_RCVBUF),
+            (SO_SNDBUFFORCE, socket.SO_SNDBUF),
+        ):
+            try:
+                # Bursts are absorbed by the socket buffer, root can exceed
+                # net.core.rmem_max/wmem_max
+                sock.setsockopt(socket.SOL_SOCKET, force_opt, SOCKET_BUFFER)
+            except OSError:
+                sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER)
+        try:
+            # Linux 4.20+, older kernels are filtered in read_frames
+            sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        except OSError:
+            pass
+        if promisc:
+            mreq = struct.pack(
+                "iHH8s", socket.if_nametoindex(interface), PACKET_MR_PROMISC, 0, b""
+            )
+            sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+        log.info("Attached to interface %s", interface)
+        return cls(interface, sock.fileno(), sock)
+
+    def fileno(self):
+        """
+        Returns the fd to poll
+        """
+        return self.fd
+
+    def read_frames(self, max_frames):
+        """
+        Returns up to max_frames frames that can be read without blocking
+        """
+        frames = []
+        try:
+            while len(frames) < max_frames:
+                if self.sock is None:
+                    frames.append(os.read(self.fd, MAX_FRAME))
+                    continue
+                frame, addr = self.sock.recvfrom(MAX_FRAME)
+                if addr[2] != PACKET_OUTGOING:
+                    frames.append(frame)
+        except OSError as error:
+            if error.errno not in _WOULD_BLOCK:
+                raise
+        return frames
+
+    def write_frame(self, frame):
+        """
+        Writes frame, returns False if it would block
+        """
+        try:
+            if self.sock is None:
+                os.write(self.fd, frame)
+            else:
+                self.sock.send(frame)
+        except OSError as error:
+            if error.errno in _WOULD_BLOCK:
+                return False
+            raise
+        return True
+
+    def close(self):
+        """
+        Closes the device or socket
+        """
+        if self.sock is None:
+            os.close(self.fd)
+        else:
+            self.sock.close()
+
+
+class HostPort(PortBase):
+    """
+    EthernetSwitch port to a HostInterface
+
+    :param interface_id: Interface id put in messages of frames from the host
+    :param max_pending: Frames queued when the host can't take them before
+        the oldest are dropped
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        name,
+        interface,
+        interface_id,
+        vlan=1,
+        trunk=False,
+        vlans=None,
+        max_pending=1024,
+    ):
+        super().__init__(name, vlan, trunk, vlans)
+        self.interface = interface
+        self.interface_id = interface_id
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+
+    def fileno(self):
+        return self.interface.fileno()
+
+    def recv_batch(self, max_frames):
+        return [
+            frame_body(frame, self.interface_id)
+            for frame in self.interface.read_frames(max_frames)
+        ]
+
+    def send(self, body, length):
+        frame = body_frame(body)
+        self.counters["tx_frames"] += 1
+        self.counters["tx_bytes"] += length
+        if self.pending or not self.interface.write_frame(frame):
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.counters["dropped"] += 1
+            self.pending.append(frame)
+
+    def flush(self):
+        while self.pending:
+            if not self.interface.write_frame(self.pending[0]):
+                return True
+            self.pending.popleft()
+        return False
+
+    def close(self):
+        self.interface.close()
+
+
+def main():
+    """
+    Bridges one emulator's ethernet model to the host
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-r",
+        "--rx_port",
+        default=5556,
+        type=int,
+        help="Port number to receive zmq messages for IO on",
+    )
+    parser.add_argument(
+        "-t",
+        "--tx_port",
+        default=5555,
+        type=int,
+        help="Port number to send IO messages via zmq",
+    )
+    parser.add_argument("--transport", default="ipc", choices=TRANSPORTS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--namespace", default=None)
+    host_if = parser.add_mutually_exclusive_group(required=True)
+    host_if.add_argument("-i", "--interface", help="Host interface to bridge to")
+    host_if.add_argument("--tap", help="TAP device to create and bridge to")
+    parser.add_argument(
+        "--id",
+        default=1073905664,
+        type=lambda x: int(x, 0),
+        help="Ethernet interface id of frames sent to the emulator",
+    )
+    parser.add_argument(
+        "-w", "--pcap", default=None, help="Capture bridged frames to this file"
+    )
+    args = parser.parse_args()
+
+    hal_log.setLogConfig()
+    if args.tap is not None:
+        interface = HostInterface.tap(args.tap)
+    else:
+        interface = HostInterface.packet(args.interface)
+
+    capture = None
+    if args.pcap is not None:
+        capture = hal_capture.PcapngWriter(args.pcap)
+    switch = EthernetSwitch(capture=capture)
+    switch.add_port(
+        SwitchPort(
+            "emulator",
+            args.rx_port,
+            args.tx_port,
+            args.transport,
+            args.host,
+            args.namespace,
+        )
+    )
+    switch.add_port(HostPort(interface.name, interface, args.id))
+    switch.start()
+    try:
+        while True:
+            time.sleep(10)
+            log.info("Bridge stats\n%s", switch.stats())
+    except KeyboardInterrupt:
+        pass
+    switch.shutdown()
+    if capture is not None:
+        capture.close()
+    print(switch.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,6 @@ import os
 import socket
 import time
 import binascii
-import scapy.all as scapy
 
 __run_server = True
 __host_socket = None
@@ -38,9 +37,8 @@ def rx_from_emulator(emu_rx_port, interface):
         frame = data['frame']
         # if len(frame) < 64:
         #    frame = frame +('\x00' * (64-len(frame)))
-        p = scapy.Raw(frame)
-        scapy.sendp(p, iface=interface)
-        # __host_socket.send(frame)
+        # Sent on the socket opened by start
+        __host_socket.send(frame)
         print("Sending Frame (%i) on eth: %s" %
               (len(frame), binascii.hexlify(frame)))
 
@@ -6,7 +6,6 @@ from threading import Thread, Event
 import logging
 import time
 import socket
-import scapy.all as scapy
 import os
 
 log = logging.getLogger(__name__)
@@ -46,8 +45,7 @@ class HostEthernetServer(Thread):
 
     def send_msg(self, topic, msg):
         frame = msg['frame']
-        p = scapy.Raw(frame)
-        scapy.sendp(p, iface=self.interface)
+        self.host_socket.send(frame)
 
     def shutdown(self):
         log.debug("Stopping Host Ethernet Server")
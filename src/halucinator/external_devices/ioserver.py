@@ -16,6 +16,11 @@ import zmq
 from halucinator.peripheral_models.peripheral_server import (
     encode_zmq_msg,
     decode_zmq_msg,
+    topic_prefix,
+    zmq_endpoint,
+    HAL2IO,
+    IO2HAL,
+    TRANSPORTS,
 )
 from halucinator import hal_log
 
@@ -31,22 +36,39 @@ class IOServer(Thread):
     RX_PORT_ARG_STR = "rx_port"
     TX_PORT_ARG_STR = "tx_port"
 
-    def __init__(self, rx_port=5556, tx_port=5555, log_file=None, parser_args=None):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        rx_port=5556,
+        tx_port=5555,
+        log_file=None,
+        parser_args=None,
+        transport="ipc",
+        host="127.0.0.1",
+        namespace=None,
+    ):
         if parser_args is not None:
             rx_port = getattr(parser_args, IOServer.RX_PORT_ARG_STR)
             tx_port = getattr(parser_args, IOServer.TX_PORT_ARG_STR)
+            transport, host, namespace = self.endpoint_args(parser_args)
         Thread.__init__(self)
         self.__stop = Event()
-        self.context = zmq.Context()
-        io2hal_pipe = f"ipc:///tmp/Halucinator2IoServer{rx_port}"
+        self.prefix = topic_prefix(namespace)
+        # inproc endpoints are only reachable from the same context
+        if transport == "inproc":
+            self.context = zmq.Context.instance()
+        else:
+            self.context = zmq.Context()
+        # Both bound emulators and a broker are connected to the same way
+        hal2io_pipe = zmq_endpoint(transport, HAL2IO, rx_port, host)
         self.rx_socket = self.context.socket(zmq.SUB)
-        self.rx_socket.connect(io2hal_pipe)
-        print(f"Connected to {io2hal_pipe}")
+        self.rx_socket.connect(hal2io_pipe)
+        print(f"Connected to {hal2io_pipe}")
 
-        hal2io_pipe = f"ipc:///tmp/IoServer2Halucinator{tx_port}"
+        io2hal_pipe = zmq_endpoint(transport, IO2HAL, tx_port, host)
         self.tx_socket = self.context.socket(zmq.PUB)
-        self.tx_socket.connect(hal2io_pipe)
-        print(f"Connected to {hal2io_pipe}")
+        self.tx_socket.connect(io2hal_pipe)
+        print(f"Connected to {io2hal_pipe}")
 
         self.poller = zmq.Poller()
         self.poller.register(self.rx_socket, zmq.POLLIN)
@@ -62,7 +84,9 @@ class IOServer(Thread):
         Register the ZMQ `topic` and will call `method` when the topic is received
         """
         log.debug("Registering Topic: %s", topic)
-        self.rx_socket.setsockopt(zmq.SUBSCRIBE, topic.encode("utf-8"))
+        self.rx_socket.setsockopt(
+            zmq.SUBSCRIBE, (self.prefix + topic).encode("utf-8")
+        )
         self.handlers[topic] = method
 
     def run(self):
@@ -76,17 +100,12 @@ class IOServer(Thread):
             if self.rx_socket in socks and socks[self.rx_socket] == zmq.POLLIN:
                 msg = self.rx_socket.recv_string()
                 log.debug("Received: %s", str(msg))
-                topic, data = decode_zmq_msg(msg)
-                if self.packet_log:
-                    self.packet_log.write(
-                        "Sent, %i, %s, %s\n",
-                        time.time(),
-                        topic,
-                        binascii.hexlify(data["frame"]),
-                    )
-                    self.packet_log.flush()
+                topic, data = decode_zmq_msg(msg[len(self.prefix):])
+                self._log_packet("Sent", topic, data)
                 method = self.handlers[topic]
                 method(self, data)
+        if self.packet_log:
+            self.packet_log.close()
         log.debug("IO Server Stopped")
 
     def shutdown(self):
@@ -95,26 +114,25 @@ class IOServer(Thread):
         """
         log.debug("Stopping Host IO Server")
         self.__stop.set()
-        if self.packet_log:
-            self.packet_log.close()
 
     def send_msg(self, topic, data):
         """
         Sends a zmq message using `topic`
         """
-        msg = encode_zmq_msg(topic, data)
+        msg = encode_zmq_msg(self.prefix + topic, data)
         self.tx_socket.send_string(msg)
-        if self.packet_log:
-            # TODO, make logging more generic so will work for non-frames
-            if "frame" in data:
+        self._log_packet("Received", topic, data)
 
-                self.packet_log.write(
-                    "Received, %i, %s, %s\n",
-                    time.time(),
-                    topic,
-                    binascii.hexlify(data["frame"]),
-                )
-                self.packet_log.flush()
+    def _log_packet(self, direction, topic, data):
+        """
+        Writes frames to the packet log, direction is from the firmware's view.
+        See async_ioserver.CaptureLog for a log of all messages
+        """
+        if self.packet_log and "frame" in data:
+            self.packet_log.write(
+                f"{direction}, {time.time():f}, {topic}, "
+                f"{binascii.hexlify(data['frame']).decode()}\n"
+            )
 
     @classmethod
     def add_args(cls, parser):
@@ -133,6 +151,31 @@ class IOServer(Thread):
             default=5555,
             help="Port number to send IO messages via zmq",
         )
+        parser.add_argument(
+            "--transport",
+            default="ipc",
+            choices=TRANSPORTS,
+            help="ZMQ transport, use tcp for HALucinator or a broker on another host",
+        )
+        parser.add_argument(
+            "--host",
+            default="127.0.0.1",
+            help="Address of HALucinator or the broker, for tcp",
+        )
+        parser.add_argument(
+            "--namespace", default=None, help="Namespace of the HALucinator instance"
+        )
+
+    @staticmethod
+    def endpoint_args(parser_args):
+        """
+        Returns (transport, host, namespace) from args added by add_args
+        """
+        return (
+            getattr(parser_args, "transport", "ipc"),
+            getattr(parser_args, "host", "127.0.0.1"),
+            getattr(parser_args, "namespace", None),
+        )
 
 
 def main():
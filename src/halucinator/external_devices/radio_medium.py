@@ -0,0 +1,576 @@
+"""
+IEEE 802.15.4 radio medium connecting many HALucinator instances (requires
+numpy)
+"""
+
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+#
+# Unlike the IEEE802_15_4 hub, which sends every frame to every emulator, the
+# medium knows each radio's position and channel.  Link delivery ratios are
+# precomputed into a matrix (with NumPy) from a loss model whenever a radio
+# moves, so delivering a frame is a few vector operations over all radios.
+# Frames occupy their channel for their airtime and are delivered when it
+# ends; radios that hear two overlapping transmissions on a channel receive
+# neither, and a radio can't receive while it transmits.
+#
+# All radios are served by one process and one poll loop.  With a
+# hal_zmq_broker every emulator uses its own namespace:
+#     hal_dev_radio_medium topology.yaml --broker --transport tcp --host broker
+# where topology.yaml is (the model type is unit_disk or log_distance)
+#     model: {type: unit_disk, tx_range: 30, interference_range: 60}
+#     nodes:
+#       - name: board1        # also the namespace, unless namespace is set
+#         position: [0, 0]
+#         channel: 26
+#       - name: board2
+#         position: [20, 0]
+#     loss:                   # optional, replaces the model's links
+#       - [0.0, 0.9]          # loss[src][dst], delivery ratio of the frames
+#       - [0.7, 0.0]          # from src to dst, in the order of nodes
+#     links:                  # optional per link delivery ratios
+#       - {src: board1, dst: board2, prr: 0.8}
+# Nodes without a broker give their emulator's rx_port and tx_port instead.
+
+from argparse import ArgumentParser
+import heapq
+import logging
+import select
+import threading
+import time
+
+import yaml
+import zmq
+
+from halucinator.peripheral_models.peripheral_server import (
+    topic_prefix,
+    zmq_endpoint,
+    HAL2IO,
+    IO2HAL,
+    TRANSPORTS,
+)
+from halucinator import hal_capture
+from halucinator import hal_log
+from halucinator.util.lazy_import import lazy_import
+
+# Optional dependency, only needed to run the medium
+np = lazy_import("numpy")
+
+log = logging.getLogger(__name__)
+
+TOPIC = "Peripheral.IEEE802_15_4."
+TX_TOPIC = TOPIC + "tx_frame"
+CHANNEL_TOPIC = TOPIC + "set_channel"
+RX_TOPIC = TOPIC + "rx_frame"
+
+# 2.4 GHz O-QPSK PHY, 250 kbit/s
+BYTE_TIME = 32e-6
+# Preamble, SFD and PHR
+PHY_OVERHEAD = 6
+FCS_LEN = 2
+DEFAULT_CHANNEL = 26
+
+
+def airtime(length):
+    """
+    Returns the seconds a frame of length bytes (without FCS) is on the air
+    """
+    return (PHY_OVERHEAD + length + FCS_LEN) * BYTE_TIME
+
+
+class Transmission:
+    """
+    A frame on the air
+
+    :param receivers: Bool array of the radios that will receive the frame
+        unless it is corrupted
+    :param corrupted: Bool array of the radios that heard a collision
+    """
+
+    __slots__ = ("src", "channel", "start", "end", "frame", "receivers", "corrupted")
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, src, channel, start, end, frame, receivers, corrupted):
+        self.src = src
+        self.channel = channel
+        self.start = start
+        self.end = end
+        self.frame = frame
+        self.receivers = receivers
+        self.corrupted = corrupted
+
+    def delivered(self):
+        """
+        Returns the indexes of the radios that receive the frame
+        """
+        return np.flatnonzero(self.receivers & ~self.corrupted)
+
+
+class RadioMedium:
+    """
+    Computes which radios receive each transmitted frame
+
+    Loss models, distances are in the units of the positions
+        unit_disk:    Links shorter than tx_range deliver prr of the frames,
+                      radios within interference_range hear collisions
+        log_distance: Received power is tx_power - ref_loss
+                      - 10 * exponent * log10(distance / ref_distance) dBm,
+                      the delivery ratio rises from 0 to 1 around
+                      sensitivity and radios receiving more than
+                      noise_floor hear collisions
+
+    :param clock: Function returning the current time in seconds
+    :param seed: Seed of the random link losses
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        model="unit_disk",
+        tx_range=30.0,
+        interference_range=None,
+        prr=1.0,
+        tx_power=0.0,
+        ref_loss=40.0,
+        ref_distance=1.0,
+        exponent=3.0,
+        sensitivity=-95.0,
+        noise_floor=-105.0,
+        clock=time.monotonic,
+        seed=None,
+    ):
+        if model not in ("unit_disk", "log_distance"):
+            raise ValueError(f"Unknown radio model {model}")
+        self.model = model
+        self.tx_range = tx_range
+        self.interference_range = (
+            interference_range if interference_range is not None else tx_range
+        )
+        self.prr = prr
+        self.tx_power = tx_power
+        self.ref_loss = ref_loss
+        self.ref_distance = ref_distance
+        self.exponent = exponent
+        self.sensitivity = sensitivity
+        self.noise_floor = noise_floor
+        self.clock = clock
+        self.rng = np.random.default_rng(seed)
+
+        self.names = []
+        self.index = {}
+        self.positions = np.zeros((0, 3))
+        self.channels = np.zeros(0, dtype=np.int16)
+        # Per radio counters
+        self.tx_frames = np.zeros(0, dtype=np.int64)
+        self.rx_frames = np.zeros(0, dtype=np.int64)
+        self.rx_lost = np.zeros(0, dtype=np.int64)
+        self.rx_collisions = np.zeros(0, dtype=np.int64)
+        # (src, dst): delivery ratio overriding the model
+        self.link_overrides = {}
+        self.loss_matrix = None
+        self._prr = None
+        self._interferes = None
+        # Transmissions on the air by channel, and by end time
+        self._on_air = {}
+        self._ending = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def _idx(self, node):
+        return self.index[node] if isinstance(node, str) else node
+
+    def add_node(self, name, position=(0.0, 0.0, 0.0), channel=DEFAULT_CHANNEL):
+        """
+        Adds a radio, returns its index
+        """
+        if name in self.index:
+            raise ValueError(f"Duplicate radio {name}")
+        position = list(position) + [0.0] * (3 - len(position))
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.positions = np.vstack([self.positions, position])
+        self.channels = np.append(self.channels, channel)
+        for counter in ("tx_frames", "rx_frames", "rx_lost", "rx_collisions"):
+            setattr(self, counter, np.append(getattr(self, counter), 0))
+        self._prr = None
+        return self.index[name]
+
+    def set_position(self, node, position):
+        """
+        Moves a radio
+        """
+        position = list(position) + [0.0] * (3 - len(position))
+        self.positions[self._idx(node)] = position
+        self._prr = None
+
+    def set_channel(self, node, channel):
+        """
+        Tunes a radio to channel
+        """
+        self.channels[self._idx(node)] = channel
+
+    def set_link(self, src, dst, prr):
+        """
+        Sets the delivery ratio from src to dst, overriding the model
+        """
+        self.link_overrides[(self._idx(src), self._idx(dst))] = prr
+        self._prr = None
+
+    def set_loss_matrix(self, matrix):
+        """
+        Sets the delivery ratio of every link instead of using the model,
+        radios hear collisions from the radios they have links from
+
+        :param matrix: N x N array, matrix[src][dst] is the ratio of the
+            frames from src dst receives
+        """
+        matrix = np.asarray(matrix, dtype=float)
+        if matrix.shape != (len(self), len(self)):
+            raise ValueError(f"Loss matrix must be {len(self)} x {len(self)}")
+        self.loss_matrix = matrix
+        self._prr = None
+
+    def _update_links(self):
+        if self.loss_matrix is not None:
+            prr = self.loss_matrix.copy()
+            interferes = prr > 0
+        else:
+            delta = self.positions[:, None, :] - self.positions[None, :, :]
+            distance = np.sqrt((delta**2).sum(axis=2))
+            if self.model == "unit_disk":
+                prr = np.where(distance <= self.tx_range, self.prr, 0.0)
+                interferes = distance <= self.interference_range
+            else:
+                distance = np.maximum(distance, self.ref_distance)
+                rx_power = (
+                    self.tx_power
+                    - self.ref_loss
+                    - 10.0 * self.exponent * np.log10(distance / self.ref_distance)
+                )
+                # About 2 dB from no frames to all frames
+                prr = 1.0 / (1.0 + np.exp(-(rx_power - self.sensitivity - 1.0) * 3.0))
+                prr[prr < 0.01] = 0.0
+                interferes = rx_power >= self.noise_floor
+        for (src, dst), link_prr in self.link_overrides.items():
+            prr[src, dst] = link_prr
+            interferes[src, dst] = interferes[src, dst] or link_prr > 0
+        np.fill_diagonal(prr, 0.0)
+        np.fill_diagonal(interferes, False)
+        self._prr = prr
+        self._interferes = interferes
+
+    def links(self):
+        """
+        Returns the N x N delivery ratio matrix
+        """
+        if self._prr is None:
+            self._update_links()
+        return self._prr
+
+    def transmit(self, src, frame, now=None):
+        """
+        Puts frame from radio src on the air on its channel
+
+        :returns: The Transmission
+        """
+        if self._prr is None:
+            self._update_links()
+        src = self._idx(src)
+        now = self.clock() if now is None else now
+        channel = int(self.channels[src])
+        on_air = [tx for tx in self._on_air.get(channel, ()) if tx.end > now]
+
+        in_range = (self._prr[src] > 0) & (self.channels == channel)
+        receivers = in_range & (self.rng.random(len(self)) < self._prr[src])
+        self.rx_lost += in_range & ~receivers
+        corrupted = np.zeros(len(self), dtype=bool)
+        heard = self._interferes[src]
+        for other in on_air:
+            # Everyone hearing both gets neither, and neither sender can
+            # receive the other's frame
+            other.corrupted |= heard
+            other.corrupted[src] = True
+            corrupted |= self._interferes[other.src]
+            corrupted[other.src] = True
+
+        tx = Transmission(
+            src, channel, now, now + airtime(len(frame)), frame, receivers, corrupted
+        )
+        on_air.append(tx)
+        self._on_air[channel] = on_air
+        self._sequence += 1
+        heapq.heappush(self._ending, (tx.end, self._sequence, tx))
+        self.tx_frames[src] += 1
+        return tx
+
+    def next_deadline(self):
+        """
+        Returns the time the next transmission ends, or None
+        """
+        return self._ending[0][0] if self._ending else None
+
+    def finished(self, now=None):
+        """
+        Returns the transmissions that ended by now, in end order
+        """
+        now = self.clock() if now is None else now
+        done = []
+        while self._ending and self._ending[0][0] <= now:
+            tx = heapq.heappop(self._ending)[2]
+            self.rx_frames[tx.delivered()] += 1
+            self.rx_collisions += tx.receivers & tx.corrupted
+            done.append(tx)
+        return done
+
+    def stats(self):
+        """
+        Returns the per radio counters as a table
+        """
+        names = ("channel", "tx_frames", "rx_frames", "rx_lost", "rx_collisions")
+        columns = [
+            self.channels,
+            self.tx_frames,
+            self.rx_frames,
+            self.rx_lost,
+            self.rx_collisions,
+        ]
+        lines = [f"{'radio':<12}" + "".join(f"{name:>14}" for name in names)]
+        for idx, name in enumerate(self.names):
+            lines.append(
+                f"{name:<12}" + "".join(f"{column[idx]:>14}" for column in columns)
+            )
+        return "\n".join(lines)
+
+
+class RadioPort:
+    """
+    ZMQ sockets to one emulator's IEEE802_15_4 model
+
+    :param rx_port: Port the emulator publishes on (its tx_port)
+    :param tx_port: Port the emulator receives on (its rx_port)
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        name,
+        rx_port=5556,
+        tx_port=5555,
+        transport="ipc",
+        host="127.0.0.1",
+        namespace=None,
+        context=None,
+    ):
+        self.name = name
+        self.prefix = topic_prefix(namespace)
+        context = context if context is not None else zmq.Context.instance()
+        self.rx_socket = context.socket(zmq.SUB)
+        self.rx_socket.connect(zmq_endpoint(transport, HAL2IO, rx_port, host))
+        self.rx_socket.setsockopt_string(zmq.SUBSCRIBE, self.prefix + TOPIC)
+        self.tx_socket = context.socket(zmq.PUB)
+        self.tx_socket.connect(zmq_endpoint(transport, IO2HAL, tx_port, host))
+
+    def fileno(self):
+        """
+        Returns the edge triggered fd of the receive socket
+        """
+        return self.rx_socket.getsockopt(zmq.FD)
+
+    def recv_batch(self, max_msgs):
+        """
+        Returns up to max_msgs (topic, decoded message) without waiting
+        """
+        msgs = []
+        try:
+            while len(msgs) < max_msgs:
+                topic, body = self.rx_socket.recv_string(zmq.NOBLOCK).split(" ", 1)
+                msgs.append((topic[len(self.prefix) :], yaml.safe_load(body)))
+        except zmq.Again:
+            pass
+        return msgs
+
+    def send(self, body):
+        """
+        Sends an encoded rx_frame message to the emulator
+        """
+        self.tx_socket.send_string(f"{self.prefix}{RX_TOPIC} {body}")
+
+    def close(self):
+        """
+        Closes the sockets
+        """
+        self.rx_socket.close(linger=0)
+        self.tx_socket.close(linger=100)
+
+
+class RadioMediumServer:
+    """
+    Runs a RadioMedium for emulators connected with RadioPorts
+
+    :param capture: hal_capture.PcapngWriter transmitted frames are
+        captured to, one pcapng interface per radio
+    """
+
+    # Max messages read from a port before reading the next one
+    BATCH = 64
+
+    def __init__(self, medium, capture=None):
+        self.medium = medium
+        self.capture = capture
+        self.ports = []
+        self.__stop = threading.Event()
+        self._thread = None
+
+    def add_node(self, port, position=(0.0, 0.0, 0.0), channel=DEFAULT_CHANNEL):
+        """
+        Adds the radio of the emulator on port, must be called before start
+        """
+        idx = self.medium.add_node(port.name, position, channel)
+        self.ports.append(port)
+        return idx
+
+    def handle_msg(self, idx, topic, msg):
+        """
+        Handles a message from radio idx
+        """
+        if "channel" in msg:
+            self.medium.set_channel(idx, msg["channel"])
+        if topic == TX_TOPIC and isinstance(msg.get("frame"), bytes):
+            self.medium.transmit(idx, msg["frame"])
+            if self.capture is not None:
+                self.capture.write(
+                    self.ports[idx].name,
+                    hal_capture.LINKTYPE_IEEE802_15_4_NOFCS,
+                    msg["frame"],
+                    hal_capture.OUTBOUND,
+                )
+
+    def deliver(self, now=None):
+        """
+        Sends the frames whose transmissions have ended to their receivers
+        """
+        for tx in self.medium.finished(now):
+            delivered = tx.delivered()
+            if not len(delivered):
+                continue
+            # Encoded once for all receivers
+            body = yaml.safe_dump({"id": self.ports[tx.src].name, "frame": tx.frame})
+            for dst in delivered:
+                self.ports[dst].send(body)
+
+    def run(self):
+        """
+        Runs the medium until shutdown
+        """
+        epoll = select.epoll()
+        for port in self.ports:
+            epoll.register(port.fileno(), select.EPOLLIN)
+        while not self.__stop.is_set():
+            # ZMQ's fds are edge triggered and only re-armed by receiving
+            # until zmq.Again, so every port is read until a round receives
+            # nothing before polling
+            received = True
+            while received:
+                received = False
+                for idx, port in enumerate(self.ports):
+                    for topic, msg in port.recv_batch(self.BATCH):
+                        received = True
+                        try:
+                            self.handle_msg(idx, topic, msg)
+                        except Exception:  # pylint: disable=broad-except
+                            log.exception("Error handling message from %s", port.name)
+            self.deliver()
+            deadline = self.medium.next_deadline()
+            timeout = 1.0
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - self.medium.clock(), 0.0))
+            epoll.poll(timeout)
+        epoll.close()
+        for port in self.ports:
+            port.close()
+        log.debug("Radio Medium Stopped")
+
+    def start(self):
+        """
+        Runs the medium in a new thread
+        """
+        self._thread = threading.Thread(target=self.run, name="RadioMedium")
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stops the medium
+        """
+        self.__stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main():
+    """
+    Runs the radio medium described by a topology file until interrupted
+    """
+    parser = ArgumentParser()
+    parser.add_argument("topology", help="YAML file of the model, radios and links")
+    parser.add_argument("--transport", default="ipc", choices=TRANSPORTS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--broker",
+        action="store_true",
+        help="Radios are namespaces on a broker, using the first ports",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Random loss seed")
+    parser.add_argument(
+        "-w", "--pcap", default=None, help="Capture transmitted frames to this file"
+    )
+    args = parser.parse_args()
+
+    with open(args.topology, "r") as infile:
+        topology = yaml.safe_load(infile)
+    model = dict(topology.get("model") or {})
+    model["model"] = model.pop("type", "unit_disk")
+
+    hal_log.setLogConfig()
+    capture = None
+    if args.pcap is not None:
+        capture = hal_capture.PcapngWriter(args.pcap)
+    server = RadioMediumServer(RadioMedium(seed=args.seed, **model), capture)
+    for node in topology["nodes"]:
+        namespace = node.get("namespace")
+        if namespace is None and args.broker:
+            namespace = node["name"]
+        port = RadioPort(
+            node["name"],
+            node.get("rx_port", 5556),
+            node.get("tx_port", 5555),
+            args.transport,
+            args.host,
+            namespace,
+        )
+        server.add_node(
+            port, node.get("position", (0.0, 0.0)), node.get("channel", DEFAULT_CHANNEL)
+        )
+    if topology.get("loss") is not None:
+        server.medium.set_loss_matrix(topology["loss"])
+    for link in topology.get("links") or ():
+        server.medium.set_link(link["src"], link["dst"], link["prr"])
+
+    server.start()
+    try:
+        while True:
+            time.sleep(10)
+            log.info("Radio stats\n%s", server.medium.stats())
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    if capture is not None:
+        capture.close()
+    print(server.medium.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ import sys
 
 import serial  # pylint: disable=import-error
 
-from halucinator.external_devices.ioserver import IOServer
+from halucinator.external_devices.async_ioserver import AsyncIOServer
 
 
 log = logging.getLogger(__name__)
@@ -72,7 +72,8 @@ if __name__ == "__main__":
 
     hal_log.setLogConfig()
 
-    io_server = IOServer(args.rx_port, args.tx_port)
+    # Bytes read from the port within 1 ms are sent as one message
+    io_server = AsyncIOServer(args.rx_port, args.tx_port, coalesce_delay=0.001)
     serial = SerialTunnel(args.port, io_server, args.baud, args.use_file)
 
     io_server.start()
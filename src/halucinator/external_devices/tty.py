@@ -13,7 +13,6 @@ import os
 import socket
 import time
 import binascii
-import scapy.all as scapy
 import serial
 log = logging.getLogger(__name__)
 
@@ -2,18 +2,16 @@
 # (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S. 
 # Government retains certain rights in this software.
 
-import IPython
-import threading
-import zmq
-from ..peripheral_models.peripheral_server import encode_zmq_msg, decode_zmq_msg
-from .ioserver import IOServer
+from .async_ioserver import AsyncIOServer
+from ..util.lazy_import import lazy_import
 import logging
+IPython = lazy_import("IPython")
 
-log = logging.getLogger(__main__)
+log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
-class VN8200XP(Thread):
+class VN8200XP(object):
     def __init__(self, ioserver):
         self.ioserver = ioserver
         ioserver.register_topic(
@@ -44,8 +42,8 @@ def main():
     import halucinator.hal_log as hal_log
     hal_log.setLogConfig()
 
-    io_server = IOServer(args.rx_port, args.tx_port)
-    uart = UARTPrintServer(io_server)
+    io_server = AsyncIOServer(args.rx_port, args.tx_port)
+    uart = VN8200XP(io_server)
 
     io_server.start()
 
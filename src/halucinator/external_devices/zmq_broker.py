@@ -0,0 +1,174 @@
+"""
+ZMQ broker that lets many HALucinator instances and external devices, on
+any hosts, share topics
+"""
+
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+#
+# The broker binds the endpoints a HALucinator instance normally binds, so
+# devices connect to it unchanged.  Emulators connect to it with the config
+# options
+#     options:
+#       peripheral_server:
+#         transport: tcp
+#         host: <broker host>
+#         broker: true
+#         namespace: board1
+# and devices for that emulator with
+#     --transport tcp --host <broker host> --namespace board1
+
+from argparse import ArgumentParser
+import logging
+import threading
+
+import zmq
+
+from halucinator.peripheral_models.peripheral_server import (
+    zmq_endpoint,
+    HAL2IO,
+    IO2HAL,
+    TRANSPORTS,
+)
+from halucinator import hal_log
+
+log = logging.getLogger(__name__)
+
+
+class ZMQBroker:
+    """
+    Forwards messages from all publishers to all subscribers with an
+    XSUB/XPUB proxy
+
+    :param rx_port: Port publishers connect to (the emulator's rx_port)
+    :param tx_port: Port subscribers connect to (the emulator's tx_port)
+    :param host: Address to bind for tcp, * for all interfaces
+    :param verbose: Log the topic of each forwarded message
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, rx_port=5555, tx_port=5556, transport="ipc", host="*", verbose=False
+    ):
+        self.transport = transport
+        # inproc endpoints are only reachable from the same context
+        if transport == "inproc":
+            self.context = zmq.Context.instance()
+        else:
+            self.context = zmq.Context()
+        self.control_addr = f"inproc://halucinator-broker-control-{id(self)}"
+        self.xsub_addr = zmq_endpoint(transport, IO2HAL, rx_port, host)
+        self.xpub_addr = zmq_endpoint(transport, HAL2IO, tx_port, host)
+        self.verbose = verbose
+        self.thread = None
+
+    def run(self):
+        """
+        Forwards messages until shutdown
+        """
+        control = self.context.socket(zmq.PAIR)
+        control.bind(self.control_addr)
+        xsub = self.context.socket(zmq.XSUB)
+        xsub.bind(self.xsub_addr)
+        xpub = self.context.socket(zmq.XPUB)
+        xpub.bind(self.xpub_addr)
+        log.info(
+            "Broker publishers: %s subscribers: %s", self.xsub_addr, self.xpub_addr
+        )
+
+        capture = None
+        if self.verbose:
+            capture = self.context.socket(zmq.PAIR)
+            capture.bind(f"inproc://halucinator-broker-capture-{id(self)}")
+            monitor = self.context.socket(zmq.PAIR)
+            monitor.connect(f"inproc://halucinator-broker-capture-{id(self)}")
+            threading.Thread(
+                target=self._log_messages, args=(monitor,), daemon=True
+            ).start()
+        try:
+            zmq.proxy_steerable(xsub, xpub, capture, control)
+        finally:
+            for sock in (xsub, xpub, capture, control):
+                if sock is not None:
+                    sock.close(linger=0)
+        log.info("Broker Stopped")
+
+    @staticmethod
+    def _log_messages(monitor):
+        while True:
+            try:
+                frame = monitor.recv()
+            except zmq.ZMQError:
+                monitor.close(linger=0)
+                return
+            # Subscriptions are forwarded as \x01<topic> or \x00<topic>
+            if frame[:1] in (b"\x00", b"\x01"):
+                action = "Subscribe" if frame[:1] == b"\x01" else "Unsubscribe"
+                log.info("%s: %s", action, frame[1:].decode("utf-8", "replace"))
+            else:
+                log.info("Forward: %s", frame.split(b" ", 1)[0].decode("utf-8"))
+
+    def start(self):
+        """
+        Runs the broker in a new thread
+        """
+        self.thread = threading.Thread(target=self.run, name="ZMQBroker", daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        """
+        Stops a broker started with start
+        """
+        control = self.context.socket(zmq.PAIR)
+        control.connect(self.control_addr)
+        control.send(b"TERMINATE")
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        # Closing before the proxy has read the command would drop it
+        control.close()
+        if self.transport != "inproc":
+            self.context.term()
+
+
+def main():
+    """
+    Runs the broker until interrupted
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-r",
+        "--rx_port",
+        default=5555,
+        type=int,
+        help="Port publishers (devices and emulators) connect to",
+    )
+    parser.add_argument(
+        "-t",
+        "--tx_port",
+        default=5556,
+        type=int,
+        help="Port subscribers (devices and emulators) connect to",
+    )
+    parser.add_argument("--transport", default="tcp", choices=TRANSPORTS)
+    parser.add_argument(
+        "--host", default="*", help="Address to bind for tcp, default all interfaces"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Log forwarded topics"
+    )
+    args = parser.parse_args()
+
+    hal_log.setLogConfig()
+    broker = ZMQBroker(
+        args.rx_port, args.tx_port, args.transport, args.host, args.verbose
+    )
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Capture of emulated network traffic to pcapng files
+
+The network peripheral models write the frames the firmware sends and
+receives to the global capture, which is off unless configured
+    hal_capture.capture("eth:1", hal_capture.LINKTYPE_ETHERNET, frame,
+                        hal_capture.INBOUND)
+
+Each interface name gets its own pcapng interface with its link type, and
+packets have nanosecond timestamps.  When a guest clock is registered with
+set_guest_clock the guest time of each packet is added as a comment.
+
+Frames are queued and written by a background thread through a buffered
+file, so capturing only costs the emulation a queue append.  If the writer
+falls behind by max_queue frames, frames are dropped and counted.
+
+Capture is set with the `capture` entry of the config file `options` (or
+halucinator --pcap)
+    options:
+      capture:
+        file: capture.pcapng  # relative to the output directory
+        max_size: 100M        # start a new file after this many bytes ...
+        max_files: 10         # ... keeping only the newest max_files
+
+The hub forwarders (hal_dev_virt_hub, hal_dev_eth_switch, ...) take --pcap
+to capture what they forward, with a PcapngWriter of their own.
+"""
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_IEEE802_15_4_WITHFCS = 195
+LINKTYPE_IEEE802_15_4_NOFCS = 230
+
+# Direction of a packet relative to the interface (the firmware)
+INBOUND = 1
+OUTBOUND = 2
+
+_SHB_TYPE = 0x0A0D0D0A
+_IDB_TYPE = 0x00000001
+_EPB_TYPE = 0x00000006
+_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+_OPT_COMMENT = 1
+_SHB_USERAPPL = 4
+_IF_NAME = 2
+_IF_TSRESOL = 9
+_EPB_FLAGS = 2
+
+_SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def _option(code, value):
+    padding = -len(value) % 4
+    return struct.pack("<HH", code, len(value)) + value + b"\x00" * padding
+
+
+def _block(block_type, body, options=()):
+    if options:
+        body += b"".join(options) + b"\x00\x00\x00\x00"
+    length = len(body) + 12
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def section_header(application="HALucinator"):
+    """
+    Returns a pcapng Section Header Block
+    """
+    body = struct.pack("<IHHq", _BYTE_ORDER_MAGIC, 1, 0, -1)
+    return _block(
+        _SHB_TYPE, body, [_option(_SHB_USERAPPL, application.encode("utf-8"))]
+    )
+
+
+def interface_description(name, linktype, snaplen=0):
+    """
+    Returns a pcapng Interface Description Block with nanosecond timestamps
+    """
+    body = struct.pack("<HHI", linktype, 0, snaplen)
+    return _block(
+        _IDB_TYPE,
+        body,
+        [_option(_IF_NAME, name.encode("utf-8")), _option(_IF_TSRESOL, b"\x09")],
+    )
+
+
+def enhanced_packet(interface, timestamp_ns, frame, direction=None, comment=None):
+    """
+    Returns a pcapng Enhanced Packet Block
+
+    :param interface: Index of the interface's description block
+    :param timestamp_ns: Time since the epoch in nanoseconds
+    :param direction: INBOUND, OUTBOUND or None if unknown
+    """
+    length = len(frame)
+    body = (
+        struct.pack(
+            "<IIIII",
+            interface,
+            timestamp_ns >> 32,
+            timestamp_ns & 0xFFFFFFFF,
+            length,
+            length,
+        )
+        + bytes(frame)
+        + b"\x00" * (-length % 4)
+    )
+    options = []
+    if comment:
+        options.append(_option(_OPT_COMMENT, comment.encode("utf-8")))
+    if direction:
+        options.append(_option(_EPB_FLAGS, struct.pack("<I", direction)))
+    return _block(_EPB_TYPE, body, options)
+
+
+def parse_size(size):
+    """
+    Returns size in bytes of an int or a string like 100M
+    """
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in _SIZE_UNITS:
+        return int(float(size[:-1]) * _SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+class PcapngWriter:
+    """
+    Writes packets to pcapng files from a background thread
+
+    :param filename: File to write, when rotating later files are named
+        <root>.<n><ext>
+    :param max_size: Bytes written to a file before starting the next one,
+        None to never rotate
+    :param max_files: Number of files kept when rotating, None keeps all
+    :param max_queue: Packets waiting to be written before new ones are
+        dropped
+    :param buffer_size: Size of the file write buffer
+    :param flush_interval: Seconds between flushes of the file while packets
+        are being written
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        filename,
+        max_size=None,
+        max_files=None,
+        max_queue=65536,
+        buffer_size=1 << 20,
+        flush_interval=1.0,
+    ):
+        self.filename = filename
+        self.max_size = parse_size(max_size)
+        self.max_files = max_files
+        self.max_queue = max_queue
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.guest_clock = None
+        self.packets = 0
+        self.dropped = 0
+        self.files = []
+        # deque append and popleft are thread safe, no lock on the fast path
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._stop = False
+        # (name, linktype): index, only used by the writer thread
+        self._interfaces = {}
+        self._file = None
+        self._size = 0
+        self._thread = threading.Thread(
+            target=self._run, name="halucinator-pcapng", daemon=True
+        )
+        self._open()
+        self._thread.start()
+
+    def write(self, name, linktype, frame, direction=None, comment=None):
+        """
+        Queues frame seen on interface name for writing, never blocks
+
+        :returns: False if the frame was dropped
+        """
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return False
+        if comment is None and self.guest_clock is not None:
+            guest_ns = self.guest_clock()
+            if guest_ns is not None:
+                comment = f"guest_time_ns={guest_ns}"
+        self._queue.append(
+            (name, linktype, time.time_ns(), bytes(frame), direction, comment)
+        )
+        return True
+
+    def _next_filename(self):
+        if not self.files:
+            return self.filename
+        root, ext = os.path.splitext(self.filename)
+        return f"{root}.{len(self.files)}{ext}"
+
+    def _open(self):
+        filename = self._next_filename()
+        # pylint: disable=consider-using-with
+        self._file = open(filename, "wb", buffering=self.buffer_size)
+        self.files.append(filename)
+        self._size = 0
+        self._write(section_header())
+        # Interface indexes are per section, describe them again in order
+        for name, linktype in self._interfaces:
+            self._write(interface_description(name, linktype))
+        if self.max_files and len(self.files) > self.max_files:
+            old = self.files[-self.max_files - 1]
+            if old != filename and os.path.exists(old):
+                os.remove(old)
+        log.info("Capturing to %s", filename)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._size += len(data)
+
+    def _write_packet(self, name, linktype, timestamp_ns, frame, direction, comment):
+        if self.max_size and self._size >= self.max_size:
+            self._file.close()
+            self._open()
+        key = (name, linktype)
+        interface = self._interfaces.get(key)
+        if interface is None:
+            interface = self._interfaces[key] = len(self._interfaces)
+            self._write(interface_description(name, linktype))
+        self._write(enhanced_packet(interface, timestamp_ns, frame, direction, comment))
+        self.packets += 1
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            stopping = self._stop
+            while self._queue:
+                self._write_packet(*self._queue.popleft())
+                if time.monotonic() - last_flush > self.flush_interval:
+                    self._file.flush()
+                    last_flush = time.monotonic()
+            self._file.flush()
+            last_flush = time.monotonic()
+            if stopping:
+                break
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+        self._file.close()
+
+    def close(self):
+        """
+        Writes the queued packets and closes the file
+        """
+        if self._stop:
+            return
+        self._stop = True
+        self._wakeup.set()
+        self._thread.join()
+        if self.dropped:
+            log.warning("Capture dropped %i packets", self.dropped)
+
+
+_CAPTURE = None
+_GUEST_CLOCK = None
+
+
+def get_capture():
+    """
+    Returns the global PcapngWriter or None if capture is off
+    """
+    return _CAPTURE
+
+
+def capture(name, linktype, frame, direction=None):
+    """
+    Writes frame seen on interface name to the global capture, if on
+    """
+    writer = _CAPTURE
+    if writer is not None:
+        writer.write(name, linktype, frame, direction)
+
+
+def set_guest_clock(clock):
+    """
+    Sets the function returning the current guest time in nanoseconds (or
+    None) that is added to captured packets
+    """
+    global _GUEST_CLOCK  # pylint: disable=global-statement
+    _GUEST_CLOCK = clock
+    if _CAPTURE is not None:
+        _CAPTURE.guest_clock = clock
+
+
+def start(filename, **kwargs):
+    """
+    Starts the global capture to filename, kwargs are those of PcapngWriter
+    """
+    global _CAPTURE  # pylint: disable=global-statement
+    stop()
+    _CAPTURE = PcapngWriter(filename, **kwargs)
+    _CAPTURE.guest_clock = _GUEST_CLOCK
+    return _CAPTURE
+
+
+def configure(options, output_directory=None, filename=None):
+    """
+    Starts the global capture as set by the `capture` config option dict
+
+    :param output_directory: Directory for relative file names
+    :param filename: Capture file, overrides options
+    """
+    options = dict(options or {})
+    if filename is not None:
+        options["file"] = filename
+    filename = options.pop("file", None)
+    if not filename:
+        return None
+    if output_directory is not None and not os.path.isabs(filename):
+        filename = os.path.join(output_directory, filename)
+    return start(filename, **options)
+
+
+def stop():
+    """
+    Stops the global capture, writing all queued packets
+    """
+    global _CAPTURE  # pylint: disable=global-statement
+    writer, _CAPTURE = _CAPTURE, None
+    if writer is not None:
+        writer.close()
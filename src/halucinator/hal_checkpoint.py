@@ -0,0 +1,526 @@
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Periodic checkpoints of the emulated firmware that a run can resume from
+
+A checkpoint holds the writable memories, the registers, the state of the
+peripheral models and the guest time.  The first checkpoint of a chain is a
+base holding every page, the following ones are incremental and hold only
+the pages whose hash changed since the previous checkpoint
+    tmp/<name>/checkpoints/ckpt-000000.base
+    tmp/<name>/checkpoints/ckpt-000001.incr     # parent ckpt-000000.base
+    tmp/<name>/checkpoints/ckpt-000002.incr     # parent ckpt-000001.incr
+
+Checkpoints are taken at an intercept, before its handler runs, while the
+guest is stopped.  Only reading the memories and hashing their pages pauses
+the guest, a background thread compresses and writes the checkpoint.  A
+checkpoint due while handlers wait on firmware calls is taken at the first
+intercept after they return.
+
+A run resumes from a checkpoint file, or the newest one in a directory, with
+    halucinator -c ... --resume-from tmp/<name>/checkpoints
+which restores the chain from its base up.  The guest continues from the
+intercept the checkpoint was taken at, and its handler runs again.
+
+Checkpointing is set with the `checkpoint` entry of the config file
+`options` (or halucinator --checkpoint-interval)
+    options:
+      checkpoint:
+        interval: 300           # host seconds between checkpoints
+        directory: checkpoints  # relative to the output directory
+        full_every: 50          # incrementals before starting a new chain
+        keep_chains: 2          # chains kept on disk, None keeps all
+        page_size: 4096
+        compression: zlib       # zlib, lzma or none
+
+Peripheral models are saved by pickling their class attributes, once the
+messages queued for them have been handled.  Attributes that can't be
+pickled (threads, locks, sockets) are skipped with a warning.  A model with
+such state defines the classmethods get_checkpoint_state, returning a
+picklable object, and set_checkpoint_state.
+
+QEMU's device state isn't saved, e.g. the NVIC's enabled and pending
+interrupts and the SysTick counter.  A resumed guest starts with them reset,
+so firmware relying on an interrupt enabled before the checkpoint has to
+enable it again (or be checkpointed before enabling it).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import lzma
+import os
+import pickle
+import tempfile
+import threading
+import time
+import zlib
+
+from halucinator import hal_clock
+from halucinator import hal_metrics
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"HALCKPT1"
+BASE = "base"
+INCREMENTAL = "incr"
+# Host seconds to wait for the models' queued messages before checkpointing
+MODEL_IDLE_TIMEOUT = 5.0
+
+# name: (id in the file header, compress, decompress)
+COMPRESSION = {
+    "none": (0, bytes, bytes),
+    "zlib": (1, lambda data: zlib.compress(data, 1), zlib.decompress),
+    "lzma": (2, lambda data: lzma.compress(data, preset=0), lzma.decompress),
+}
+
+CHECKPOINT_PAUSE = hal_metrics.histogram(
+    "halucinator_checkpoint_pause_seconds",
+    "Time the guest is stopped to take a checkpoint",
+    ["kind"],
+)
+CHECKPOINT_BYTES = hal_metrics.counter(
+    "halucinator_checkpoint_bytes_total",
+    "Compressed bytes of checkpoints written",
+    ["kind"],
+)
+
+
+def write_checkpoint(filename, checkpoint, compression="zlib"):
+    """
+    Writes the checkpoint dict to filename
+
+    :returns: Number of bytes written
+    """
+    comp_id, compress, _ = COMPRESSION[compression]
+    data = MAGIC + bytes([comp_id]) + compress(pickle.dumps(checkpoint, protocol=4))
+    # Written then renamed, so a crash never leaves a partial checkpoint
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "wb") as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_name, filename)
+    return len(data)
+
+
+def read_checkpoint(filename):
+    """
+    Returns the checkpoint dict written to filename
+    """
+    with open(filename, "rb") as infile:
+        data = infile.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{filename} is not a HALucinator checkpoint")
+    for comp_id, _, decompress in COMPRESSION.values():
+        if comp_id == data[len(MAGIC)]:
+            return pickle.loads(decompress(data[len(MAGIC) + 1 :]))
+    raise ValueError(f"Unknown compression in checkpoint {filename}")
+
+
+def latest_checkpoint(directory):
+    """
+    Returns the newest checkpoint file in directory, None if there are none
+    """
+    names = sorted(
+        name
+        for name in os.listdir(directory)
+        if name.startswith("ckpt-") and name.endswith((BASE, INCREMENTAL))
+    )
+    return os.path.join(directory, names[-1]) if names else None
+
+
+def load_chain(path):
+    """
+    Reads the checkpoint at path (or the newest in the directory path) and
+    its parents, and returns the state they restore
+
+    :returns: (files, memories, checkpoint) with files the chain's files from
+        the base, memories a dict of base address: bytearray, and checkpoint
+        the dict of the newest checkpoint
+    """
+    if os.path.isdir(path):
+        filename = latest_checkpoint(path)
+        if filename is None:
+            raise ValueError(f"No checkpoints in {path}")
+    else:
+        filename = path
+    chain = []
+    files = []
+    parent = filename
+    while parent is not None:
+        checkpoint = read_checkpoint(parent)
+        chain.append(checkpoint)
+        files.insert(0, parent)
+        parent = checkpoint["parent"]
+        if parent is not None:
+            parent = os.path.join(os.path.dirname(filename), parent)
+    if chain[-1]["kind"] != BASE:
+        raise ValueError(f"Checkpoint chain of {filename} has no base")
+
+    memories = {}
+    for checkpoint in reversed(chain):
+        page_size = checkpoint["page_size"]
+        if checkpoint["kind"] == BASE:
+            memories = {
+                base: bytearray(image) for base, image in checkpoint["memories"].items()
+            }
+            continue
+        for base, pages in checkpoint["pages"].items():
+            image = memories[base]
+            for page, data in pages.items():
+                image[page * page_size : page * page_size + len(data)] = data
+    return files, memories, chain[0]
+
+
+def get_model_state(cls):
+    """
+    Returns dict of the pickled state of the peripheral model cls
+    """
+    if hasattr(cls, "get_checkpoint_state"):
+        return {None: pickle.dumps(cls.get_checkpoint_state(), protocol=4)}
+    state = {}
+    for name, value in vars(cls).items():
+        if name.startswith("__") or isinstance(
+            value, (classmethod, staticmethod, property, type)
+        ):
+            continue
+        if callable(value):
+            continue
+        try:
+            state[name] = pickle.dumps(value, protocol=4)
+        except Exception as error:  # pylint: disable=broad-except
+            log.warning("Not saving %s.%s: %s", cls.__name__, name, error)
+    return state
+
+
+def set_model_state(cls, state):
+    """
+    Restores the peripheral model cls from get_model_state's dict
+    """
+    if None in state:
+        cls.set_checkpoint_state(pickle.loads(state[None]))
+        return
+    for name, data in state.items():
+        setattr(cls, name, pickle.loads(data))
+
+
+class Checkpointer:
+    """
+    Takes the periodic checkpoints of a target
+
+    :param target: Avatar QEMU target
+    :param memories: List of (name, base address, size) of the memories saved
+    :param directory: Directory checkpoints are written to
+    :param interval: Host seconds between checkpoints
+    :param full_every: Incremental checkpoints before a new base
+    :param keep_chains: Chains kept, older ones are deleted, None keeps all
+    :param page_size: Bytes per page compared between checkpoints
+    :param compression: zlib, lzma or none
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        target,
+        memories,
+        directory,
+        interval=300.0,
+        full_every=50,
+        keep_chains=None,
+        page_size=4096,
+        compression="zlib",
+    ):
+        if compression not in COMPRESSION:
+            raise ValueError(
+                f"Unknown checkpoint compression {compression}, "
+                f"expected {list(COMPRESSION)}"
+            )
+        self.target = target
+        self.memories = memories
+        self.directory = directory
+        self.interval = interval
+        self.full_every = full_every
+        self.keep_chains = keep_chains
+        self.page_size = page_size
+        self.compression = compression
+        self.index = 0
+        self.parent = None
+        # Files of each chain, oldest first
+        self.chains = []
+        self._lock = threading.Lock()
+        # base address: list of page hashes at the last checkpoint
+        self._hashes = {}
+        self._last = time.monotonic()
+        self._scratch = None
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="halucinator-checkpoint"
+        )
+        os.makedirs(directory, exist_ok=True)
+
+    def _read_memory(self, base, size):
+        # QEMU dumps memory to a file much faster than GDB reads it
+        monitor = getattr(self.target.protocols, "monitor", None)
+        if monitor is None:
+            return self.target.read_memory(base, 1, size, raw=True)
+        if self._scratch is None:
+            scratch_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            handle, self._scratch = tempfile.mkstemp(
+                prefix="halucinator-ckpt-", dir=scratch_dir
+            )
+            os.close(handle)
+        # pylint: disable=import-outside-toplevel
+        from halucinator.peripheral_models import peripheral_server
+
+        with peripheral_server.__QMP_LOCK__:
+            monitor.execute_command(
+                "pmemsave", {"val": base, "size": size, "filename": self._scratch}
+            )
+        with open(self._scratch, "rb") as infile:
+            return infile.read()
+
+    def _hash_pages(self, image):
+        page_size = self.page_size
+        return [
+            hashlib.blake2b(image[offset : offset + page_size], digest_size=16).digest()
+            for offset in range(0, len(image), page_size)
+        ]
+
+    def _registers(self):
+        registers = {}
+        for reg in self.target.avatar.arch.registers:
+            try:
+                registers[reg] = self.target.read_register(reg)
+            except Exception:  # pylint: disable=broad-except
+                log.debug("Not saving register %s", reg)
+        return registers
+
+    def _models(self):
+        # pylint: disable=import-outside-toplevel
+        from halucinator.peripheral_models import peripheral_server
+
+        # Handlers change the models' state, so it's only consistent once
+        # the messages received before the checkpoint are handled
+        if not peripheral_server.wait_idle(timeout=MODEL_IDLE_TIMEOUT):
+            log.warning("Peripheral models still busy, checkpointing anyway")
+        return {
+            name: get_model_state(cls)
+            for name, cls in list(peripheral_server.__MODELS__.items())
+        }
+
+    def due(self):
+        """
+        True when the next checkpoint should be taken
+        """
+        return time.monotonic() - self._last >= self.interval
+
+    def checkpoint(self):
+        """
+        Takes a checkpoint of the stopped target, and queues it for writing
+
+        :returns: Filename the checkpoint is written to
+        """
+        start = time.perf_counter()
+        incremental = self.parent is not None and (
+            self.full_every is None or len(self.chains[-1]) <= self.full_every
+        )
+        kind = INCREMENTAL if incremental else BASE
+        checkpoint = {
+            "kind": kind,
+            "index": self.index,
+            "parent": self.parent if incremental else None,
+            "page_size": self.page_size,
+            "time": time.time(),
+            "guest_ns": hal_clock.now_ns(),
+            "registers": self._registers(),
+            "models": self._models(),
+        }
+        images = {}
+        pages = {}
+        for name, base, size in self.memories:
+            image = self._read_memory(base, size)
+            hashes = self._hash_pages(image)
+            if incremental:
+                # Every page of a memory without hashes is dirty
+                old_hashes = self._hashes.get(base) or [None] * len(hashes)
+                page_size = self.page_size
+                pages[base] = {
+                    page: image[page * page_size : (page + 1) * page_size]
+                    for page, digest in enumerate(hashes)
+                    if digest != old_hashes[page]
+                }
+            else:
+                images[base] = image
+            self._hashes[base] = hashes
+            log.debug("Checkpointed memory %s", name)
+        if incremental:
+            checkpoint["pages"] = pages
+        else:
+            checkpoint["memories"] = images
+        pause = time.perf_counter() - start
+        CHECKPOINT_PAUSE.observe(pause, kind=kind)
+
+        name = f"ckpt-{self.index:06d}.{kind}"
+        filename = os.path.join(self.directory, name)
+        with self._lock:
+            if incremental:
+                self.chains[-1].append(filename)
+            else:
+                self.chains.append([filename])
+        self.parent = name
+        self.index += 1
+        self._last = time.monotonic()
+        self._writer.submit(self._write, filename, checkpoint)
+        log.info(
+            "Checkpoint %s, paused %.1f ms, %i dirty pages",
+            name,
+            pause * 1000,
+            sum(len(dirty) for dirty in pages.values()),
+        )
+        return filename
+
+    def _write(self, filename, checkpoint):
+        try:
+            size = write_checkpoint(filename, checkpoint, self.compression)
+            CHECKPOINT_BYTES.inc(size, kind=checkpoint["kind"])
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Error writing checkpoint %s", filename)
+            return
+        if checkpoint["kind"] == BASE and self.keep_chains:
+            # The new base is on disk, the chains keep_chains before it
+            # aren't needed.  Later chains may already be queued.
+            with self._lock:
+                current = [chain[0] for chain in self.chains].index(filename)
+                old_chains = self.chains[: max(current + 1 - self.keep_chains, 0)]
+                del self.chains[: len(old_chains)]
+            for old in (name for chain in old_chains for name in chain):
+                if os.path.exists(old):
+                    os.remove(old)
+
+    def resume(self, files, memories, index):
+        """
+        Continues after the resumed checkpoint index, whose chain is files.
+        Chains in the checkpoint directory are extended with incremental
+        checkpoints, elsewhere a new chain is started
+        """
+        self.index = max(self.index, index + 1)
+        if not os.path.samefile(os.path.dirname(files[-1]) or ".", self.directory):
+            return
+        with self._lock:
+            self.chains.append(list(files))
+        self.parent = os.path.basename(files[-1])
+        for _, base, _ in self.memories:
+            if base in memories:
+                self._hashes[base] = self._hash_pages(bytes(memories[base]))
+
+    def close(self):
+        """
+        Waits for queued checkpoints to be written
+        """
+        self._writer.shutdown(wait=True)
+        if self._scratch is not None and os.path.exists(self._scratch):
+            os.remove(self._scratch)
+
+
+_CHECKPOINTER = None
+
+
+def get_checkpointer():
+    """
+    Returns the global Checkpointer or None if checkpointing is off
+    """
+    return _CHECKPOINTER
+
+
+def poll(target):
+    """
+    Takes a checkpoint of the stopped target if one is due, called by the
+    interceptor before the handler runs
+    """
+    checkpointer = _CHECKPOINTER
+    if checkpointer is not None and checkpointer.target is target:
+        # The handlers waiting on firmware calls (qemu_targets.firmware_rpc)
+        # can't be saved, so checkpoints wait until the calls have returned
+        rpc = getattr(target, "rpc", None)
+        if rpc is not None and rpc.pending:
+            return
+        if checkpointer.due():
+            checkpointer.checkpoint()
+
+
+def saved_memories(memories):
+    """
+    Returns (name, base address, size) of the writable, not emulated,
+    memories of the config's memories dict
+    """
+    return [
+        (memory.name, memory.base_addr, memory.size)
+        for memory in memories.values()
+        if "w" in memory.permissions and memory.emulate is None
+    ]
+
+
+def configure(options, target, memories, output_directory=None, interval=None):
+    """
+    Starts checkpointing as set by the `checkpoint` config option dict
+
+    :param memories: The config's memories dict
+    :param interval: Host seconds between checkpoints, overrides options
+    """
+    global _CHECKPOINTER  # pylint: disable=global-statement
+    options = dict(options or {})
+    if interval is not None:
+        options["interval"] = interval
+    if options.get("interval") is None:
+        return None
+    directory = options.pop("directory", "checkpoints")
+    if output_directory is not None and not os.path.isabs(directory):
+        directory = os.path.join(output_directory, directory)
+    stop()
+    _CHECKPOINTER = Checkpointer(target, saved_memories(memories), directory, **options)
+    log.info("Checkpointing every %s s to %s", options["interval"], directory)
+    return _CHECKPOINTER
+
+
+def restore(target, path):
+    """
+    Restores the target and peripheral models from the checkpoint chain at
+    path, must be done before the target first runs
+    """
+    # pylint: disable=import-outside-toplevel
+    from halucinator.peripheral_models import peripheral_server
+
+    files, memories, checkpoint = load_chain(path)
+    for base, image in memories.items():
+        target.write_memory(base, 1, bytes(image), len(image), raw=True)
+    for reg, value in checkpoint["registers"].items():
+        try:
+            target.write_register(reg, value)
+        except Exception:  # pylint: disable=broad-except
+            log.debug("Not restoring register %s", reg)
+    for name, state in checkpoint["models"].items():
+        cls = peripheral_server.__MODELS__.get(name)
+        if cls is None:
+            log.warning("Checkpoint has state of unknown model %s", name)
+            continue
+        set_model_state(cls, state)
+    hal_clock.get_clock().restore(checkpoint["guest_ns"])
+    if _CHECKPOINTER is not None:
+        _CHECKPOINTER.resume(files, memories, checkpoint["index"])
+    log.info(
+        "Resumed from %s at %.6f guest seconds",
+        files[-1],
+        checkpoint["guest_ns"] / hal_clock.NS_PER_SECOND,
+    )
+    return checkpoint
+
+
+def stop():
+    """
+    Stops checkpointing, writing the queued checkpoints
+    """
+    global _CHECKPOINTER  # pylint: disable=global-statement
+    checkpointer, _CHECKPOINTER = _CHECKPOINTER, None
+    if checkpointer is not None:
+        checkpointer.close()
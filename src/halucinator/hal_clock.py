@@ -0,0 +1,407 @@
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Guest clock shared by the handlers and models that keep time
+
+Handlers read the guest time and wait on it through this module instead of
+the time module, so one configured source sets the firmware's time
+    elapsed = hal_clock.now()            # guest seconds since start
+    hal_clock.wait(stop_event, rate)     # timer thread waits guest seconds
+    hal_clock.sleep(seconds)             # the firmware blocks for seconds
+    hal_clock.advance(seconds)           # a skipped firmware delay
+    hal_clock.idle()                     # the firmware is waiting (WFI)
+
+Sources
+    wall:    Host time, the default, firmware time depends on host load
+    scaled:  Host time multiplied by scale, 0.1 runs guest time ten times
+             slower than the host's
+    virtual: Deterministic time advanced by ns_per_intercept for every
+             intercepted call, and by the firmware delays handlers skip.
+             An Idle intercept on the firmware's idle loop or WFI wrapper
+             jumps time to the next timer deadline, so idle firmware runs
+             faster than real time.  idle_skip also treats the guest as
+             idle when no intercept has run for idle_timeout host seconds,
+             this depends on host load so runs are no longer
+             deterministic, and it is off by default.  With icount set,
+             QEMU runs with -icount shift=<icount> so QEMU's own timers
+             count instructions too.
+             With lockstep set, guest time stops at a limit that an
+             orchestrator (hal_lockstep) raises one quantum at a time, and
+             the Lockstep peripheral model reports each limit reached.
+             The limit is reached by intercepts, skipped delays and Idle
+             intercepts, so only at points the firmware decides.
+
+The source is set with the `clock` entry of the config file `options`
+    options:
+      clock:
+        source: virtual
+        ns_per_intercept: 10000
+        idle_skip: false
+        icount: 4
+        lockstep: false
+        qmp_port: null
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+from halucinator import hal_capture
+
+log = logging.getLogger(__name__)
+
+NS_PER_SECOND = 1000000000
+
+
+class WallClock:
+    """
+    Guest time is the host's monotonic time since the clock was created
+    """
+
+    # Guest time is host time, so captured packets need no guest timestamps
+    HOST_TIME = True
+
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def now(self):
+        """
+        Returns the guest time in seconds
+        """
+        return time.monotonic() - self.start
+
+    def now_ns(self):
+        """
+        Returns the guest time in nanoseconds
+        """
+        return int(self.now() * NS_PER_SECOND)
+
+    def sleep(self, seconds):
+        """
+        Blocks the calling (firmware) thread for seconds of guest time
+        """
+        time.sleep(seconds)
+
+    def advance(self, seconds):  # pylint: disable=unused-argument
+        """
+        Accounts for seconds of guest time a handler skipped
+        """
+
+    def wait(self, event, timeout):
+        """
+        Waits timeout seconds of guest time or until event is set
+
+        :returns: True if event is set
+        """
+        return event.wait(timeout)
+
+    def tick(self, count=1):
+        """
+        Counts intercepted calls
+        """
+
+    def idle(self):
+        """
+        The firmware is idle until a timer or interrupt wakes it
+        """
+
+    def restore(self, nanoseconds):
+        """
+        Continues guest time from nanoseconds, when resuming a checkpoint
+        """
+        self.start = time.monotonic() - nanoseconds / NS_PER_SECOND
+
+    def qemu_args(self):  # pylint: disable=no-self-use
+        """
+        Returns the QEMU arguments the clock needs
+        """
+        return []
+
+
+class ScaledClock(WallClock):
+    """
+    Guest time is host time multiplied by scale
+
+    :param scale: Guest seconds per host second
+    """
+
+    HOST_TIME = False
+
+    def __init__(self, scale=1.0):
+        super().__init__()
+        if scale <= 0:
+            raise ValueError("Clock scale must be positive")
+        self.scale = scale
+
+    def now(self):
+        return (time.monotonic() - self.start) * self.scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+    def restore(self, nanoseconds):
+        self.start = time.monotonic() - nanoseconds / NS_PER_SECOND / self.scale
+
+    def wait(self, event, timeout):
+        return event.wait(timeout / self.scale)
+
+
+class VirtualClock(WallClock):
+    """
+    Deterministic guest time advanced by intercepted calls and skipped
+    delays
+
+    :param ns_per_intercept: Guest nanoseconds each intercepted call takes
+    :param idle_skip: Also jump to the next deadline when no intercept has
+        run for idle_timeout host seconds, not deterministic
+    :param idle_timeout: Host seconds without intercepts before the guest is
+        idle, when idle_skip is set
+    :param icount: QEMU -icount shift, None to not use -icount
+    :param lockstep: Start with a limit of 0, guest time only passes once
+        set_limit raises it
+    :param qmp_port: Port of a QMP server added to QEMU, for the orchestrator
+        to pause the guest at barriers
+    """
+
+    HOST_TIME = False
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        ns_per_intercept=10000,
+        idle_skip=False,
+        idle_timeout=0.01,
+        icount=None,
+        lockstep=False,
+        qmp_port=None,
+    ):
+        super().__init__()
+        self.ns_per_intercept = ns_per_intercept
+        self.idle_skip = idle_skip
+        self.idle_timeout = idle_timeout
+        self.icount = icount
+        self.qmp_port = qmp_port
+        self._now_ns = 0
+        self._last_tick = time.monotonic()
+        # Guest ns deadlines of the waiting threads
+        self._deadlines = []
+        self._cond = threading.Condition()
+        # Guest time can't pass limit_ns, None for no limit
+        self.limit_ns = 0 if lockstep else None
+        # Called with the guest ns when the limit is reached
+        self.on_barrier = None
+        # The limit last reported, the starting limit isn't
+        self._reported = self.limit_ns
+        self._watcher = None
+
+    def now(self):
+        return self._now_ns / NS_PER_SECOND
+
+    def now_ns(self):
+        return self._now_ns
+
+    def _set_now_ns(self, nanoseconds):
+        # Called holding _cond
+        if nanoseconds > self._now_ns:
+            self._now_ns = nanoseconds
+            if self._deadlines and self._now_ns >= self._deadlines[0]:
+                self._cond.notify_all()
+
+    def _barrier(self):
+        # Called holding _cond, reports each limit once
+        if self._reported != self.limit_ns:
+            self._reported = self.limit_ns
+            if self.on_barrier is not None:
+                self.on_barrier(self._now_ns)
+
+    def _advance_ns(self, nanoseconds):
+        with self._cond:
+            target = self._now_ns + nanoseconds
+            while self.limit_ns is not None and target > self.limit_ns:
+                # Blocks the firmware until the orchestrator raises the limit
+                self._set_now_ns(self.limit_ns)
+                self._barrier()
+                self._cond.wait()
+            self._set_now_ns(target)
+
+    def _jump_idle(self):
+        # Called holding _cond, jumps an idle guest to the next deadline
+        # or the limit, whichever is first
+        targets = [self.limit_ns] if self.limit_ns is not None else []
+        if self._deadlines:
+            targets.append(self._deadlines[0])
+        if targets:
+            self._set_now_ns(min(targets))
+        if self.limit_ns is not None and self._now_ns >= self.limit_ns:
+            self._barrier()
+
+    def _skip_idle(self):
+        # Called holding _cond, host time only decides idle with idle_skip
+        if self.idle_skip and time.monotonic() - self._last_tick >= self.idle_timeout:
+            self._jump_idle()
+
+    def _watch(self):
+        # With idle_skip, a guest idle without timers waiting still reaches
+        # limits
+        with self._cond:
+            while True:
+                self._cond.wait(self.idle_timeout)
+                self._skip_idle()
+
+    def set_limit(self, nanoseconds):
+        """
+        Lets guest time pass until nanoseconds, limits are only raised
+        """
+        with self._cond:
+            if self.limit_ns is None or nanoseconds > self.limit_ns:
+                self.limit_ns = nanoseconds
+                # Time blocked at the limit isn't idle time
+                self._last_tick = time.monotonic()
+                self._cond.notify_all()
+            if self.idle_skip and self._watcher is None:
+                self._watcher = threading.Thread(
+                    target=self._watch, name="halucinator-clock", daemon=True
+                )
+                self._watcher.start()
+
+    def tick(self, count=1):
+        self._last_tick = time.monotonic()
+        self._advance_ns(count * self.ns_per_intercept)
+
+    def idle(self):
+        # Signalled by the firmware, so the jump is deterministic
+        with self._cond:
+            self._jump_idle()
+
+    def restore(self, nanoseconds):
+        with self._cond:
+            self._now_ns = nanoseconds
+            self._cond.notify_all()
+
+    def advance(self, seconds):
+        self._advance_ns(int(seconds * NS_PER_SECOND))
+
+    def sleep(self, seconds):
+        # The firmware is blocked, so no time needs to pass on the host
+        self.advance(seconds)
+
+    def wait(self, event, timeout):
+        with self._cond:
+            deadline = self._now_ns + int(timeout * NS_PER_SECOND)
+            heapq.heappush(self._deadlines, deadline)
+            try:
+                while self._now_ns < deadline and not event.is_set():
+                    # Polled, as setting event doesn't notify the condition
+                    self._cond.wait(self.idle_timeout)
+                    self._skip_idle()
+            finally:
+                self._deadlines.remove(deadline)
+                heapq.heapify(self._deadlines)
+        return event.is_set()
+
+    def qemu_args(self):
+        args = []
+        if self.icount is not None:
+            args += ["-icount", f"shift={self.icount},align=off,sleep=off"]
+        if self.qmp_port is not None:
+            args += ["-qmp", f"tcp:127.0.0.1:{self.qmp_port},server,nowait"]
+        return args
+
+
+SOURCES = {"wall": WallClock, "scaled": ScaledClock, "virtual": VirtualClock}
+_CLOCK = WallClock()
+
+
+def get_clock():
+    """
+    Returns the global clock
+    """
+    return _CLOCK
+
+
+def set_clock(clock):
+    """
+    Replaces the global clock, must be done before handlers start using it
+    """
+    global _CLOCK  # pylint: disable=global-statement
+    _CLOCK = clock
+    # Packets already have host timestamps, only other clocks are added
+    hal_capture.set_guest_clock(None if clock.HOST_TIME else clock.now_ns)
+    return clock
+
+
+def now():
+    """
+    Returns the guest time in seconds
+    """
+    return _CLOCK.now()
+
+
+def now_ns():
+    """
+    Returns the guest time in nanoseconds
+    """
+    return _CLOCK.now_ns()
+
+
+def sleep(seconds):
+    """
+    Blocks the calling (firmware) thread for seconds of guest time
+    """
+    _CLOCK.sleep(seconds)
+
+
+def advance(seconds):
+    """
+    Accounts for seconds of guest time a handler skipped
+    """
+    _CLOCK.advance(seconds)
+
+
+def wait(event, timeout):
+    """
+    Waits timeout seconds of guest time or until event is set
+
+    :returns: True if event is set
+    """
+    return _CLOCK.wait(event, timeout)
+
+
+def tick(count=1):
+    """
+    Counts intercepted calls
+    """
+    _CLOCK.tick(count)
+
+
+def idle():
+    """
+    The firmware is idle until a timer or interrupt wakes it
+    """
+    _CLOCK.idle()
+
+
+def configure(options, qemu=None):
+    """
+    Sets the global clock as set by the `clock` config option dict
+
+    :param qemu: QEMU target the clock's arguments are added to
+    """
+    options = dict(options or {})
+    source = options.pop("source", "wall")
+    if source not in SOURCES:
+        raise ValueError(f"Unknown clock source {source}, expected {list(SOURCES)}")
+    clock = set_clock(SOURCES[source](**options))
+    if qemu is not None:
+        qemu.additional_args.extend(clock.qemu_args())
+    if options.get("lockstep"):
+        # Registers the model the orchestrator sets the limit through
+        from halucinator.peripheral_models import (  # pylint: disable=import-outside-toplevel
+            lockstep,
+        )
+
+        lockstep.Lockstep.attach(clock)
+    log.info("Using %s guest clock", source)
+    return clock
@@ -18,7 +18,7 @@ from halucinator import hal_log as hal_log_conf
 from halucinator.config.target_archs import HALUCINATOR_TARGETS
 from halucinator.config.elf_program import ELFProgram
 from halucinator.config.memory_config import HalMemConfig
-from halucinator.config.symbols_config import HalSymbolConfig
+from halucinator.config.symbols_config import HalSymbolConfig, HalSymbolStore
 
 log = logging.getLogger(__name__)
 hal_log = hal_log_conf.getHalLogger()
@@ -223,7 +223,7 @@ class HalucinatorConfig:
         self.memories = {}
         self.intercepts = []
         self.watchpoints = []
-        self.symbols = []
+        self.symbols = HalSymbolStore()
         self.callables = []
         self.elf_program = None
 
@@ -339,10 +339,7 @@ class HalucinatorConfig:
         :param sym_name:  Name of the symbol
         :ret_val None or Address:
         """
-        for sym in self.symbols:
-            if sym_name == sym.name:
-                return sym.addr
-        return None
+        return self.symbols.get_addr(sym_name)
 
     def resolve_intercept_bp_addrs(self):
         """
@@ -364,11 +361,8 @@ class HalucinatorConfig:
         """
         Gets symbol name that contains address
         """
-        for sym in self.symbols:
-            # pylint: disable=chained-comparison
-            if addr >= sym.addr and addr <= (sym.addr + sym.size):
-                return sym.name
-        return hex(addr)
+        name = self.symbols.get_name(addr)
+        return hex(addr) if name is None else name
 
     def memory_by_name(self, name):
         """
@@ -0,0 +1,383 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Live metrics in Prometheus text format
+
+Modules create metrics on the global registry when imported
+    HITS = hal_metrics.counter("halucinator_intercept_hits_total",
+                               "Intercept hits", ["function"])
+    HITS.inc(function="HAL_UART_Transmit")
+
+Gauges can instead be computed when scraped with add_function, which is how
+model queue depths are exported.
+
+Serving is set with the `metrics` entry of the config file `options`
+(or halucinator --metrics-port)
+    options:
+      metrics:
+        port: 9100          # serve http://addr:port/metrics
+        addr: 127.0.0.1
+        file: metrics.prom  # also write the metrics to this file ...
+        interval: 10        # ... every interval seconds
+"""
+
+import bisect
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Base of the metric types, values are kept per tuple of label values
+    """
+
+    TYPE = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, label_values):
+        if set(label_values) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}")
+        return tuple(label_values[name] for name in self.labels)
+
+    def samples(self):
+        """
+        Returns list of (suffix, label values, extra label, value)
+        """
+        with self.lock:
+            return [("", key, None, value) for key, value in self.values.items()]
+
+    def render(self):
+        """
+        Returns the metric in Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} "
+                f"{_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count
+    """
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **label_values):
+        """
+        Increments the count for label_values by amount
+        """
+        key = self._key(label_values)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **label_values):
+        """
+        Returns the count for label_values
+        """
+        return self.values.get(self._key(label_values), 0)
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down, or that is computed when collected
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.functions = []
+
+    def set(self, value, **label_values):
+        """
+        Sets the value for label_values
+        """
+        key = self._key(label_values)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **label_values):
+        """
+        Increments the value for label_values by amount
+        """
+        key = self._key(label_values)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def add_function(self, function):
+        """
+        Adds a function that computes values of the gauge when collected
+
+        :param function: Callable returning dict of label values tuple (in the
+            order of labels) to value
+        """
+        self.functions.append(function)
+
+    def samples(self):
+        samples = super().samples()
+        for function in self.functions:
+            try:
+                values = function()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Collecting %s failed", self.name)
+                continue
+            samples.extend(("", key, None, value) for key, value in values.items())
+        return samples
+
+
+class Histogram(_Metric):
+    """
+    Counts of observations in buckets, with their sum and count
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **label_values):
+        """
+        Adds an observation
+        """
+        key = self._key(label_values)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # [per bucket counts, sum, count]
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(e[0]), e[1], e[2]) for key, e in self.values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(
+                    ("_bucket", key, ("le", _format_value(bound)), cumulative)
+                )
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, count))
+        return samples
+
+
+class Registry:
+    """
+    Collection of named metrics
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, doc, labels, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, doc, labels, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError(f"Metric {name} already registered differently")
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        """
+        Returns the Counter name, creating it if needed
+        """
+        return self._get_or_create(Counter, name, doc, labels)
+
+    def gauge(self, name, doc, labels=()):
+        """
+        Returns the Gauge name, creating it if needed
+        """
+        return self._get_or_create(Gauge, name, doc, labels)
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Returns the Histogram name, creating it if needed
+        """
+        return self._get_or_create(Histogram, name, doc, labels, buckets=buckets)
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+# (stop event, filename, registry) of the periodic file dumps
+_FILE_DUMPS = []
+
+
+def counter(name, doc, labels=()):
+    """
+    Returns the Counter name on the global registry
+    """
+    return REGISTRY.counter(name, doc, labels)
+
+
+def gauge(name, doc, labels=()):
+    """
+    Returns the Gauge name on the global registry
+    """
+    return REGISTRY.gauge(name, doc, labels)
+
+
+def histogram(name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+    """
+    Returns the Histogram name on the global registry
+    """
+    return REGISTRY.histogram(name, doc, labels, buckets)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves /metrics
+        """
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug(format, *args)
+
+
+def start_http_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """
+    Serves the registry at http://addr:port/metrics from a daemon thread
+
+    :returns: The ThreadingHTTPServer
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="halucinator-metrics", daemon=True
+    )
+    thread.start()
+    log.info("Serving metrics on http://%s:%i/metrics", addr, server.server_port)
+    return server
+
+
+def write_file(filename, registry=REGISTRY):
+    """
+    Writes the registry to filename, replacing it atomically
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as outfile:
+        outfile.write(registry.render())
+    os.replace(tmp_filename, filename)
+
+
+def start_file_dump(filename, interval=10.0, registry=REGISTRY):
+    """
+    Writes the registry to filename every interval seconds from a daemon
+    thread
+
+    :returns: threading.Event that stops the dumps when set
+    """
+    stop_event = threading.Event()
+
+    def _dump():
+        while not stop_event.wait(interval):
+            write_file(filename, registry)
+
+    threading.Thread(target=_dump, name="halucinator-metrics-file", daemon=True).start()
+    _FILE_DUMPS.append((stop_event, filename, registry))
+    return stop_event
+
+
+def configure(options, output_directory=None, port=None):
+    """
+    Starts serving metrics as set by the `metrics` config option dict
+
+    :param output_directory: Directory for relative file names
+    :param port: HTTP port, overrides options
+    """
+    options = dict(options or {})
+    if port is not None:
+        options["port"] = port
+    if options.get("port") is not None:
+        start_http_server(options["port"], options.get("addr", "127.0.0.1"))
+    if options.get("file"):
+        filename = options["file"]
+        if output_directory is not None and not os.path.isabs(filename):
+            filename = os.path.join(output_directory, filename)
+        start_file_dump(filename, options.get("interval", 10.0))
+
+
+def stop():
+    """
+    Stops the periodic file dumps, writing the files one last time
+    """
+    while _FILE_DUMPS:
+        stop_event, filename, registry = _FILE_DUMPS.pop()
+        stop_event.set()
+        write_file(filename, registry)
@@ -0,0 +1,144 @@
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Shared backing of read-only memories across emulator instances
+
+Normally every QEMU instance loads a private copy of each memory's file.
+Read-only memories (permissions without w) with a file can instead be
+mapped from one image file in a shared memory directory, with QEMU's
+memory-backend-file and share=on, so parallel instances of a firmware share
+the pages of its flash and ROM and launching doesn't copy the image
+    -object memory-backend-file,id=hal-shared-flash,size=...,
+            mem-path=/dev/shm/halucinator-<hash>.img,share=on,readonly=on
+
+Images are named by the hash of their contents, the first instance creates
+the image and later ones, of any firmware with the same image, reuse it.
+Images stay in the directory after the emulators exit, for the next
+launches, and are removed with rm /dev/shm/halucinator-*.img.
+
+The backend's id is to be passed as the memory_backend entry of the
+memory's mapping, for the configurable machine to map instead of loading
+file.  The avatar-qemu in deps/ doesn't map memory_backend yet, so memories
+are still loaded privately: enabling sharing only logs a warning, and no
+images are created, until the machine supports it.
+
+Sharing is set with the `shared_memory` entry of the config file `options`
+    options:
+      shared_memory:
+        enabled: true
+        directory: /dev/shm   # or a hugetlbfs mount, e.g. /dev/hugepages
+and a memory can opt out (or in, when not enabled) with
+    memories:
+      flash: {base_addr: 0x8000000, size: 0x2000000, permissions: r-x,
+              file: firmware.bin, shared: false}
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = "/dev/shm"
+
+_OPTIONS = {"enabled": False, "directory": DEFAULT_DIRECTORY}
+
+
+def configure(options, memories=()):
+    """
+    Sets sharing as set by the `shared_memory` config option dict
+
+    :param memories: The config's memories (HalMemConfig), those that would
+        be shared are reported as loaded privately
+    """
+    options = dict(options or {})
+    unknown = set(options) - set(_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown shared_memory options {sorted(unknown)}")
+    _OPTIONS.update(options)
+    shared = [memory.name for memory in memories if is_shared(memory)]
+    if shared:
+        log.warning(
+            "Loading private copies of %s, sharing needs a QEMU machine "
+            "that maps memory_backend",
+            ", ".join(shared),
+        )
+
+
+def is_shared(memory):
+    """
+    True if memory (a HalMemConfig) is mapped from a shared image
+    """
+    shared = memory.shared if memory.shared is not None else _OPTIONS["enabled"]
+    return bool(
+        shared
+        and memory.file is not None
+        and memory.emulate is None
+        and "w" not in memory.permissions
+    )
+
+
+def backing_file(filename, size, directory=None):
+    """
+    Returns the shared image of the first size bytes of filename, creating
+    it in directory if no instance has yet
+
+    :raises ValueError: If size isn't a multiple of the directory's page
+        size (e.g. the huge page size of a hugetlbfs mount)
+    """
+    directory = directory or _OPTIONS["directory"]
+    page_size = os.statvfs(directory).f_bsize
+    if size % page_size:
+        raise ValueError(
+            f"Size {size:#x} isn't a multiple of {directory}'s page size {page_size:#x}"
+        )
+    with open(filename, "rb") as infile:
+        image = infile.read(size)
+    digest = hashlib.blake2b(image, digest_size=16)
+    digest.update(size.to_bytes(8, "little"))
+    path = os.path.join(directory, f"halucinator-{digest.hexdigest()}.img")
+    if os.path.exists(path):
+        return path
+
+    # Written through a mapping, as hugetlbfs files can't be written, and
+    # renamed into place so instances starting together never see a
+    # partial image
+    handle, tmp_path = tempfile.mkstemp(prefix=".halucinator-", dir=directory)
+    try:
+        os.ftruncate(handle, size)
+        with mmap.mmap(handle, size) as mapped:
+            mapped[: len(image)] = image
+        os.fchmod(handle, 0o644)
+    except BaseException:
+        os.close(handle)
+        os.remove(tmp_path)
+        raise
+    os.close(handle)
+    os.replace(tmp_path, path)
+    log.info("Created shared image %s of %s", path, filename)
+    return path
+
+
+def add_backend(qemu, memory):
+    """
+    Adds the shared memory backend of memory to the QEMU command line
+
+    :returns: Id of the backend, None if memory can't be shared
+    """
+    try:
+        path = backing_file(memory.file, memory.size)
+    except (OSError, ValueError) as err:
+        log.warning("Loading a private copy of %s: %s", memory.name, err)
+        return None
+    backend = f"hal-shared-{memory.name}"
+    qemu.additional_args.extend(
+        [
+            "-object",
+            f"memory-backend-file,id={backend},size={memory.size},"
+            f"mem-path={path},share=on,readonly=on",
+        ]
+    )
+    return backend
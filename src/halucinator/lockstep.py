@@ -0,0 +1,500 @@
+"""
+Runs many HALucinator instances in lockstep, advancing their guest clocks
+one quantum at a time and exchanging their messages at the barriers
+"""
+
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+#
+# Every node (emulator) runs with a lockstep virtual clock (see hal_clock),
+# guest time stops at a limit the orchestrator raises a quantum at a time.
+# When a node reaches its limit it reports a barrier, and the orchestrator
+# pauses its guest over QMP until it may continue.  Guest time only passes
+# through the node's intercepts, skipped delays and Idle intercepts, so a
+# node's firmware needs an Idle intercept on its idle loop (or the
+# nondeterministic idle_skip clock option) to reach its limit while idle.
+#
+# The orchestrator is the nodes' broker, so it holds every message a node
+# publishes until all nodes have reached the limit the sender was running
+# to, then releases them in a fixed order (sender, then arrival) before the
+# next quantum is granted.  Messages on routed topics are sent to every
+# other node, e.g. a frame one node transmits is received by the others.
+#
+# With window equal to quantum (the default) the nodes run in strict
+# lockstep.  A larger window is the relaxed mode, a node is granted its next
+# quantum as long as it stays within window of the slowest node, so fast
+# nodes run ahead and messages may arrive up to window late.
+#
+# Devices connect to the orchestrator as to a hal_zmq_broker, the messages
+# they send to nodes are released at the next barrier.  The nodes are given
+# in a YAML file
+#     quantum: 0.001          # guest seconds
+#     window: 0.001           # >= quantum, larger for the relaxed mode
+#     end: 10                 # optional guest seconds to run
+#     routes:                 # optional, replaces the default routes
+#       Peripheral.EthernetModel.tx_frame: Peripheral.EthernetModel.rx_frame
+#     nodes:
+#       - name: board1        # also the node's namespace
+#         config: [board1_config.yaml, board1_memory.yaml]
+#         args: [--pcap, board1.pcapng]   # optional halucinator arguments
+#       - name: board2
+#         config: [board2_config.yaml]
+#         launch: false       # started by hand with the generated config
+
+from argparse import ArgumentParser
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import yaml
+import zmq
+
+from halucinator.peripheral_models.peripheral_server import (
+    topic_prefix,
+    zmq_endpoint,
+    HAL2IO,
+    IO2HAL,
+    TRANSPORTS,
+)
+from halucinator import hal_log
+
+log = logging.getLogger(__name__)
+
+NS_PER_SECOND = 1000000000
+
+ADVANCE_TOPIC = "Peripheral.Lockstep.advance"
+GRANTED_TOPIC = "Peripheral.Lockstep.granted"
+BARRIER_TOPIC = "Peripheral.Lockstep.barrier"
+
+# Topics a node publishes: topic the other nodes receive
+DEFAULT_ROUTES = {
+    "Peripheral.EthernetModel.tx_frame": "Peripheral.EthernetModel.rx_frame",
+    "Peripheral.IEEE802_15_4.tx_frame": "Peripheral.IEEE802_15_4.rx_frame",
+}
+
+
+class Node:
+    """
+    One emulator run in lockstep
+
+    :param name: Name and namespace of the node
+    :param index: Position of the node, orders released messages
+    :param qmp_port: Port of the node's QMP server, None to not pause it
+    """
+
+    # Host seconds before an unacknowledged advance is sent again
+    RESEND = 0.5
+
+    def __init__(self, name, index, qmp_port=None):
+        self.name = name
+        self.index = index
+        self.prefix = topic_prefix(name)
+        self.qmp_port = qmp_port
+        # Guest ns of the last barrier and the limit granted
+        self.time_ns = 0
+        self.limit_ns = 0
+        # Sequence number of the last advance sent and acknowledged
+        self.seq = 0
+        self.acked = 0
+        self.sent_at = 0.0
+        self.barriers = 0
+        self.waiting = False
+        self.paused = False
+        self.process = None
+        self._qmp = None
+
+    @property
+    def running(self):
+        """
+        True while the node has time left before its limit
+        """
+        return self.acked < self.seq or self.time_ns < self.limit_ns
+
+    def _qmp_command(self, command):
+        if self.qmp_port is None:
+            return None
+        try:
+            if self._qmp is None:
+                # pylint: disable=import-outside-toplevel
+                from avatar2.protocols.qmp import QMPProtocol
+
+                self._qmp = QMPProtocol(self.qmp_port)
+                self._qmp.connect()
+            return self._qmp.execute_command(command)
+        except Exception:  # pylint: disable=broad-except
+            # Pausing is best effort, the clock's limit is the barrier
+            log.warning("QMP %s failed for %s", command, self.name, exc_info=True)
+            self._qmp = None
+            return None
+
+    def pause(self):
+        """
+        Stops the guest if it is running (not stopped at a breakpoint)
+        """
+        if self.waiting:
+            return
+        self.waiting = True
+        status = self._qmp_command("query-status")
+        if status and status.get("running"):
+            self._qmp_command("stop")
+            self.paused = True
+
+    def resume(self):
+        """
+        Continues the guest if pause stopped it
+        """
+        self.waiting = False
+        if self.paused:
+            self._qmp_command("cont")
+            self.paused = False
+
+
+class Orchestrator:
+    """
+    Advances nodes in quanta of guest time and exchanges their messages
+
+    :param quantum: Guest seconds each node is advanced by
+    :param window: Guest seconds a node may run ahead of the slowest node,
+        defaults to quantum (strict lockstep)
+    :param end: Guest seconds after which the nodes aren't advanced, None to
+        run until shutdown
+    :param rx_port: Port devices publish to
+    :param tx_port: Port devices subscribe to
+    :param node_rx_port: Port nodes publish to (their rx_port)
+    :param node_tx_port: Port nodes subscribe to (their tx_port)
+    :param routes: Dict of topics a node publishes to the topics the other
+        nodes receive them as
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        quantum,
+        window=None,
+        end=None,
+        rx_port=5555,
+        tx_port=5556,
+        node_rx_port=5565,
+        node_tx_port=5566,
+        transport="tcp",
+        host="*",
+        routes=None,
+    ):
+        self.quantum_ns = int(quantum * NS_PER_SECOND)
+        self.window_ns = (
+            self.quantum_ns if window is None else int(window * NS_PER_SECOND)
+        )
+        if self.quantum_ns <= 0:
+            raise ValueError("Lockstep quantum must be positive")
+        if self.window_ns < self.quantum_ns:
+            raise ValueError("Lockstep window must be at least the quantum")
+        self.end_ns = None if end is None else int(end * NS_PER_SECOND)
+        self.routes = DEFAULT_ROUTES if routes is None else dict(routes)
+        self.nodes = []
+        self._by_prefix = {}
+        # (stamp ns, source index, arrival, node, topic, body), released once
+        # every node has reached stamp
+        self._held = []
+        self._arrivals = 0
+        self._stop = False
+        self.transport = transport
+        # inproc endpoints are only reachable from the same context
+        if transport == "inproc":
+            self.context = zmq.Context.instance()
+        else:
+            self.context = zmq.Context()
+        self.node_sub = self._socket(zmq.SUB, IO2HAL, node_rx_port, host)
+        self.node_pub = self._socket(zmq.PUB, HAL2IO, node_tx_port, host)
+        self.device_sub = self._socket(zmq.SUB, IO2HAL, rx_port, host)
+        self.device_pub = self._socket(zmq.PUB, HAL2IO, tx_port, host)
+
+    def _socket(self, kind, name, port, host):
+        socket = self.context.socket(kind)
+        socket.bind(zmq_endpoint(self.transport, name, port, host))
+        if kind == zmq.SUB:
+            socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        return socket
+
+    def add_node(self, name, qmp_port=None):
+        """
+        Adds the node with namespace name, must be done before run
+        """
+        if topic_prefix(name) in self._by_prefix:
+            raise ValueError(f"Duplicate lockstep node {name}")
+        node = Node(name, len(self.nodes), qmp_port)
+        self.nodes.append(node)
+        self._by_prefix[node.prefix] = node
+        return node
+
+    def gvt_ns(self):
+        """
+        Returns the guest time every node has reached
+        """
+        return min((node.time_ns for node in self.nodes), default=0)
+
+    def _hold(self, stamp, index, node, topic, body):
+        self._held.append((stamp, index, self._arrivals, node, topic, body))
+        self._arrivals += 1
+
+    def handle_node_msg(self, string):
+        """
+        Handles a message a node published
+        """
+        topic, body = string.split(" ", 1)
+        node = self._by_prefix.get(topic.split("/", 1)[0] + "/")
+        if node is None:
+            log.warning("Message from unknown node: %s", topic)
+            return
+        topic = topic[len(node.prefix) :]
+        if topic == BARRIER_TOPIC:
+            node.time_ns = max(node.time_ns, yaml.safe_load(body)["now_ns"])
+            node.barriers += 1
+        elif topic == GRANTED_TOPIC:
+            node.acked = max(node.acked, yaml.safe_load(body)["seq"])
+        else:
+            # Sent before the node reached its limit
+            self._hold(node.limit_ns, node.index, node, topic, body)
+
+    def handle_device_msg(self, string):
+        """
+        Handles a message a device published to a node
+        """
+        # Released after the next barrier, after the nodes' messages
+        self._hold(self.gvt_ns() + 1, len(self.nodes), None, string, None)
+
+    def release(self):
+        """
+        Sends the held messages every node has reached the stamps of
+        """
+        gvt = self.gvt_ns()
+        ready = [held for held in self._held if held[0] <= gvt]
+        if not ready:
+            return
+        self._held = [held for held in self._held if held[0] > gvt]
+        ready.sort(key=lambda held: held[:3])
+        for _, _, _, src, topic, body in ready:
+            if src is None:
+                self.node_pub.send_string(topic)
+                continue
+            self.device_pub.send_string(f"{src.prefix}{topic} {body}")
+            route = self.routes.get(topic)
+            if route is not None:
+                for node in self.nodes:
+                    if node is not src:
+                        self.node_pub.send_string(f"{node.prefix}{route} {body}")
+
+    def _send_advance(self, node, now):
+        body = yaml.safe_dump({"seq": node.seq, "until_ns": node.limit_ns})
+        self.node_pub.send_string(f"{node.prefix}{ADVANCE_TOPIC} {body}")
+        node.sent_at = now
+
+    def grant(self, now=None):
+        """
+        Advances the nodes at their limit that are allowed another quantum,
+        and pauses those that must wait for the others
+        """
+        now = time.monotonic() if now is None else now
+        gvt = self.gvt_ns()
+        for node in self.nodes:
+            if node.acked < node.seq:
+                # Resent until the node is up and subscribed
+                if now - node.sent_at >= node.RESEND:
+                    self._send_advance(node, now)
+                continue
+            if node.running:
+                continue
+            limit = min(node.time_ns + self.quantum_ns, gvt + self.window_ns)
+            if self.end_ns is not None:
+                limit = min(limit, self.end_ns)
+            if limit <= node.limit_ns:
+                node.pause()
+                continue
+            node.resume()
+            node.limit_ns = limit
+            node.seq += 1
+            self._send_advance(node, now)
+
+    @property
+    def finished(self):
+        """
+        True when every node has reached end
+        """
+        return self.end_ns is not None and self.gvt_ns() >= self.end_ns
+
+    def _drain(self, socket, handler):
+        received = False
+        while True:
+            try:
+                string = socket.recv_string(zmq.NOBLOCK)
+            except zmq.Again:
+                return received
+            received = True
+            try:
+                handler(string)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error handling lockstep message")
+
+    def run(self):
+        """
+        Runs the nodes until shutdown or every node has reached end
+        """
+        poller = zmq.Poller()
+        poller.register(self.node_sub, zmq.POLLIN)
+        poller.register(self.device_sub, zmq.POLLIN)
+        self._stop = False
+        self.grant()
+        while not self._stop and not self.finished:
+            poller.poll(int(Node.RESEND * 1000))
+            while self._drain(self.node_sub, self.handle_node_msg) | self._drain(
+                self.device_sub, self.handle_device_msg
+            ):
+                pass
+            # Messages are released before the quantum that receives them
+            self.release()
+            self.grant()
+        log.info(
+            "Lockstep stopped at %.6f guest seconds", self.gvt_ns() / NS_PER_SECOND
+        )
+
+    def stats(self):
+        """
+        Returns a string of each node's guest time and barriers
+        """
+        lines = [f"GVT {self.gvt_ns() / NS_PER_SECOND:.6f} s, held {len(self._held)}"]
+        for node in self.nodes:
+            state = "running" if node.running else "waiting"
+            lines.append(
+                f"  {node.name}: {node.time_ns / NS_PER_SECOND:.6f} s "
+                f"{node.barriers} barriers, {state}"
+            )
+        return "\n".join(lines)
+
+    def shutdown(self):
+        """
+        Stops run and closes the sockets
+        """
+        self._stop = True
+
+    def close(self):
+        """
+        Closes the sockets, after run has returned
+        """
+        for socket in (self.node_sub, self.node_pub, self.device_sub, self.device_pub):
+            socket.close(linger=0)
+        if self.transport != "inproc":
+            self.context.term()
+
+
+def _config_options(config_files, key):
+    # Options entries of later files replace earlier ones, as in hal_config
+    options = {}
+    for filename in config_files:
+        with open(filename, "r") as infile:
+            config = yaml.safe_load(infile) or {}
+        options.update((config.get("options") or {}).get(key) or {})
+    return options
+
+
+def node_config(node, config_files, transport, host):
+    """
+    Returns the config options that run a node in lockstep, appended after
+    the node's own config files
+    """
+    server = _config_options(config_files, "peripheral_server")
+    server.update(transport=transport, host=host, broker=True, namespace=node.name)
+    clock = _config_options(config_files, "clock")
+    clock.update(source="virtual", lockstep=True)
+    if node.qmp_port is not None:
+        clock["qmp_port"] = node.qmp_port
+    return {"options": {"peripheral_server": server, "clock": clock}}
+
+
+def main():
+    """
+    Runs the nodes of a lockstep file until they reach its end or interrupted
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("nodes", help="YAML file of the quantum and nodes")
+    parser.add_argument("-q", "--quantum", type=float, help="Guest seconds")
+    parser.add_argument("-w", "--window", type=float, help="Guest seconds")
+    parser.add_argument("--end", type=float, help="Guest seconds to run")
+    parser.add_argument("-r", "--rx_port", default=5555, type=int)
+    parser.add_argument("-t", "--tx_port", default=5556, type=int)
+    parser.add_argument("--node_rx_port", default=5565, type=int)
+    parser.add_argument("--node_tx_port", default=5566, type=int)
+    parser.add_argument("--transport", default="tcp", choices=TRANSPORTS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "-o", "--output", default="tmp/lockstep", help="Directory of node configs"
+    )
+    parser.add_argument(
+        "--no-launch",
+        action="store_true",
+        help="Don't start the nodes, print their commands instead",
+    )
+    args = parser.parse_args()
+
+    with open(args.nodes, "r") as infile:
+        spec = yaml.safe_load(infile)
+    hal_log.setLogConfig()
+    quantum = args.quantum if args.quantum is not None else spec.get("quantum", 0.001)
+    orchestrator = Orchestrator(
+        quantum,
+        args.window if args.window is not None else spec.get("window"),
+        args.end if args.end is not None else spec.get("end"),
+        args.rx_port,
+        args.tx_port,
+        args.node_rx_port,
+        args.node_tx_port,
+        args.transport,
+        args.host,
+        spec.get("routes"),
+    )
+
+    os.makedirs(args.output, exist_ok=True)
+    for idx, spec_node in enumerate(spec["nodes"]):
+        gdb_port = spec_node.get("gdb_port", 1234 + 10 * idx)
+        # The target uses gdb_port + 1 for QMP and the PC profiler + 2
+        node = orchestrator.add_node(
+            spec_node["name"], spec_node.get("qmp_port", gdb_port + 3)
+        )
+        config_files = spec_node.get("config") or []
+        if isinstance(config_files, str):
+            config_files = [config_files]
+        generated = os.path.join(args.output, f"{node.name}_lockstep.yaml")
+        with open(generated, "w") as outfile:
+            yaml.safe_dump(
+                node_config(node, config_files, args.transport, args.host),
+                outfile,
+            )
+        cmd = [sys.executable, "-m", "halucinator.main"]
+        for config_file in config_files + [generated]:
+            cmd += ["-c", config_file]
+        cmd += ["-n", node.name, "-p", str(gdb_port)]
+        cmd += ["-r", str(args.node_rx_port), "-t", str(args.node_tx_port)]
+        cmd += [str(arg) for arg in spec_node.get("args") or ()]
+        if args.no_launch or not spec_node.get("launch", True):
+            print(" ".join(cmd))
+            continue
+        # pylint: disable=consider-using-with
+        node_log = open(os.path.join(args.output, f"{node.name}.log"), "w")
+        node.process = subprocess.Popen(cmd, stdout=node_log, stderr=subprocess.STDOUT)
+        log.info("Started %s (pid %i)", node.name, node.process.pid)
+
+    try:
+        orchestrator.run()
+    except KeyboardInterrupt:
+        pass
+    print(orchestrator.stats())
+    orchestrator.close()
+    for node in orchestrator.nodes:
+        if node.process is not None:
+            node.process.terminate()
+            node.process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,16 +14,27 @@ import sys
 import argparse
 import signal
 
-from avatar2 import Avatar
-from avatar2.peripherals.avatar_peripheral import AvatarPeripheral
-from .peripheral_models import generic as peripheral_emulators
-
-from .bp_handlers import intercepts
-from .peripheral_models import peripheral_server as periph_server
-from .util.profile_hals import State_Recorder
+from .util.lazy_import import lazy_import, enable_import_report, print_import_report
 from .util import cortex_m_helpers as CM_helpers
+from .util import startup_profile
+from . import console
+from . import hal_capture
+from . import hal_checkpoint
+from . import hal_clock
+from . import hal_metrics
+from . import hal_shared_memory
 from . import hal_stats
-from . import hal_log, hal_config
+from . import hal_log
+
+# Imported on first use so --import-report can time them and --help is fast
+avatar2 = lazy_import("avatar2")
+avatar_peripheral = lazy_import("avatar2.peripherals.avatar_peripheral")
+peripheral_emulators = lazy_import("halucinator.peripheral_models.generic")
+intercepts = lazy_import("halucinator.bp_handlers.intercepts")
+periph_server = lazy_import("halucinator.peripheral_models.peripheral_server")
+profile_hals = lazy_import("halucinator.util.profile_hals")
+pc_profiler = lazy_import("halucinator.util.pc_profiler")
+hal_config = lazy_import("halucinator.hal_config")
 
 
 log = logging.getLogger(__name__)
@@ -53,7 +64,8 @@ def get_qemu_target(
     # Get info from config
     avatar_arch = config.machine.get_avatar_arch()
 
-    avatar = Avatar(arch=avatar_arch, output_directory=outdir)
+    with startup_profile.phase("avatar"):
+        avatar = avatar2.Avatar(arch=avatar_arch, output_directory=outdir)
     avatar.config = config
     avatar.cpu_model = config.machine.cpu_model
 
@@ -62,19 +74,20 @@ def get_qemu_target(
     log.info("QEMU Path: %s", qemu_path)
 
     qemu_target = config.machine.get_qemu_target()
-    qemu = avatar.add_target(
-        qemu_target,
-        machine=config.machine.machine,
-        cpu_model=config.machine.cpu_model,
-        gdb_executable=config.machine.gdb_exe,
-        gdb_port=gdb_port,
-        qmp_port=gdb_port + 1,
-        firmware=firmware,
-        executable=qemu_path,
-        entry_address=config.machine.entry_addr,
-        name=name,
-        qmp_unix_socket=f"/tmp/{name}-qmp",
-    )
+    with startup_profile.phase("add_target"):
+        qemu = avatar.add_target(
+            qemu_target,
+            machine=config.machine.machine,
+            cpu_model=config.machine.cpu_model,
+            gdb_executable=config.machine.gdb_exe,
+            gdb_port=gdb_port,
+            qmp_port=gdb_port + 1,
+            firmware=firmware,
+            executable=qemu_path,
+            entry_address=config.machine.entry_addr,
+            name=name,
+            qmp_unix_socket=f"/tmp/{name}-qmp",
+        )
 
     if log_basic_blocks == "irq":
         qemu.additional_args = [
@@ -195,8 +208,9 @@ def register_intercepts(config, avatar, qemu):
     # Instantiate the BP Handler Classes
     added_classes = []
     for intercept in config.intercepts:
-        bp_cls = intercepts.get_bp_handler(intercept)
-        if issubclass(bp_cls.__class__, AvatarPeripheral):
+        with startup_profile.phase("get_bp_handler", cls=intercept.cls):
+            bp_cls = intercepts.get_bp_handler(intercept)
+        if issubclass(bp_cls.__class__, avatar_peripheral.AvatarPeripheral):
             name, addr, size, per = bp_cls.get_mmio_info()
             if bp_cls not in added_classes:
                 log.info(
@@ -225,10 +239,7 @@ def register_intercepts(config, avatar, qemu):
     )
 
     # Register the BP handlers
-    for intercept in config.intercepts:
-        if intercept.bp_addr is not None:
-            log.info("Registering Intercept: %s", intercept)
-            intercepts.register_bp_handler(qemu, intercept)
+    intercepts.register_bp_handlers(qemu, config.intercepts)
 
 
 def emulate_binary(
@@ -244,9 +255,22 @@ def emulate_binary(
     qemu_args=None,
     gdb_server_port=9999,
     print_qemu_command=None,
+    startup_profile_summary=False,
+    pc_profile_rate=None,
+    metrics_port=None,
+    pcap_file=None,
+    checkpoint_interval=None,
+    resume_from=None,
 ):  # pylint: disable=too-many-arguments,too-many-locals
     """
     Start emulation of the firmware
+
+    :param startup_profile_summary: Print the startup phase timing table
+    :param pc_profile_rate: If set, sample the guest PC at this rate (Hz)
+    :param metrics_port: If set, serve Prometheus metrics on this port
+    :param pcap_file: If set, capture network traffic to this pcapng file
+    :param checkpoint_interval: If set, checkpoint every this many seconds
+    :param resume_from: Checkpoint file or directory to resume from
     """
 
     avatar, qemu = get_qemu_target(
@@ -266,10 +290,41 @@ def emulate_binary(
         log.info("Removing Bitband")
         qemu.remove_bitband = True
 
+    console.configure(config.options.get("console"))
+    periph_server.configure(config.options.get("peripheral_server"))
+    hal_clock.configure(config.options.get("clock"), qemu)
+    hal_metrics.configure(
+        config.options.get("metrics"), avatar.output_directory, metrics_port
+    )
+    hal_capture.configure(
+        config.options.get("capture"), avatar.output_directory, pcap_file
+    )
+    hal_checkpoint.configure(
+        config.options.get("checkpoint"),
+        qemu,
+        config.memories,
+        avatar.output_directory,
+        checkpoint_interval,
+    )
+
+    pc_sampler = None
+    pc_options = dict(config.options.get("pc_profiler") or {})
+    if pc_profile_rate:
+        pc_options["rate"] = pc_profile_rate
+    if pc_options:
+        pc_options.setdefault("qmp_port", gdb_port + 2)
+        pc_sampler = pc_profiler.PCSampler(qemu, config.symbols, **pc_options)
+        pc_sampler.add_qemu_args()
+
     # Setup Memory Regions
+    hal_shared_memory.configure(
+        config.options.get("shared_memory"), config.memories.values()
+    )
     record_memories = []
-    for memory in config.memories.values():
-        setup_memory(avatar, memory, record_memories)
+    with startup_profile.phase("setup_memories"):
+        for memory in config.memories.values():
+            with startup_profile.phase("add_memory_range", memory=memory.name):
+                setup_memory(avatar, memory, record_memories)
 
     # Add recorder to avatar
     # Used for debugging peripherals
@@ -279,24 +334,31 @@ def emulate_binary(
                 (os.path.splitext(elf_file)[0], str(target_name), "sqlite")
             )
 
-        avatar.recorder = State_Recorder(db_name, qemu, record_memories, elf_file)
+        with startup_profile.phase("state_recorder"):
+            avatar.recorder = profile_hals.State_Recorder(
+                db_name, qemu, record_memories, elf_file
+            )
     else:
         avatar.recorder = None
 
     qemu.gdb_port = gdb_port
     avatar.config = config
     log.info("Initializing Avatar Targets")
-    avatar.init_targets()
+    with startup_profile.phase("init_targets"):
+        avatar.init_targets()
 
     if gdb_server_port is not None and gdb_server_port >= 0:
-        avatar.load_plugin("gdbserver")
-        # pylint: disable=no-member
-        avatar.spawn_gdb_server(qemu, gdb_server_port, do_forwarding=False)
+        with startup_profile.phase("gdbserver"):
+            avatar.load_plugin("gdbserver")
+            # pylint: disable=no-member
+            avatar.spawn_gdb_server(qemu, gdb_server_port, do_forwarding=False)
 
-    register_intercepts(config, avatar, qemu)
+    with startup_profile.phase("register_intercepts"):
+        register_intercepts(config, avatar, qemu)
 
     # Do post qemu creation initialization
-    config.initialize_target(qemu)
+    with startup_profile.phase("initialize_target"):
+        config.initialize_target(qemu)
 
     # Work around Avatar-QEMU's improper init of Cortex-M3
     if config.machine.arch == "cortex-m3":
@@ -304,17 +366,39 @@ def emulate_binary(
         qemu.regs.sp = config.machine.init_sp  # Set SP as Qemu doesn't init correctly
         qemu.set_vector_table_base(config.machine.vector_base)
 
-    _start_execution(avatar, qemu, rx_port, tx_port, gdb_server_port)
+    if resume_from is not None:
+        with startup_profile.phase("resume"):
+            hal_checkpoint.restore(qemu, resume_from)
+
+    print_import_report()
+    _start_execution(
+        avatar,
+        qemu,
+        rx_port,
+        tx_port,
+        gdb_server_port,
+        startup_profile_summary,
+        pc_sampler,
+    )
 
 
-def _start_execution(avatar, qemu, rx_addr, tx_addr, gdb_server_port):
+def _start_execution(
+    avatar,
+    qemu,
+    rx_addr,
+    tx_addr,
+    gdb_server_port,
+    startup_profile_summary=False,
+    pc_sampler=None,
+):  # pylint: disable=too-many-arguments
     """
     Starts the actual execution of qemu,
     peripheral server with handlers to enable clean
     exiting
     """
     # Emulate the Binary
-    periph_server.start(rx_addr, tx_addr, qemu)
+    with startup_profile.phase("peripheral_server"):
+        periph_server.start(rx_addr, tx_addr, qemu)
 
     # Removed because of issues in python 3.10 which is default in ubuntu 22.04
     # exit_code_lock = Lock()
@@ -331,8 +415,15 @@ def _start_execution(avatar, qemu, rx_addr, tx_addr, gdb_server_port):
             signal.raise_signal(signal.SIGINT)
         else:
             __HAL_EXIT_CODE = exit_code
+            if pc_sampler is not None:
+                pc_sampler.stop()
+                pc_sampler.write(avatar.output_directory)
             avatar.stop()
             avatar.shutdown()
+            console.get_console().stop()
+            hal_metrics.stop()
+            hal_capture.stop()
+            hal_checkpoint.stop()
             periph_server.stop()
             sys.exit(__HAL_EXIT_CODE)
 
@@ -344,11 +435,20 @@ def _start_execution(avatar, qemu, rx_addr, tx_addr, gdb_server_port):
     qemu.halucinator_shutdown = halucinator_shutdown
     log.info("Letting QEMU Run")
 
+    if pc_sampler is not None:
+        pc_sampler.start()
+
     if gdb_server_port is not None:
         print(f"GDB Server Running on localhost:{gdb_server_port}")
         print("Connect GDB and continue to run")
     else:
-        qemu.cont()
+        with startup_profile.phase("first_cont"):
+            qemu.cont()
+
+    startup_profile.write(os.path.join(avatar.output_directory, "startup_profile.json"))
+    if startup_profile_summary:
+        startup_profile.print_summary()
+
     try:
         periph_server.run_server()  # Blocks Forever
     except KeyboardInterrupt:
@@ -428,6 +528,51 @@ def main():
         default=None,
         help="Just print the QEMU Command",
     )
+    parser.add_argument(
+        "--import-report",
+        action="store_true",
+        default=False,
+        help="Print the time spent importing each module during startup",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        default=False,
+        help="Print the time spent in each startup phase, "
+        "always written to tmp/<name>/startup_profile.json",
+    )
+    parser.add_argument(
+        "--pc-profile",
+        default=None,
+        type=float,
+        metavar="HZ",
+        help="Sample the guest PC at HZ samples/s, writes "
+        "tmp/<name>/pc_profile.folded and pc_profile.txt",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        default=None,
+        type=int,
+        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics",
+    )
+    parser.add_argument(
+        "--pcap",
+        default=None,
+        help="Capture emulated network traffic to this pcapng file, "
+        "relative to tmp/<name>",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        default=None,
+        type=float,
+        metavar="SECONDS",
+        help="Checkpoint the firmware every SECONDS, to tmp/<name>/checkpoints",
+    )
+    parser.add_argument(
+        "--resume-from",
+        default=None,
+        help="Resume from this checkpoint, or the newest in this directory",
+    )
     parser.add_argument(
         "-q",
         "--qemu_args",
@@ -437,18 +582,23 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.import_report:
+        enable_import_report()
 
     # Build configuration
-    config = hal_config.HalucinatorConfig()
-    for conf_file in args.config:
-        log.info("Parsing config file: %s", conf_file)
-        config.add_yaml(conf_file)
-
-    for csv_file in args.symbols:
-        log.info("Parsing csv symbol file: %s", csv_file)
-        config.add_csv_symbols(csv_file)
-
-    if not config.prepare_and_validate():
+    with startup_profile.phase("config"):
+        config = hal_config.HalucinatorConfig()
+        for conf_file in args.config:
+            log.info("Parsing config file: %s", conf_file)
+            config.add_yaml(conf_file)
+
+        for csv_file in args.symbols:
+            log.info("Parsing csv symbol file: %s", csv_file)
+            config.add_csv_symbols(csv_file)
+
+        with startup_profile.phase("validate"):
+            valid = config.prepare_and_validate()
+    if not valid:
         log.error("Config invalid")
         sys.exit(-1)
 
@@ -471,6 +621,12 @@ def main():
         qemu_args=qemu_args,
         gdb_server_port=args.gdb_server_port,
         print_qemu_command=args.print_qemu_command,
+        startup_profile_summary=args.startup_profile,
+        pc_profile_rate=args.pc_profile,
+        metrics_port=args.metrics_port,
+        pcap_file=args.pcap,
+        checkpoint_interval=args.checkpoint_interval,
+        resume_from=args.resume_from,
     )
 
 
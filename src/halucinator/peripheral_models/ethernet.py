@@ -1,31 +1,100 @@
-# Copyright 2019 National Technology & Engineering Solutions of Sandia, LLC (NTESS). 
-# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains 
+# Copyright 2019 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
 # certain rights in this software.
 
 
 from . import peripheral_server
 # from peripheral_server import PeripheralServer, peripheral_model
-from collections import deque, defaultdict
 from .interrupts import Interrupts
+from halucinator import hal_capture
+from halucinator import hal_clock
+from halucinator import hal_metrics
 import binascii
-import struct
 import logging
-import time
+import threading
+import zlib
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)
 
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+FCS_LEN = 4
 
+ETHERNET_FRAMES = hal_metrics.counter(
+    "halucinator_ethernet_frames_total",
+    "Ethernet frames handled by the ethernet model",
+    ["interface", "event"])
+
+
+def fcs(frame):
+    '''
+        Returns the Ethernet frame check sequence of frame, as it is sent
+        on the wire (CRC-32 least significant byte first)
+    '''
+    return zlib.crc32(frame).to_bytes(FCS_LEN, "little")
 
-class EthernetInterface:
 
+class EthernetInterface:
+    '''
+        Receive ring of one ethernet interface
+
+        Frames are kept as memoryviews of the received message buffers in a
+        fixed size ring, when it is full the overflow policy drops either the
+        oldest queued frame or the new frame.
+
+        :param queue_size: Number of frames the ring holds
+        :param overflow: DROP_OLDEST or DROP_NEWEST
+        :param calc_crc: Hardware calculates the FCS of sent frames, if False
+            the firmware appends it and it is checked and stripped
+        :param rx_fcs: Append the FCS to received frames (for hardware that
+            leaves it in the receive buffer)
+    '''
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
     def __init__(self, interface_id, enabled=True,
-                 calc_crc=True, irq_num=None):
+                 calc_crc=True, irq_num=None, queue_size=256,
+                 overflow=DROP_OLDEST, rx_fcs=False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s, expected one of %s"
+                             % (overflow, OVERFLOW_POLICIES))
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
         self.interface_id = interface_id
-        self.rx_queue = deque()
-        self.frame_times = deque()
         self.calc_crc = calc_crc
+        self.rx_fcs = rx_fcs
         self.irq_num = irq_num
         self.enabled = enabled
+        self.overflow = overflow
+        # Ring of (frame, rx time), self.count entries from self.head
+        self.ring = [None] * queue_size
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.counters = {"rx_frames": 0, "rx_dropped": 0, "tx_frames": 0,
+                         "tx_crc_errors": 0}
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        # Saved by checkpoints, without the lock and with the frames copied
+        # out of the received message buffers
+        state = dict(self.__dict__)
+        del state["lock"]
+        state["ring"] = [entry if entry is None else (bytes(entry[0]), entry[1])
+                         for entry in self.ring]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.ring = [entry if entry is None else (memoryview(entry[0]), entry[1])
+                     for entry in self.ring]
+        self.lock = threading.Lock()
+
+    @property
+    def queue_size(self):
+        return len(self.ring)
 
     def enable(self):
         self.enabled = True
@@ -34,7 +103,10 @@ class EthernetInterface:
         self.enabled = False
 
     def flush(self):
-        self.rx_queue.clear()
+        with self.lock:
+            self.ring = [None] * len(self.ring)
+            self.head = 0
+            self.count = 0
 
     def disable_irq(self):
         self.irq_enabled = False
@@ -43,34 +115,77 @@ class EthernetInterface:
         Interrupts.clear_active_bp(self.irq_num)
 
     def _fire_interrupt_bp(self):
-        if self.rx_queue and self.irq_num:
+        if self.count and self.irq_num:
             Interrupts.set_active_bp(self.irq_num)
 
     def _fire_interrupt_qmp(self):
-        if self.rx_queue and self.irq_num:
+        if self.count and self.irq_num:
             log.debug("Sending Interupt for %s: %#x" %(self.interface_id, self.irq_num))
             Interrupts.set_active_qmp(self.irq_num)
 
-    def buffer_frame_qmp(self, frame): 
+    def _count(self, event, amount=1):
+        self.counters[event] += amount
+        ETHERNET_FRAMES.inc(amount, interface=str(self.interface_id),
+                            event=event)
+
+    def buffer_frame_qmp(self, frame):
         '''
         This method buffer the frame so it can be read into the firmware
         later using the get_frame method
+
+        :returns: True if the frame was queued
         '''
-        if self.enabled:
-            self.rx_queue.append(frame)
-            self.frame_times.append(time.time())
-            log.info("Adding Frame to: %s" % self.interface_id)
-            self._fire_interrupt_qmp()
-        else:
-            return
+        if not self.enabled:
+            return False
+        if self.rx_fcs:
+            frame = bytes(frame) + fcs(frame)
+        entry = (memoryview(frame), hal_clock.now())
+        size = len(self.ring)
+        with self.lock:
+            if self.count < size:
+                self.ring[(self.head + self.count) % size] = entry
+                self.count += 1
+                dropped = False
+            elif self.overflow == DROP_OLDEST:
+                self.ring[self.head] = entry
+                self.head = (self.head + 1) % size
+                dropped = True
+            else:
+                dropped = None
+        if dropped is None:
+            self._count("rx_dropped")
+            log.debug("Dropped frame to %s, queue full" % self.interface_id)
+            return False
+        self._count("rx_frames")
+        if dropped:
+            self._count("rx_dropped")
+        log.debug("Adding Frame to: %s" % self.interface_id)
+        self._fire_interrupt_qmp()
+        return True
+
+    def get_frames(self, num, get_time=False):
+        '''
+            Removes up to num frames from the queue
+
+            :param get_time: Return (frame, rx time) tuples
+            :returns: List of memoryviews of the frames, oldest first
+        '''
+        size = len(self.ring)
+        with self.lock:
+            num = min(num, self.count)
+            entries = []
+            for _ in range(num):
+                entries.append(self.ring[self.head])
+                self.ring[self.head] = None
+                self.head = (self.head + 1) % size
+            self.count -= num
+        if get_time:
+            return entries
+        return [frame for frame, _ in entries]
 
     def get_frame(self, get_time=False):
-        frame = None
-        rx_time = None
-        
-        if self.rx_queue:
-            frame = self.rx_queue.popleft()
-            rx_time = self.frame_times.popleft()
+        frames = self.get_frames(1, True)
+        frame, rx_time = frames[0] if frames else (None, None)
 
         if get_time:
             return frame, rx_time
@@ -79,41 +194,60 @@ class EthernetInterface:
 
     def get_frame_info(self):
         '''
-            Returns the number of frames in the Queue and number of 
+            Returns the number of frames in the Queue and number of
             len of first frame
         '''
-        if self.rx_queue:   
-            return len(self.rx_queue), len(self.rx_queue[0])
+        with self.lock:
+            if self.count:
+                return self.count, len(self.ring[self.head][0])
         return 0, 0
 
+    def prepare_tx(self, frame):
+        '''
+            Returns frame as sent on the wire, which has no FCS. When the
+            firmware calculates the FCS (calc_crc False) it is checked and
+            stripped
+        '''
+        self._count("tx_frames")
+        if self.calc_crc or len(frame) < FCS_LEN:
+            return frame
+        frame = memoryview(frame)
+        if fcs(frame[:-FCS_LEN]) != frame[-FCS_LEN:]:
+            self._count("tx_crc_errors")
+            log.warning("Bad FCS on frame sent from %s" % self.interface_id)
+        return frame[:-FCS_LEN]
+
 # Register the pub/sub calls and methods that need mapped
 @peripheral_server.peripheral_model
 class EthernetModel(object):
 
-    # frame_queues = defaultdict(deque)
-    # calc_crc = True
-    # rx_frame_irq = None
-    # rx_irq_enabled = False
-    # frame_times = defaultdict(deque)  # Used to record reception time
     interfaces = dict()
 
+    # pylint: disable=too-many-arguments
     @classmethod
-    def add_interface(cls, interface_id, enabled=True, calc_crc=True, irq_num=None):
+    def add_interface(cls, interface_id, enabled=True, calc_crc=True, irq_num=None,
+                      queue_size=256, overflow=DROP_OLDEST, rx_fcs=False):
         '''
             Used to add an interface to the model.
 
             interface_id:   The id used for the interface
             enable:         Interface is enabled
-            calc_crc:       Should calculate and append CRC to sent frames 
-                            (used if HW would normally do this)
-            irq_num:        The irq number to trigger on received frames for this 
+            calc_crc:       Hardware calculates the CRC (FCS) of sent frames,
+                            if False the firmware appends it and it is
+                            stripped before the frame is sent
+            irq_num:        The irq number to trigger on received frames for this
                             interfaces
+            queue_size:     Number of received frames buffered
+            overflow:       drop_oldest or drop_newest, frame dropped when
+                            the receive queue is full
+            rx_fcs:         Append the CRC (FCS) to received frames
         '''
-        interface = EthernetInterface(interface_id, enabled=True, calc_crc=calc_crc, 
-                                       irq_num=irq_num)
+        interface = EthernetInterface(interface_id, enabled=enabled, calc_crc=calc_crc,
+                                       irq_num=irq_num, queue_size=queue_size,
+                                       overflow=overflow, rx_fcs=rx_fcs)
         cls.interfaces[interface_id] = interface
 
-    @classmethod    
+    @classmethod
     def enable_rx_isr_bp(cls, interface_id):
         cls.interfaces[interface_id].enable_irq_bp()
 
@@ -138,35 +272,51 @@ class EthernetModel(object):
     @peripheral_server.tx_msg
     def tx_frame(cls, interface_id, frame):
         '''
-            Creates the message that Peripheral.tx_msga will send on this 
+            Creates the message that Peripheral.tx_msga will send on this
             event
         '''
-        # TODO append CRC if needed for the interface
-        print("Sending Frame (%i): " % len(frame), binascii.hexlify(frame))
-        # print ""
-        msg = {'interface_id': interface_id, 'frame': frame}
+        interface = cls.interfaces.get(interface_id)
+        if interface is not None:
+            frame = interface.prepare_tx(frame)
+        peripheral_server.PERIPHERAL_BYTES.inc(
+            len(frame), peripheral="Ethernet %s" % interface_id, direction="tx")
+        hal_capture.capture("eth:%s" % interface_id, hal_capture.LINKTYPE_ETHERNET,
+                            frame, hal_capture.OUTBOUND)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sending Frame (%i): %s" % (len(frame), binascii.hexlify(frame)))
+        msg = {'interface_id': interface_id, 'frame': bytes(frame)}
         return msg
 
     @classmethod
     @peripheral_server.reg_rx_handler
     def rx_frame(cls, msg):
         '''
-            Processes reception of this type of message from 
+            Processes reception of this type of message from
             PeripheralServer.rx_msg
         '''
         interface_id = msg['interface_id']
-        log.info("Adding Frame to: %s" % interface_id)
         interface = cls.interfaces[interface_id]
         frame = msg['frame']
+        peripheral_server.PERIPHERAL_BYTES.inc(
+            len(frame), peripheral="Ethernet %s" % interface_id, direction="rx")
+        hal_capture.capture("eth:%s" % interface_id, hal_capture.LINKTYPE_ETHERNET,
+                            frame, hal_capture.INBOUND)
         interface.buffer_frame_qmp(frame)
 
 
     @classmethod
     def get_rx_frame(cls, interface_id, get_time=False):
-        log.info("Getting RX frame from: %s" % str(interface_id))
+        log.debug("Getting RX frame from: %s" % str(interface_id))
         interface = cls.interfaces[interface_id]
         return interface.get_frame(get_time)
 
+    @classmethod
+    def get_rx_frames(cls, interface_id, num, get_time=False):
+        '''
+            Returns up to num received frames, for drivers that fill several
+            receive descriptors per interrupt
+        '''
+        return cls.interfaces[interface_id].get_frames(num, get_time)
 
     @classmethod
     def get_frame_info(cls, interface_id):
@@ -175,5 +325,15 @@ class EthernetModel(object):
         '''
         interface = cls.interfaces[interface_id]
         return interface.get_frame_info()
-        
 
+    @classmethod
+    def get_stats(cls, interface_id):
+        '''
+            Returns dict of the frame and drop counters of the interface
+        '''
+        return dict(cls.interfaces[interface_id].counters)
+
+
+peripheral_server.RX_QUEUE_DEPTH.add_function(
+    lambda: {("EthernetModel", str(interface_id)): len(interface)
+             for interface_id, interface in list(EthernetModel.interfaces.items())})
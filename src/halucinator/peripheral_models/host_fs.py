@@ -4,13 +4,9 @@
 
 from halucinator.peripheral_models.peripheral import requires_tx_map, requires_rx_map, requires_interrupt_map
 from halucinator.peripheral_models import peripheral_server
-from collections import defaultdict
-import os
-import io
+from halucinator.peripheral_models.host_vfs import HostVFS
 import shutil
 import logging
-from os import sys, path
-from stat import S_ISDIR
 from errno import *
 log = logging.getLogger(__name__)
 
@@ -20,48 +16,37 @@ log = logging.getLogger(__name__)
 # without requiring every function to be a classmethod
 @peripheral_server.peripheral_model
 class HostFSModel(object):
-    # keep states here
-    mount_points = {}
-    open_files = {}
-    current_fd = 1
-    current_dir = 1
-    open_directories = {}
+    # keep states here, guest paths are resolved through the vfs mount table
+    # to directories in storage/
+    vfs = HostVFS("storage")
 
     def __init__(self):
         """Initialization of HostFSModel class
         """
 
         # Make sure our VFS is clean of any lingering
-        # symlinks before beginning
+        # symlinks left by older versions before beginning
         try:
             shutil.rmtree("vfs")
         except OSError:
             pass
+        self.vfs.reset()
 
     def is_valid_path(self, path):
-        """Helper function to verify if a file/folder is within the VFS folder or not.
+        """Helper function to verify a path does not escape the VFS root.
 
-        :param path: Relative or absolute file/folder path to check
+        :param path: VFS file/folder path to check
         :type path: str
         """
-        abs_path = os.path.abspath(path)
-        common_prefix_verify = os.path.abspath("./vfs")
-        common_prefix = os.path.commonpath([abs_path, common_prefix_verify])
-        return (common_prefix == common_prefix_verify)
+        return self.vfs.mounts.normalize(path) is not None
 
     def is_valid_mount(self, mp):
-        """Helper function to verify if a file/folder is within the VFS folder or not.
+        """Helper function to verify if a file/folder is on a mounted filesystem.
 
-        :param path: Relative or absolute file/folder path to check
-        :type path: str
+        :param mp: VFS file/folder path to check
+        :type mp: str
         """
-        abs_path = os.path.abspath(mp)
-        for storage in self.mount_points:
-            common_prefix_verify = os.path.abspath("./vfs" + self.mount_points[storage])
-            common_prefix = os.path.commonpath([abs_path, common_prefix_verify])
-            if (common_prefix == common_prefix_verify):
-                return True
-        return False
+        return self.vfs.resolve(mp) is not None
 
     @classmethod
     def mount(self, mount_path, fs_type):
@@ -74,34 +59,12 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if (fs_type in self.mount_points):
+        if fs_type in self.vfs.mounts.by_fs_type:
             return -EBUSY
-        print("mount ", mount_path, fs_type)
-        dir_path = os.path.realpath("storage/" + str(fs_type))
-        #
-        try:
-            os.makedirs("vfs", exist_ok=True)
-        except OSError:
-            pass
-
-        try:
-            os.makedirs("storage/" + str(fs_type), exist_ok=True)
-        except OSError:
-            pass
-
-        if not self.is_valid_path(self, "vfs" + mount_path):
-            return 0
-
-        if self.is_valid_mount(self, "vfs" + mount_path):
-            return 0
-
-        try:
-            os.symlink(dir_path, "vfs" + mount_path, target_is_directory=True)
-        except OSError:
-            pass
-        self.mount_points[fs_type] = mount_path
-
-        return 0
+        log.info("mount %s %s", mount_path, fs_type)
+        ret = self.vfs.mount(mount_path, fs_type)
+        # Remounting an existing path is not an error for the firmware
+        return 0 if ret == -EBUSY else ret
 
     @classmethod
     def open(self, f_path, flags):
@@ -115,41 +78,7 @@ class HostFSModel(object):
                  and on success, a file handle.
         :rtype: int, int
         """
-        if not self.is_valid_path(self, "./vfs" + f_path):
-            return (-ENOENT, 0)
-
-        if not self.is_valid_mount(self, "./vfs" + f_path):
-            return (-ENOENT, 0)
-
-        # TODO make sure files can't be created in /
-
-        try:
-            if (not path.exists("./vfs" + f_path) and (flags & 0x10)):
-                open("./vfs" + f_path, "wb+").close()
-            if (flags & 0x20):
-                if ((flags & 0x03) == 0x03):
-                    f = open("./vfs" + f_path, "rb+")
-                elif ((flags & 0x03) == 0x02):
-                    f = open("./vfs" + f_path, "wb")
-                else:
-                    f = open("./vfs" + f_path, "rb+")
-
-                f.seek(0, os.SEEK_END)
-            else:
-                if ((flags & 0x03) == 0x03):
-                    f = open("./vfs" + f_path, "rb+")
-                elif ((flags & 0x03) == 0x02):
-                    f = open("./vfs" + f_path, "wb")
-                else:
-                    f = open("./vfs" + f_path, "rb+")
-
-                f.seek(0)
-        except FileNotFoundError:
-            return (-ENOENT, 0)
-
-        self.open_files[self.current_fd] = f
-        self.current_fd += 1
-        return (0, (self.current_fd - 1))
+        return self.vfs.open(f_path, flags)
 
     @classmethod
     def read(self, f_id, f_size):
@@ -163,13 +92,9 @@ class HostFSModel(object):
                  and on success, contents read from the file
         :rtype: int, int
         """
-        if f_id not in self.open_files:
-            return -EBADF, bytes([])
-
         try:
-            data = self.open_files[f_id].read(f_size)
-            return len(data), data
-        except io.UnsupportedOperation:
+            return self.vfs.read(f_id, f_size)
+        except OSError:
             return 0, bytes([])
 
     @classmethod
@@ -183,12 +108,9 @@ class HostFSModel(object):
         :return: Number of bytes written on success, -ERRNO on errors.
         :rtype: int
         """
-        if f_id not in self.open_files:
-            return -EBADF
-
         try:
-            return self.open_files[f_id].write(f_data)
-        except io.UnsupportedOperation:
+            return self.vfs.write(f_id, f_data)
+        except OSError:
             return 0
 
     @classmethod
@@ -200,8 +122,7 @@ class HostFSModel(object):
         :return: A tuple of an errcode (0 on success, -ERRNO on errors) and statvfs results.
         :rtype: int, os.statvfs_result
         """
-        # TODO invalid paths?
-        return os.statvfs("./vfs" + f_path)
+        return self.vfs.statvfs(f_path)
 
     @classmethod
     def stat(self, f_path):
@@ -212,16 +133,7 @@ class HostFSModel(object):
         :return: A tuple of an errcode (0 on success, -ERRNO on errors) and stat results.
         :rtype: int, os.stat_result
         """
-        if not self.is_valid_path(self, "./vfs" + f_path):
-            return -ENOENT, None
-
-        if not self.is_valid_mount(self, "./vfs" + f_path):
-            return (-ENOENT, None)
-
-        try:
-            return 0, os.stat("./vfs" + f_path)
-        except FileNotFoundError:
-            return -ENOENT, None
+        return self.vfs.stat(f_path)
 
     @classmethod
     def close(self, f_id):
@@ -232,13 +144,7 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if f_id not in self.open_files:
-            return 0
-
-        self.open_files[f_id].close()
-        del self.open_files[f_id]
-        return 0
-        #wipe id to zero
+        return self.vfs.close(f_id)
 
     @classmethod
     def seek(self, f_id, f_pos, f_whence):
@@ -253,11 +159,7 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if f_id not in self.open_files:
-            return -EBADF
-
-        self.open_files[f_id].seek(f_pos, f_whence)
-        return 0
+        return self.vfs.seek(f_id, f_pos, f_whence)
 
     @classmethod
     def unmount(self, mount_path, fs_type):
@@ -270,12 +172,7 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if fs_type not in self.mount_points:
-            return -EINVAL
-
-        os.unlink("./vfs" + self.mount_points[fs_type])
-        del self.mount_points[fs_type]
-        return 0
+        return self.vfs.unmount(fs_type)
 
     @classmethod
     def tell(self, f_id):
@@ -286,10 +183,7 @@ class HostFSModel(object):
         :return: File position on success, -ERRNO on errors.
         :rtype: int
         """
-        if f_id not in self.open_files:
-            return -EBADF
-
-        return self.open_files[f_id].tell()
+        return self.vfs.tell(f_id)
 
     @classmethod
     def sync(self, f_id):
@@ -300,10 +194,10 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if f_id not in self.open_files:
+        if f_id not in self.vfs.open_files:
             return -EBADF
 
-        return 0 # self.open_files[f_id].flush()
+        return 0
 
     @classmethod
     def closedir(self, d_id):
@@ -314,10 +208,7 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if d_id not in self.open_directories:
-            return 0
-        del self.open_directories[d_id]
-        return 0
+        return self.vfs.closedir(d_id)
 
     @classmethod
     def mkdir(self, d_path):
@@ -328,19 +219,7 @@ class HostFSModel(object):
         :return: 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if not self.is_valid_path(self, "./vfs" + d_path):
-            return -ENOENT
-
-        if not self.is_valid_mount(self, "./vfs" + d_path):
-            return (-ENOENT)
-
-        # TODO make sure folders can't be created in /
-
-        if (path.exists("./vfs" + d_path)):
-            return -EEXIST
-
-        os.mkdir("./vfs" + d_path)
-        return 0
+        return self.vfs.mkdir(d_path)
 
     @classmethod
     def opendir(self, d_path):
@@ -352,18 +231,7 @@ class HostFSModel(object):
                  on success, a directory handle.
         :rtype: int, int
         """
-        if not self.is_valid_path(self, "./vfs" + d_path):
-            return (-ENOENT, 0)
-
-        if not self.is_valid_mount(self, "./vfs" + d_path):
-            return (-ENOENT, 0)
-
-        if (not path.exists("./vfs" + d_path)):
-            return (-ENOENT, 0)
-
-        self.open_directories[self.current_dir] = os.scandir("./vfs" + d_path)
-        self.current_dir += 1
-        return (0, (self.current_dir - 1))
+        return self.vfs.opendir(d_path)
 
     @classmethod
     def readdir(self, d_id):
@@ -376,17 +244,7 @@ class HostFSModel(object):
                  and the associated entry name str.
         :rtype: int, DirEntry, str
         """
-        if d_id not in self.open_directories:
-            return -EBADF, None, ""
-        try:
-            d_entry = next(self.open_directories[d_id])
-        except StopIteration:
-            return 0, None, ""
-
-        try:
-            return 0, d_entry.stat(), d_entry.name
-        except FileNotFoundError:
-            return -ENOENT, None, ""
+        return self.vfs.readdir(d_id)
 
     @classmethod
     def unlink(self, f_path):
@@ -397,23 +255,7 @@ class HostFSModel(object):
         :return: Returns 0 on success, -ERRNO on errors
         :rtype: int
         """
-        if not self.is_valid_path(self, "./vfs" + f_path):
-            return -ENOENT
-
-        if not self.is_valid_mount(self, "./vfs" + f_path):
-            return (-ENOENT)
-
-        if (not path.exists("./vfs" + f_path)):
-            return -ENOENT
-        try:
-            os.unlink("./vfs" + f_path)
-        except IsADirectoryError:
-            dir_path = "./vfs" + f_path
-            try:
-                os.rmdir(dir_path)
-            except OSError:
-                return -ENOTBLK
-        return 0
+        return self.vfs.unlink(f_path)
 
     @classmethod
     def rename(self, src, dst):
@@ -428,28 +270,8 @@ class HostFSModel(object):
         :return: Returns 0 on success, -ERRNO on errors
         :rtype: int
         """
-        if not self.is_valid_path(self, "./vfs" + src):
-            return -EINVAL
-
-        if not self.is_valid_mount(self, "./vfs" + src):
-            return (-EINVAL)
-
-        if not self.is_valid_path(self, "./vfs" + dst):
-            return -EINVAL
-
-        if not self.is_valid_mount(self, "./vfs" + dst):
-            return (-EINVAL)
-
-        # TODO make sure files can't be created in /
+        return self.vfs.rename(src, dst)
 
-        if (not path.exists("./vfs" + src)):
-            return -ENOENT # -EINVAL?
-
-        try:
-            os.rename("./vfs" + src, "./vfs" + dst)
-        except OSError:
-            return -ENOTBLK
-        return 0
     @classmethod
     def truncate(self, f_id, length):
         """Truncates a VFS file handle to a specified length.
@@ -461,9 +283,7 @@ class HostFSModel(object):
         :return: Returns an errcode, 0 on success, -ERRNO on errors.
         :rtype: int
         """
-        if f_id not in self.open_files:
-            return -EBADF
-
-        self.open_files[f_id].truncate(length)
-
-        return 0
+        try:
+            return self.vfs.truncate(f_id, length)
+        except OSError:
+            return -EINVAL
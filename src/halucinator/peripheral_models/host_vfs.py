@@ -0,0 +1,546 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+VFS core used by the HostFSModel.
+
+Resolves guest paths to host paths through a mount table, keeps a bounded
+pool of open host file descriptors, and uses positional I/O so a guest
+handle does not need its host descriptor to stay open between calls.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from errno import EBADF, EBUSY, EEXIST, EINVAL, ENOENT, ENOTBLK
+
+log = logging.getLogger(__name__)
+
+# Zephyr fs_open flags
+FS_O_READ = 0x01
+FS_O_WRITE = 0x02
+FS_O_RDWR = FS_O_READ | FS_O_WRITE
+FS_O_MODE_MASK = 0x03
+FS_O_CREATE = 0x10
+FS_O_APPEND = 0x20
+
+
+class MountTable:
+    """
+    Maps guest mount points to host directories.
+
+    Lookups are done by longest matching prefix and the resolved paths are
+    cached until the table changes.
+    """
+
+    MAX_CACHED_PATHS = 4096
+
+    def __init__(self):
+        self.mounts = {}  # guest mount path -> host directory
+        self.by_fs_type = {}  # fs_type -> guest mount path
+        self._prefixes = []
+        self._cache = {}
+
+    def add(self, mount_path, fs_type, host_dir):
+        """
+        Adds a mount point
+
+        :param mount_path: Guest mount path (e.g. /lfs)
+        :param fs_type: Filesystem ID backing the mount
+        :param host_dir: Host directory that the mount point maps to
+        :return: 0 on success, -ERRNO on errors
+        """
+        mount_path = self.normalize(mount_path)
+        if mount_path is None or mount_path == "/":
+            return -EINVAL
+        if fs_type in self.by_fs_type or mount_path in self.mounts:
+            return -EBUSY
+        self.mounts[mount_path] = host_dir
+        self.by_fs_type[fs_type] = mount_path
+        self._rebuild()
+        return 0
+
+    def remove(self, fs_type):
+        """
+        Removes the mount point for fs_type
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        if fs_type not in self.by_fs_type:
+            return -EINVAL
+        mount_path = self.by_fs_type.pop(fs_type)
+        del self.mounts[mount_path]
+        self._rebuild()
+        return 0
+
+    def _rebuild(self):
+        self._prefixes = sorted(self.mounts, key=len, reverse=True)
+        self._cache.clear()
+
+    @staticmethod
+    def normalize(guest_path):
+        """
+        Normalizes a guest path, returns None if it escapes the root
+        """
+        if not guest_path.startswith("/"):
+            guest_path = "/" + guest_path
+        parts = []
+        for part in guest_path.split("/"):
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if not parts:
+                    return None
+                parts.pop()
+            else:
+                parts.append(part)
+        return "/" + "/".join(parts)
+
+    def resolve(self, guest_path):
+        """
+        Resolves a guest path to a host path
+
+        :param guest_path: Path as seen by the firmware
+        :return: Host path, or None if path is not under a mount point
+        """
+        try:
+            return self._cache[guest_path]
+        except KeyError:
+            pass
+
+        host_path = None
+        norm_path = self.normalize(guest_path)
+        if norm_path is not None:
+            for prefix in self._prefixes:
+                if norm_path == prefix:
+                    host_path = self.mounts[prefix]
+                    break
+                if norm_path.startswith(prefix + "/"):
+                    host_path = os.path.join(
+                        self.mounts[prefix], norm_path[len(prefix) + 1 :]
+                    )
+                    break
+        if len(self._cache) >= self.MAX_CACHED_PATHS:
+            self._cache.clear()
+        self._cache[guest_path] = host_path
+        return host_path
+
+
+class HostFdPool:
+    """
+    LRU cache of open host file descriptors keyed by host path.
+
+    Descriptors are closed when evicted and transparently reopened on next
+    use, so the number of host descriptors is bounded by max_open.
+    """
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._fds = OrderedDict()
+
+    def get(self, host_path, writable):
+        """
+        Returns an open descriptor for host_path
+
+        :param writable: Descriptor must allow writes
+        """
+        entry = self._fds.get(host_path)
+        if entry is not None:
+            fd, fd_writable = entry
+            if fd_writable or not writable:
+                self._fds.move_to_end(host_path)
+                return fd
+            self._close(host_path)
+
+        try:
+            fd = os.open(host_path, os.O_RDWR)
+            fd_writable = True
+        except PermissionError:
+            if writable:
+                raise
+            fd = os.open(host_path, os.O_RDONLY)
+            fd_writable = False
+
+        self._fds[host_path] = (fd, fd_writable)
+        while len(self._fds) > self.max_open:
+            self._close(next(iter(self._fds)))
+        return fd
+
+    def _close(self, host_path):
+        fd, _ = self._fds.pop(host_path)
+        os.close(fd)
+
+    def evict(self, host_path):
+        """
+        Closes the cached descriptor for host_path, if any
+        """
+        if host_path in self._fds:
+            self._close(host_path)
+
+    def evict_under(self, host_dir):
+        """
+        Closes all cached descriptors below host_dir
+        """
+        prefix = host_dir.rstrip("/") + "/"
+        for host_path in [p for p in self._fds if p.startswith(prefix)]:
+            self._close(host_path)
+
+    def clear(self):
+        """
+        Closes all cached descriptors
+        """
+        for host_path in list(self._fds):
+            self._close(host_path)
+
+
+class OpenFile:  # pylint: disable=too-few-public-methods
+    """
+    Guest file handle, the position is kept here and not in the host fd
+    """
+
+    __slots__ = ("host_path", "mode", "append", "pos")
+
+    def __init__(self, host_path, mode, append):
+        self.host_path = host_path
+        self.mode = mode
+        self.append = append
+        self.pos = 0
+
+
+class OpenDir:  # pylint: disable=too-few-public-methods
+    """
+    Guest directory handle iterating a cached directory listing
+    """
+
+    __slots__ = ("entries", "index")
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.index = 0
+
+
+class HostVFS:
+    """
+    VFS core that maps guest filesystem operations onto host directories
+    """
+
+    def __init__(self, storage_dir="storage", max_open=64):
+        self.storage_dir = storage_dir
+        self.mounts = MountTable()
+        self.fd_pool = HostFdPool(max_open)
+        self.open_files = {}
+        self.open_directories = {}
+        self.dir_cache = {}
+        self.next_fd = 1
+        self.next_dir = 1
+
+    def reset(self):
+        """
+        Closes all handles and removes all mount points
+        """
+        self.fd_pool.clear()
+        self.mounts = MountTable()
+        self.open_files.clear()
+        self.open_directories.clear()
+        self.dir_cache.clear()
+        self.next_fd = 1
+        self.next_dir = 1
+
+    def resolve(self, guest_path):
+        """
+        Resolves guest_path to a host path, None if not on a mounted filesystem
+        """
+        return self.mounts.resolve(guest_path)
+
+    def _invalidate(self, host_path):
+        """
+        Drops cached listings that may contain host_path
+        """
+        self.dir_cache.pop(os.path.dirname(host_path), None)
+        self.dir_cache.pop(host_path, None)
+
+    def listdir(self, host_dir):
+        """
+        Returns cached list of (name, stat_result) for host_dir
+        """
+        entries = self.dir_cache.get(host_dir)
+        if entries is None:
+            entries = []
+            with os.scandir(host_dir) as dir_iter:
+                for d_entry in dir_iter:
+                    try:
+                        entries.append((d_entry.name, d_entry.stat()))
+                    except FileNotFoundError:
+                        pass
+            self.dir_cache[host_dir] = entries
+        return entries
+
+    def mount(self, mount_path, fs_type):
+        """
+        Mounts storage/<fs_type> at mount_path
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        host_dir = os.path.realpath(os.path.join(self.storage_dir, str(fs_type)))
+        os.makedirs(host_dir, exist_ok=True)
+        return self.mounts.add(mount_path, fs_type, host_dir)
+
+    def unmount(self, fs_type):
+        """
+        Unmounts the filesystem fs_type
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        mount_path = self.mounts.by_fs_type.get(fs_type)
+        if mount_path is not None:
+            host_dir = self.mounts.mounts[mount_path]
+            self.fd_pool.evict_under(host_dir)
+            for cached_dir in [
+                d
+                for d in self.dir_cache
+                if d == host_dir or d.startswith(host_dir + "/")
+            ]:
+                del self.dir_cache[cached_dir]
+        return self.mounts.remove(fs_type)
+
+    def open(self, guest_path, flags):
+        """
+        Opens guest_path
+
+        :return: (0, handle) on success, (-ERRNO, 0) on errors
+        """
+        host_path = self.resolve(guest_path)
+        if host_path is None:
+            return -ENOENT, 0
+
+        mode = flags & FS_O_MODE_MASK
+        os_flags = os.O_RDONLY if mode == FS_O_READ else os.O_RDWR
+        if flags & FS_O_CREATE:
+            os_flags |= os.O_CREAT
+        if mode == FS_O_WRITE:
+            # Matches historic behavior of opening write only files with "wb"
+            os_flags |= os.O_TRUNC | os.O_CREAT
+        try:
+            os.close(os.open(host_path, os_flags, 0o666))
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return -ENOENT, 0
+        except OSError as err:
+            # e.g. EACCES opening a read-only host file for writing
+            return -(err.errno or EINVAL), 0
+        self.fd_pool.evict(host_path)
+        self._invalidate(host_path)
+
+        open_file = OpenFile(host_path, mode, bool(flags & FS_O_APPEND))
+        if open_file.append:
+            open_file.pos = os.stat(host_path).st_size
+        handle = self.next_fd
+        self.next_fd += 1
+        self.open_files[handle] = open_file
+        return 0, handle
+
+    def read(self, handle, size):
+        """
+        Reads size bytes from handle
+
+        :return: (bytes read or -ERRNO, data)
+        """
+        open_file = self.open_files.get(handle)
+        if open_file is None:
+            return -EBADF, bytes([])
+        if open_file.mode == FS_O_WRITE:
+            return 0, bytes([])
+        fd = self.fd_pool.get(open_file.host_path, False)
+        data = os.pread(fd, size, open_file.pos)
+        open_file.pos += len(data)
+        return len(data), data
+
+    def write(self, handle, data):
+        """
+        Writes data to handle
+
+        :return: Number of bytes written on success, -ERRNO on errors
+        """
+        open_file = self.open_files.get(handle)
+        if open_file is None:
+            return -EBADF
+        fd = self.fd_pool.get(open_file.host_path, True)
+        if open_file.append:
+            open_file.pos = os.fstat(fd).st_size
+        written = os.pwrite(fd, data, open_file.pos)
+        open_file.pos += written
+        self._invalidate(open_file.host_path)
+        return written
+
+    def seek(self, handle, offset, whence):
+        """
+        Seeks handle, whence follows os.SEEK_*
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        open_file = self.open_files.get(handle)
+        if open_file is None:
+            return -EBADF
+        if whence == os.SEEK_SET:
+            new_pos = offset
+        elif whence == os.SEEK_CUR:
+            new_pos = open_file.pos + offset
+        elif whence == os.SEEK_END:
+            fd = self.fd_pool.get(open_file.host_path, False)
+            new_pos = os.fstat(fd).st_size + offset
+        else:
+            return -EINVAL
+        if new_pos < 0:
+            return -EINVAL
+        open_file.pos = new_pos
+        return 0
+
+    def tell(self, handle):
+        """
+        :return: Position of handle on success, -ERRNO on errors
+        """
+        open_file = self.open_files.get(handle)
+        if open_file is None:
+            return -EBADF
+        return open_file.pos
+
+    def truncate(self, handle, length):
+        """
+        Truncates handle to length
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        open_file = self.open_files.get(handle)
+        if open_file is None:
+            return -EBADF
+        os.ftruncate(self.fd_pool.get(open_file.host_path, True), length)
+        self._invalidate(open_file.host_path)
+        return 0
+
+    def close(self, handle):
+        """
+        Closes handle, the host fd stays pooled until evicted
+
+        :return: 0
+        """
+        self.open_files.pop(handle, None)
+        return 0
+
+    def stat(self, guest_path):
+        """
+        :return: (0, os.stat_result) on success, (-ERRNO, None) on errors
+        """
+        host_path = self.resolve(guest_path)
+        if host_path is None:
+            return -ENOENT, None
+        try:
+            return 0, os.stat(host_path)
+        except FileNotFoundError:
+            return -ENOENT, None
+
+    def statvfs(self, guest_path):
+        """
+        :return: os.statvfs_result of the filesystem holding guest_path
+        """
+        host_path = self.resolve(guest_path)
+        if host_path is None:
+            host_path = self.storage_dir
+        return os.statvfs(host_path)
+
+    def mkdir(self, guest_path):
+        """
+        :return: 0 on success, -ERRNO on errors
+        """
+        host_path = self.resolve(guest_path)
+        if host_path is None:
+            return -ENOENT
+        try:
+            os.mkdir(host_path)
+        except FileExistsError:
+            return -EEXIST
+        except FileNotFoundError:
+            return -ENOENT
+        self._invalidate(host_path)
+        return 0
+
+    def opendir(self, guest_path):
+        """
+        :return: (0, handle) on success, (-ERRNO, 0) on errors
+        """
+        host_path = self.resolve(guest_path)
+        if host_path is None:
+            return -ENOENT, 0
+        try:
+            entries = self.listdir(host_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return -ENOENT, 0
+        handle = self.next_dir
+        self.next_dir += 1
+        self.open_directories[handle] = OpenDir(entries)
+        return 0, handle
+
+    def readdir(self, handle):
+        """
+        :return: (errcode, os.stat_result or None, name)
+        """
+        open_dir = self.open_directories.get(handle)
+        if open_dir is None:
+            return -EBADF, None, ""
+        if open_dir.index >= len(open_dir.entries):
+            return 0, None, ""
+        name, info = open_dir.entries[open_dir.index]
+        open_dir.index += 1
+        return 0, info, name
+
+    def closedir(self, handle):
+        """
+        :return: 0
+        """
+        self.open_directories.pop(handle, None)
+        return 0
+
+    def unlink(self, guest_path):
+        """
+        Removes a file or empty directory
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        host_path = self.resolve(guest_path)
+        if host_path is None or host_path in self.mounts.mounts.values():
+            return -ENOENT
+        if not os.path.lexists(host_path):
+            return -ENOENT
+        self.fd_pool.evict(host_path)
+        try:
+            os.unlink(host_path)
+        except IsADirectoryError:
+            try:
+                os.rmdir(host_path)
+            except OSError:
+                return -ENOTBLK
+        self._invalidate(host_path)
+        return 0
+
+    def rename(self, src, dst):
+        """
+        Renames src to dst, clobbering dst if it exists
+
+        :return: 0 on success, -ERRNO on errors
+        """
+        src_path = self.resolve(src)
+        dst_path = self.resolve(dst)
+        if src_path is None or dst_path is None:
+            return -EINVAL
+        if not os.path.lexists(src_path):
+            return -ENOENT
+        self.fd_pool.evict(src_path)
+        self.fd_pool.evict(dst_path)
+        try:
+            os.rename(src_path, dst_path)
+        except OSError:
+            return -ENOTBLK
+        for open_file in self.open_files.values():
+            if open_file.host_path == src_path:
+                open_file.host_path = dst_path
+        self._invalidate(src_path)
+        self._invalidate(dst_path)
+        return 0
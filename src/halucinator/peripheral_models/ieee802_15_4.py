@@ -7,10 +7,11 @@ from . import peripheral_server
 # from peripheral_server import PeripheralServer, peripheral_model
 from collections import deque, defaultdict
 from .interrupts import Interrupts
+from halucinator import hal_capture
+from halucinator import hal_clock
 import binascii
 import struct
 import logging
-import time
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
@@ -25,6 +26,7 @@ class IEEE802_15_4(object):
     rx_frame_isr = None
     rx_isr_enabled = False
     frame_time = deque()  # Used to record reception time
+    channel = 26  # Radio channel, sent with frames for the radio medium
 
     @classmethod
     def enable_rx_isr(cls, interface_id):
@@ -44,7 +46,20 @@ class IEEE802_15_4(object):
             event
         '''
         print("Sending Frame (%i): " % len(frame), binascii.hexlify(frame))
-        msg = {'frame': frame}
+        hal_capture.capture("wpan", hal_capture.LINKTYPE_IEEE802_15_4_NOFCS,
+                            frame, hal_capture.OUTBOUND)
+        msg = {'frame': frame, 'channel': cls.channel}
+        return msg
+
+    @classmethod
+    @peripheral_server.tx_msg
+    def set_channel(cls, interface_id, channel):
+        '''
+            Tunes the radio to channel, the message lets the radio medium
+            deliver frames on the channel to this radio
+        '''
+        cls.channel = channel
+        msg = {'channel': channel}
         return msg
 
     @classmethod
@@ -56,9 +71,11 @@ class IEEE802_15_4(object):
         '''
         frame = msg['frame']
         log.info("Received Frame: %s" % binascii.hexlify(frame))
+        hal_capture.capture("wpan", hal_capture.LINKTYPE_IEEE802_15_4_NOFCS,
+                            frame, hal_capture.INBOUND)
 
         cls.frame_queue.append(frame)
-        cls.frame_time.append(time.time())
+        cls.frame_time.append(hal_clock.now())
         if cls.rx_frame_isr is not None and cls.rx_isr_enabled:
             Interrupts.trigger_interrupt(cls.rx_frame_isr,  cls.IRQ_NAME)
 
@@ -67,7 +84,7 @@ class IEEE802_15_4(object):
         frame = None
         rx_time = None
         log.info("Checking for frame")
-        if cls.frame_queue > 0:
+        if cls.frame_queue:
             log.info("Returning frame")
             frame = cls.frame_queue.popleft()
             rx_time = cls.frame_time.popleft()
@@ -0,0 +1,81 @@
+# Copyright 2022 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+"""
+Lets the lockstep orchestrator (hal_lockstep) advance the guest clock one
+quantum at a time
+
+The orchestrator sends Peripheral.Lockstep.advance with the guest time the
+emulator may run until, and the emulator answers with granted.  When the
+guest reaches that time the clock blocks the firmware and barrier is sent.
+Advances are applied on their own thread, as waiting for the other models'
+messages from a dispatcher worker could hold the only worker they need.
+"""
+
+import logging
+import queue
+import threading
+
+from halucinator.peripheral_models import peripheral_server
+
+log = logging.getLogger(__name__)
+
+
+# Register the pub/sub calls and methods that need mapped
+@peripheral_server.peripheral_model
+class Lockstep(object):
+
+    clock = None
+    # Received advance messages, applied by the halucinator-lockstep thread
+    advances = queue.Queue()
+    _thread = None
+
+    @classmethod
+    def attach(cls, clock):
+        """
+        Reports the limits clock (a lockstep VirtualClock) reaches
+        """
+        cls.clock = clock
+        clock.on_barrier = cls.barrier
+        if cls._thread is None:
+            cls._thread = threading.Thread(
+                target=cls._run_advances, name="halucinator-lockstep", daemon=True
+            )
+            cls._thread.start()
+
+    @classmethod
+    def _run_advances(cls):
+        while True:
+            msg = cls.advances.get()
+            # Messages released before the advance are handled first, so
+            # every quantum starts from the same model state
+            peripheral_server.wait_idle(exclude=(cls.__name__,))
+            cls.clock.set_limit(msg["until_ns"])
+            cls.granted(msg["seq"])
+
+    @classmethod
+    @peripheral_server.reg_rx_handler
+    def advance(cls, msg):
+        """
+        Raises the clock's limit to msg['until_ns']
+        """
+        if cls.clock is None:
+            log.error("Lockstep advance received without a lockstep clock")
+            return
+        cls.advances.put(msg)
+
+    @classmethod
+    @peripheral_server.tx_msg
+    def granted(cls, seq):
+        """
+        Acknowledges the advance with sequence number seq
+        """
+        return {"seq": seq, "now_ns": cls.clock.now_ns()}
+
+    @classmethod
+    @peripheral_server.tx_msg
+    def barrier(cls, now_ns):
+        """
+        Reports that the guest reached its limit at now_ns
+        """
+        return {"now_ns": now_ns}
@@ -4,23 +4,105 @@
 """
 Peripheral Server that enables external devices to send and receive events
 from HALucinator over ZMQ
+
+Received messages are queued per peripheral model and handled by a small
+pool of worker threads, so messages for one model are handled in order while
+a slow model does not delay the others.  Set with the `peripheral_server`
+entry of the config file `options`
+    options:
+      peripheral_server:
+        workers: 4          # worker threads
+        queue_size: 1024    # max messages queued per model
+        policy: block       # full queue: block, drop_oldest or drop_newest
+
+External devices (IOServer) connect over ipc by default, so they must run on
+the same host.  The endpoints are set with
+        transport: tcp      # ipc (default), tcp or inproc
+        host: 0.0.0.0       # tcp address to bind, or the broker's address
+        broker: false       # connect to a hal_zmq_broker instead of binding
+        namespace: board1   # prefix all topics with board1/
+
+Many emulators and devices can share topics through one broker
+(external_devices/zmq_broker.py), each emulator using its own namespace.
 """
 
 import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import yaml
 import zmq
 
+from halucinator import hal_metrics
+
 log = logging.getLogger(__name__)
 
+ZMQ_MESSAGES = hal_metrics.counter(
+    "halucinator_zmq_messages_total",
+    "Peripheral server messages",
+    ["direction", "topic"],
+)
+ZMQ_BYTES = hal_metrics.counter(
+    "halucinator_zmq_bytes_total",
+    "Encoded peripheral server message bytes",
+    ["direction", "topic"],
+)
+PERIPHERAL_BYTES = hal_metrics.counter(
+    "halucinator_peripheral_bytes_total",
+    "Data bytes moved by peripheral models",
+    ["peripheral", "direction"],
+)
+RX_QUEUE_DEPTH = hal_metrics.gauge(
+    "halucinator_rx_queue_depth",
+    "Received items waiting to be read by the firmware",
+    ["model", "interface"],
+)
+DISPATCH_QUEUE_DEPTH = hal_metrics.gauge(
+    "halucinator_dispatch_queue_depth",
+    "Received messages waiting for a peripheral model handler",
+    ["model"],
+)
+DISPATCH_DROPPED = hal_metrics.counter(
+    "halucinator_dispatch_dropped_total",
+    "Received messages dropped because the model's queue was full",
+    ["model"],
+)
+DISPATCH_BLOCKED = hal_metrics.counter(
+    "halucinator_dispatch_blocked_total",
+    "Times receiving waited because a model's queue was full",
+    ["model"],
+)
+
 # pylint: disable=global-statement
 
 __RX_HANDLERS__ = {}
-__RX_CONTEXT__ = zmq.Context()
-__TX_CONTEXT__ = zmq.Context()
+# Class name: class of every registered peripheral model
+__MODELS__ = {}
+# The process wide context so inproc devices in this process can connect
+__RX_CONTEXT__ = zmq.Context.instance()
+__TX_CONTEXT__ = __RX_CONTEXT__
 __STOP_SERVER = False
 __RX_SOCKET__ = None
 __TX_SOCKET__ = None
+# Models may send from handler, console and server threads
+__TX_LOCK__ = threading.Lock()
+
+# QMP is not thread safe and models send IRQs from worker threads
+__QMP_LOCK__ = threading.Lock()
+__WAKE_ADDR__ = "inproc://halucinator-peripheral-server-wake"
+__WAKE_SOCKET__ = None
+__PENDING_SUBSCRIPTIONS__ = deque()
+__DISPATCHER__ = None
+__DISPATCH_OPTIONS__ = {}
+__ENDPOINT_OPTIONS__ = {}
+__TOPIC_PREFIX__ = ""
+
+# Endpoint names, of messages to and from HALucinator
+IO2HAL = "IoServer2Halucinator"
+HAL2IO = "Halucinator2IoServer"
+TRANSPORTS = ("ipc", "tcp", "inproc")
 
 __PROCESS = None
 __QEMU = None
@@ -28,10 +110,190 @@ __QEMU = None
 OUTPUT_DIRECTORY = None
 
 
+class _ModelQueue:  # pylint: disable=too-few-public-methods
+    """
+    Messages for one peripheral model, handled by at most one worker at a time
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = deque()
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+
+
+class Dispatcher:
+    """
+    Routes received messages to per model queues served by a worker pool
+
+    :param workers: Number of worker threads
+    :param queue_size: Max messages queued per model
+    :param policy: What to do when a model's queue is full, block (wait
+        for space), drop_oldest or drop_newest
+    """
+
+    # Max messages handled before a worker moves to another model's queue
+    BATCH = 32
+
+    def __init__(self, workers=4, queue_size=1024, policy="block"):
+        if policy not in ("block", "drop_oldest", "drop_newest"):
+            raise ValueError(f"Invalid peripheral_server policy {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="halucinator-periph"
+        )
+        self.running = True
+        # Set in the worker threads, which can't wait for the pool
+        self._worker = threading.local()
+        DISPATCH_QUEUE_DEPTH.add_function(
+            lambda: {(name,): len(q.messages) for name, q in list(self.queues.items())}
+        )
+
+    def _get_queue(self, name):
+        with self.lock:
+            queue = self.queues.get(name)
+            if queue is None:
+                queue = self.queues[name] = _ModelQueue(name)
+        return queue
+
+    def submit(self, name, item):
+        """
+        Queues item to be handled on the queue name
+
+        :param item: (handler, args) handler is called as handler(*args)
+        :returns: False if the item was dropped
+        """
+        queue = self._get_queue(name)
+        with queue.lock:
+            while len(queue.messages) >= self.queue_size and self.running:
+                if self.policy == "drop_newest":
+                    DISPATCH_DROPPED.inc(model=name)
+                    return False
+                if self.policy == "drop_oldest":
+                    queue.messages.popleft()
+                    DISPATCH_DROPPED.inc(model=name)
+                    break
+                DISPATCH_BLOCKED.inc(model=name)
+                queue.not_full.wait(0.1)
+            queue.messages.append(item)
+            schedule = not queue.scheduled
+            queue.scheduled = True
+        if schedule:
+            self.executor.submit(self._drain, queue)
+        return True
+
+    def _drain(self, queue):
+        self._worker.active = True
+        for _ in range(self.BATCH):
+            with queue.lock:
+                if not queue.messages or not self.running:
+                    queue.scheduled = False
+                    return
+                handler, args = queue.messages.popleft()
+                queue.not_full.notify()
+            try:
+                handler(*args)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error handling message for %s", queue.name)
+        # Let other models' queues run before continuing
+        self.executor.submit(self._drain, queue)
+
+    def wait_idle(self, exclude=(), timeout=None):
+        """
+        Waits until the queues, other than those named in exclude, are
+        empty and their handlers have returned
+
+        :returns: False on timeout
+        :raises RuntimeError: When called from a handler, which may hold the
+            only worker the queues need
+        """
+        if getattr(self._worker, "active", False):
+            raise RuntimeError("wait_idle can't be called from a model handler")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running:
+            busy = [
+                queue
+                for name, queue in list(self.queues.items())
+                if name not in exclude and queue.scheduled
+            ]
+            if not busy:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def stop(self):
+        """
+        Stops the workers, dropping queued messages
+        """
+        self.running = False
+        for queue in list(self.queues.values()):
+            with queue.lock:
+                queue.not_full.notify_all()
+        self.executor.shutdown(wait=False)
+
+
+def configure(options):
+    """
+    Sets the dispatcher and endpoint options from the `peripheral_server`
+    config option dict
+    """
+    global __TOPIC_PREFIX__
+    for key, value in (options or {}).items():
+        if key in ("transport", "host", "broker"):
+            __ENDPOINT_OPTIONS__[key] = value
+        elif key == "namespace":
+            __TOPIC_PREFIX__ = topic_prefix(value)
+        else:
+            __DISPATCH_OPTIONS__[key] = value
+
+
+def topic_prefix(namespace):
+    """
+    Returns the string prepended to topics in namespace
+    """
+    return f"{namespace}/" if namespace else ""
+
+
+def zmq_endpoint(transport, name, port, host="127.0.0.1"):
+    """
+    Returns the ZMQ endpoint address
+
+    :param transport: ipc, tcp or inproc
+    :param name: IO2HAL or HAL2IO
+    :param port: Port number, also used to name ipc and inproc endpoints
+    :param host: Address for tcp
+    """
+    if transport == "ipc":
+        return f"ipc:///tmp/{name}{port}"
+    if transport == "inproc":
+        return f"inproc://{name}{port}"
+    if transport == "tcp":
+        return f"tcp://{host}:{port}"
+    raise ValueError(f"Invalid transport {transport}, use one of {TRANSPORTS}")
+
+
+def _wake():
+    """
+    Wakes run_server to stop or apply new subscriptions
+    """
+    sock = __RX_CONTEXT__.socket(zmq.PUSH)
+    sock.setsockopt(zmq.LINGER, 100)
+    sock.connect(__WAKE_ADDR__)
+    sock.send(b"")
+    sock.close()
+
+
 def peripheral_model(cls):
     """
     Decorator which registers classes as peripheral models
     """
+    __MODELS__[cls.__name__] = cls
     methods = [
         getattr(cls, x) for x in dir(cls) if hasattr(getattr(cls, x), "is_rx_handler")
     ]
@@ -40,8 +302,9 @@ def peripheral_model(cls):
         log.info("Adding method: %s", key)
         __RX_HANDLERS__[key] = (cls, method)
         if __RX_SOCKET__ is not None:
-            log.info("Subscribing to: %s", key)
-            __RX_SOCKET__.setsockopt(zmq.SUBSCRIBE, bytes(key))
+            # Socket belongs to run_server's thread, it subscribes
+            __PENDING_SUBSCRIPTIONS__.append(key)
+            _wake()
 
     return cls
 
@@ -60,9 +323,12 @@ def tx_msg(funct):
         """
         data = funct(model_cls, *args)
         topic = f"Peripheral.{model_cls.__name__}.{funct.__name__}"
-        msg = encode_zmq_msg(topic, data)
+        msg = encode_zmq_msg(__TOPIC_PREFIX__ + topic, data)
         log.info("Sending: %s", msg)
-        __TX_SOCKET__.send_string(msg)
+        ZMQ_MESSAGES.inc(direction="tx", topic=topic)
+        ZMQ_BYTES.inc(len(msg), direction="tx", topic=topic)
+        with __TX_LOCK__:
+            __TX_SOCKET__.send_string(msg)
 
     return tx_msg_decorator
 
@@ -103,27 +369,42 @@ def start(rx_port=5555, tx_port=5556, qemu=None):
     """
     global __RX_SOCKET__
     global __TX_SOCKET__
+    global __WAKE_SOCKET__
+    global __DISPATCHER__
     global __QEMU
     global OUTPUT_DIRECTORY
 
     OUTPUT_DIRECTORY = qemu.avatar.output_directory
     __QEMU = qemu
     log.info("Starting Peripheral Server, In port %i, outport %i", rx_port, tx_port)
+    transport = __ENDPOINT_OPTIONS__.get("transport", "ipc")
+    host = __ENDPOINT_OPTIONS__.get("host", "127.0.0.1")
+    io2hal_pipe = zmq_endpoint(transport, IO2HAL, rx_port, host)
+    hal2io_pipe = zmq_endpoint(transport, HAL2IO, tx_port, host)
+    if __ENDPOINT_OPTIONS__.get("broker", False):
+        # Everyone connects to the broker, publishers to its IO2HAL endpoint
+        # and subscribers to its HAL2IO endpoint
+        sub_pipe, pub_pipe, attach = hal2io_pipe, io2hal_pipe, "connect"
+    else:
+        sub_pipe, pub_pipe, attach = io2hal_pipe, hal2io_pipe, "bind"
+
     # Setup subscriber
-    io2hal_pipe = f"ipc:///tmp/IoServer2Halucinator{rx_port}"
     __RX_SOCKET__ = __RX_CONTEXT__.socket(zmq.SUB)
-    __RX_SOCKET__.bind(io2hal_pipe)
-    log.debug("Bound to %s", str(io2hal_pipe))
+    getattr(__RX_SOCKET__, attach)(sub_pipe)
+    log.debug("%s to %s", attach, sub_pipe)
+
+    for topic in list(__RX_HANDLERS__.keys()) + ["Interrupt."]:
+        log.info("Subscribing to: %s", __TOPIC_PREFIX__ + topic)
+        __RX_SOCKET__.setsockopt_string(zmq.SUBSCRIBE, __TOPIC_PREFIX__ + topic)
 
-    for topic in list(__RX_HANDLERS__.keys()):
-        log.info("Subscribing to: %s", topic)
-        __RX_SOCKET__.setsockopt_string(zmq.SUBSCRIBE, topic)
+    __WAKE_SOCKET__ = __RX_CONTEXT__.socket(zmq.PULL)
+    __WAKE_SOCKET__.bind(__WAKE_ADDR__)
+    __DISPATCHER__ = Dispatcher(**__DISPATCH_OPTIONS__)
 
     # Setup Publisher
-    hal2io_pipe = f"ipc:///tmp/Halucinator2IoServer{tx_port}"
     __TX_SOCKET__ = __TX_CONTEXT__.socket(zmq.PUB)
-    __TX_SOCKET__.bind(hal2io_pipe)
-    log.debug("Bound to %s", str(hal2io_pipe))
+    getattr(__TX_SOCKET__, attach)(pub_pipe)
+    log.debug("%s to %s", attach, pub_pipe)
 
     # __process = Process(target=run_server).start()
 
@@ -140,7 +421,8 @@ def irq_set_qmp(irq_num=1):
     Should not be used in BP handlers as creates race
     condition that may cause spurious interrupts
     """
-    __QEMU.irq_set_qmp(irq_num)
+    with __QMP_LOCK__:
+        __QEMU.irq_set_qmp(irq_num)
 
 
 def irq_clear_qmp(irq_num=1):
@@ -149,7 +431,8 @@ def irq_clear_qmp(irq_num=1):
     Should not be used in BP handlers as creates race
     condition that may cause spurious interrupts
     """
-    __QEMU.irq_clear_qmp(irq_num)
+    with __QMP_LOCK__:
+        __QEMU.irq_clear_qmp(irq_num)
 
 
 def irq_enable_qmp(irq_num=1):
@@ -159,7 +442,8 @@ def irq_enable_qmp(irq_num=1):
     Should not be used in BP handlers as creates race
     condition that may cause spurious interrupts
     """
-    __QEMU.irq_disable_qmp(irq_num)
+    with __QMP_LOCK__:
+        __QEMU.irq_enable_qmp(irq_num)
 
 
 def irq_disable_qmp(irq_num=1):
@@ -169,7 +453,8 @@ def irq_disable_qmp(irq_num=1):
     Should not be used in BP handlers as creates race
     condition that may cause spurious interrupts
     """
-    __QEMU.irq_disable_qmp(irq_num)
+    with __QMP_LOCK__:
+        __QEMU.irq_disable_qmp(irq_num)
 
 
 def irq_set_bp(irq_num=1):
@@ -219,6 +504,57 @@ def irq_disable_bp(irq_num):
 #     __QEMU.irq_pulse(irq_num, cpu)
 
 
+def _handle_message(string):
+    """
+    Decodes and handles a received message, called from the worker threads
+    """
+    topic, msg = decode_zmq_msg(string)
+    log.debug("Got message: Topic %s  Msg: %s", str(topic), str(msg))
+    if topic.startswith("Peripheral"):
+        if topic in __RX_HANDLERS__:
+            _, method = __RX_HANDLERS__[topic]
+            method(msg)
+        else:
+            log.error("Unhandled peripheral message type received: %s", topic)
+
+    elif topic.startswith("Interrupt.Trigger"):
+        log.info("Triggering Interrupt %s", msg["num"])
+        irq_set_qmp(msg["num"])
+    elif topic.startswith("Interrupt.Base"):
+        log.info("Setting Vector Base Addr %s", msg["base"])
+        with __QMP_LOCK__:
+            __QEMU.set_vector_table_base(msg["base"])
+    else:
+        log.error("Unhandled topic received: %s", topic)
+
+
+def _dispatch(string):
+    """
+    Queues a received message on its model's queue
+    """
+    # Only topics in the namespace are subscribed
+    string = string[len(__TOPIC_PREFIX__) :]
+    topic = string.split(" ", 1)[0]
+    ZMQ_MESSAGES.inc(direction="rx", topic=topic)
+    ZMQ_BYTES.inc(len(string), direction="rx", topic=topic)
+    # Peripheral.<Model>.<method> messages are ordered per model
+    parts = topic.split(".")
+    name = parts[1] if parts[0] == "Peripheral" and len(parts) > 2 else parts[0]
+    __DISPATCHER__.submit(name, (_handle_message, (string,)))
+
+
+def wait_idle(exclude=(), timeout=None):
+    """
+    Waits until the received messages queued for the models, other than
+    those named in exclude, have been handled
+
+    :returns: False on timeout
+    """
+    if __DISPATCHER__ is None:
+        return True
+    return __DISPATCHER__.wait_idle(exclude, timeout)
+
+
 def run_server():
     """
     This the main loop for the peripheral server.
@@ -226,32 +562,28 @@ def run_server():
     global __STOP_SERVER  # pylint: disable=global-statement
 
     __STOP_SERVER = False
-    __RX_SOCKET__.setsockopt(zmq.SUBSCRIBE, b"")  # pylint: disable=no-member
 
     poller = zmq.Poller()
     poller.register(__RX_SOCKET__, zmq.POLLIN)
+    poller.register(__WAKE_SOCKET__, zmq.POLLIN)
     while not __STOP_SERVER:
-        socks = dict(poller.poll(100))
-        if __RX_SOCKET__ in socks and socks[__RX_SOCKET__] == zmq.POLLIN:
-            string = __RX_SOCKET__.recv_string()
-            topic, msg = decode_zmq_msg(string)
-            log.info("Got message: Topic %s  Msg: %s", str(topic), str(msg))
-            print(f"Got message: Topic {topic}  Msg: {msg}")
-            if topic.startswith("Peripheral"):
-                if topic in __RX_HANDLERS__:
-                    _, method = __RX_HANDLERS__[topic]
-                    method(msg)
-                else:
-                    log.error("Unhandled peripheral message type received: %s", topic)
-
-            elif topic.startswith("Interrupt.Trigger"):
-                log.info("Triggering Interrupt %s", msg["num"])
-                irq_set_qmp(msg["num"])
-            elif topic.startswith("Interrupt.Base"):
-                log.info("Setting Vector Base Addr %s", msg["num"])
-                __QEMU.set_vector_table_base(msg["base"])
-            else:
-                log.error("Unhandled topic received: %s", topic)
+        socks = dict(poller.poll(1000))
+        if __WAKE_SOCKET__ in socks:
+            while __WAKE_SOCKET__.poll(0):
+                __WAKE_SOCKET__.recv()
+            while __PENDING_SUBSCRIPTIONS__:
+                topic = __PENDING_SUBSCRIPTIONS__.popleft()
+                log.info("Subscribing to: %s", __TOPIC_PREFIX__ + topic)
+                __RX_SOCKET__.setsockopt_string(zmq.SUBSCRIBE, __TOPIC_PREFIX__ + topic)
+        if __RX_SOCKET__ in socks:
+            # Queue everything received before polling again
+            while not __STOP_SERVER:
+                try:
+                    string = __RX_SOCKET__.recv_string(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                _dispatch(string)
+    __DISPATCHER__.stop()
     log.info("Peripheral Server Shutdown Normally")
 
 
@@ -261,3 +593,5 @@ def stop():
     """
     global __STOP_SERVER  # pylint: disable=global-statement
     __STOP_SERVER = True
+    if __WAKE_SOCKET__ is not None:
+        _wake()
@@ -0,0 +1,522 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC (NTESS).
+# Under the terms of Contract DE-NA0003525 with NTESS, the U.S. Government retains
+# certain rights in this software.
+"""
+RAM backed filesystem model that exposes the same API as the DosFsModel.
+
+The tree is seeded from a host directory or a tar/zip archive. Seeded file
+contents are only read from the image the first time they are accessed,
+after which all changes stay in memory, so the image is never modified.
+Optionally the final tree is exported to a directory or tar file at exit.
+"""
+
+import atexit
+import errno
+import io
+import logging
+import os
+import posixpath
+import stat
+import tarfile
+import time
+import zipfile
+
+from halucinator.peripheral_models.dos_fs_model import (
+    DosFsModel,
+    is_mkdir,
+    translate_flags,
+)
+
+log = logging.getLogger(__name__)
+
+ERROR = 0xFFFFFFFF
+FIRST_FD = 3
+BLOCK_SIZE = 512
+
+
+class RamNode(object):
+    """A file or directory in the RAM filesystem"""
+
+    __slots__ = ("is_dir", "children", "_data", "_loader", "atime", "mtime")
+
+    def __init__(self, is_dir=False, data=None, loader=None, mtime=None):
+        self.is_dir = is_dir
+        self.children = {} if is_dir else None
+        self._data = bytearray(data) if data is not None else None
+        self._loader = loader
+        self.mtime = int(time.time()) if mtime is None else int(mtime)
+        self.atime = self.mtime
+
+    @property
+    def data(self):
+        """File contents, copied from the seed image on first access"""
+        if self._data is None:
+            self._data = bytearray(self._loader() if self._loader else b"")
+            self._loader = None
+        return self._data
+
+    @property
+    def size(self):
+        """Size of file in bytes, does not load seeded contents"""
+        if self.is_dir:
+            return 0
+        if self._data is None and self._loader is not None:
+            return self._loader.size
+        return len(self.data)
+
+
+def _read_host_file(host_path):
+    with open(host_path, "rb") as infile:
+        return infile.read()
+
+
+class _ImageLoader(object):  # pylint: disable=too-few-public-methods
+    """Lazily reads one file out of a seed directory or archive"""
+
+    __slots__ = ("read", "size")
+
+    def __init__(self, read, size):
+        self.read = read
+        self.size = size
+
+    def __call__(self):
+        return self.read()
+
+
+class RamFd(object):  # pylint: disable=too-few-public-methods
+    """An open file descriptor in the RAM filesystem"""
+
+    __slots__ = ("path", "node", "pos", "flags")
+
+    def __init__(self, path, node, flags):
+        self.path = path
+        self.node = node
+        self.pos = 0
+        self.flags = flags
+
+
+class RamDosFsModel(DosFsModel):
+    """
+    In memory DOS FS model, used by the dos_fs and yaf_fs bp_handlers when
+    their `fs_backend` class arg is `ram`
+    """
+
+    readdir = {}
+    fd_table = {}
+    fds = {}
+    free_fds = []
+    next_fd = FIRST_FD
+    nodes = {}
+    image = None
+    export_path = None
+    _configured = False
+    _export_registered = False
+
+    @classmethod
+    def configure(cls, image=None, export=None):
+        """
+        Sets the seed image and export location then resets the filesystem.
+        The filesystem is shared by the dos_fs and yaf_fs handlers, so later
+        calls with the same arguments keep the current tree
+
+        image: Host directory, tar or zip file used to seed the filesystem
+        export: Directory (or .tar/.tar.gz file) the final tree is written to
+                when HALucinator exits
+        """
+        if cls._configured:
+            if (image, export) != (cls.image, cls.export_path):
+                raise ValueError(
+                    f"RAM filesystem already configured with image {cls.image} "
+                    f"and export {cls.export_path}"
+                )
+            return
+        cls.image = image
+        cls.export_path = export
+        cls._configured = True
+        cls.reset()
+        if export is not None and not cls._export_registered:
+            atexit.register(cls.export_at_exit)
+            cls._export_registered = True
+
+    @classmethod
+    def reset(cls):
+        """Discards all changes and open files, reseeding from the image"""
+        cls.readdir.clear()
+        cls.fd_table.clear()
+        cls.fds.clear()
+        cls.free_fds.clear()
+        cls.next_fd = FIRST_FD
+        cls.nodes = {"/": RamNode(is_dir=True)}
+        if cls.image is not None:
+            cls._seed(cls.image)
+
+    @classmethod
+    def _seed(cls, image):
+        if os.path.isdir(image):
+            cls._seed_dir(image)
+        elif tarfile.is_tarfile(image):
+            cls._seed_tar(image)
+        elif zipfile.is_zipfile(image):
+            cls._seed_zip(image)
+        else:
+            raise ValueError(f"Unsupported filesystem image {image}")
+        log.info("Seeded RAM filesystem with %i entries from %s", len(cls.nodes), image)
+
+    @classmethod
+    def _seed_dir(cls, image):
+        for root, dirs, files in os.walk(image):
+            rel = os.path.relpath(root, image)
+            base = "/" if rel == "." else "/" + rel.replace(os.sep, "/")
+            for name in dirs:
+                st = os.stat(os.path.join(root, name))
+                cls._add_node(
+                    posixpath.join(base, name), RamNode(is_dir=True, mtime=st.st_mtime)
+                )
+            for name in files:
+                host_path = os.path.join(root, name)
+                st = os.stat(host_path)
+                loader = _ImageLoader(
+                    lambda p=host_path: _read_host_file(p), st.st_size
+                )
+                cls._add_node(
+                    posixpath.join(base, name),
+                    RamNode(loader=loader, mtime=st.st_mtime),
+                )
+
+    @classmethod
+    def _seed_tar(cls, image):
+        tar = tarfile.open(image)
+        for member in tar.getmembers():
+            path = cls.normalize(member.name)
+            if path == "/":
+                continue
+            if member.isdir():
+                cls._add_node(path, RamNode(is_dir=True, mtime=member.mtime))
+            elif member.isfile():
+                loader = _ImageLoader(
+                    lambda m=member: tar.extractfile(m).read(), member.size
+                )
+                cls._add_node(path, RamNode(loader=loader, mtime=member.mtime))
+
+    @classmethod
+    def _seed_zip(cls, image):
+        archive = zipfile.ZipFile(image)
+        for info in archive.infolist():
+            path = cls.normalize(info.filename)
+            if path == "/":
+                continue
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            if info.is_dir():
+                cls._add_node(path, RamNode(is_dir=True, mtime=mtime))
+            else:
+                loader = _ImageLoader(lambda i=info: archive.read(i), info.file_size)
+                cls._add_node(path, RamNode(loader=loader, mtime=mtime))
+
+    @classmethod
+    def _add_node(cls, path, node):
+        """Adds node at path, creating missing parent directories"""
+        parent_path, name = posixpath.split(path)
+        parent = cls.nodes.get(parent_path)
+        if parent is None:
+            parent = cls._add_node(parent_path, RamNode(is_dir=True))
+        existing = parent.children.get(name)
+        if existing is not None and existing.is_dir and node.is_dir:
+            return existing
+        parent.children[name] = node
+        cls.nodes[path] = node
+        return node
+
+    @classmethod
+    def _remove_node(cls, path):
+        node = cls.nodes.pop(path)
+        parent_path, name = posixpath.split(path)
+        del cls.nodes[parent_path].children[name]
+        return node
+
+    @classmethod
+    def make_dir(cls, path):
+        """Creates the directory path and its missing parents"""
+        path = cls.normalize(path)
+        if path != "/":
+            cls._add_node(path, RamNode(is_dir=True))
+
+    @staticmethod
+    def normalize(path):
+        """Returns the absolute normalized form of a guest path"""
+        return posixpath.normpath("/" + path.lstrip("/"))
+
+    @classmethod
+    def _alloc_fd(cls, path, node, flags):
+        if cls.free_fds:
+            fd = cls.free_fds.pop()
+        else:
+            fd = cls.next_fd
+            cls.next_fd += 1
+        cls.fds[fd] = RamFd(path, node, flags)
+        cls.fd_table[fd] = path
+        return fd
+
+    @classmethod
+    def _get_fd(cls, fd):
+        try:
+            return cls.fds[fd]
+        except KeyError:
+            raise OSError(f"Bad file descriptor {fd}") from None
+
+    @classmethod
+    def read(cls, fd, size):
+        """read"""
+        ram_fd = cls._get_fd(fd)
+        if ram_fd.node.is_dir:
+            raise IsADirectoryError(ram_fd.path)
+        data = bytes(ram_fd.node.data[ram_fd.pos : ram_fd.pos + size])
+        ram_fd.pos += len(data)
+        ram_fd.node.atime = int(time.time())
+        return data
+
+    @classmethod
+    def write(cls, fd, buf):
+        """write"""
+        ram_fd = cls._get_fd(fd)
+        if ram_fd.node.is_dir:
+            raise IsADirectoryError(ram_fd.path)
+        data = ram_fd.node.data
+        if ram_fd.flags & os.O_APPEND:
+            ram_fd.pos = len(data)
+        end = ram_fd.pos + len(buf)
+        if ram_fd.pos > len(data):
+            data.extend(bytes(ram_fd.pos - len(data)))
+        data[ram_fd.pos : end] = buf
+        ram_fd.pos = end
+        ram_fd.node.mtime = int(time.time())
+
+    @classmethod
+    def close(cls, fd):
+        """close"""
+        cls._get_fd(fd)
+        del cls.fds[fd]
+        del cls.fd_table[fd]
+        cls.readdir.pop(fd, None)
+        cls.free_fds.append(fd)
+
+    @classmethod
+    def creat_or_open(cls, name, flags, mode):
+        """
+        Opens a file, or creates it of not present
+        name: Filename
+        flags:
+        mode: (Open Mode)
+
+        returns: fd on success, or -1 on failure
+        """
+        if not ((len(name) > 1) and name.strip()):
+            return True, ERROR
+        path = cls.normalize(name)
+        parent_path = posixpath.dirname(path)
+        # Match host backend, which creates missing parent directories
+        parent = cls.nodes.get(parent_path)
+        if parent is None:
+            parent = cls._add_node(parent_path, RamNode(is_dir=True))
+        if not parent.is_dir:
+            log.debug("PATH DOES NOT EXIST: %s", parent_path)
+            return True, ERROR
+
+        fl = translate_flags(flags)
+        log.debug("vxworks flags: %s, translated flags: %s", flags, fl)
+        node = cls.nodes.get(path)
+        if is_mkdir(mode):
+            if node is None:
+                log.debug("CREATING DIR: %s", path)
+                node = cls._add_node(path, RamNode(is_dir=True))
+            return True, cls._alloc_fd(path, node, os.O_RDONLY)
+
+        if node is None:
+            if not fl & os.O_CREAT:
+                log.debug("FILE DOES NOT EXIST: %s", path)
+                return True, ERROR
+            node = cls._add_node(path, RamNode(data=b""))
+        elif node.is_dir and fl & (os.O_WRONLY | os.O_RDWR):
+            return True, ERROR
+        log.debug("OPENING FILE: %s", path)
+        return True, cls._alloc_fd(path, node, fl)
+
+    @classmethod
+    def delete(cls, drv, path, drive):
+        """delete"""
+        if drive is None:
+            log.debug("NO DRIVER INITALIZED")
+            return 0
+
+        full_path = cls.normalize(drive + path)
+        node = cls.nodes.get(full_path)
+        if node is None:
+            log.error("The file does not exist")
+            return ERROR
+        if node.is_dir and node.children:
+            log.error("Directory not empty: %s", full_path)
+            return ERROR
+        cls._remove_node(full_path)
+        return 0
+
+    @classmethod
+    def _move(cls, old_path, new_path):
+        """Renames old_path to new_path, raising OSError like os.rename"""
+        if new_path == old_path:
+            return
+        node = cls.nodes[old_path]
+        if node.is_dir and new_path.startswith(old_path + "/"):
+            raise OSError(errno.EINVAL, "Cannot move a directory into itself", new_path)
+        existing = cls.nodes.get(new_path)
+        if existing is not None:
+            if existing.is_dir and not node.is_dir:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory", new_path)
+            if node.is_dir and not existing.is_dir:
+                raise NotADirectoryError(errno.ENOTDIR, "Not a directory", new_path)
+            if existing.is_dir and existing.children:
+                raise OSError(errno.ENOTEMPTY, "Directory not empty", new_path)
+            cls._remove_node(new_path)
+        cls._remove_node(old_path)
+        if node.is_dir:
+            prefix = old_path + "/"
+            for sub_path in [p for p in cls.nodes if p.startswith(prefix)]:
+                cls.nodes[new_path + sub_path[len(old_path) :]] = cls.nodes.pop(
+                    sub_path
+                )
+        cls._add_node(new_path, node)
+        for fd, ram_fd in cls.fds.items():
+            if ram_fd.node is node:
+                ram_fd.path = new_path
+                cls.fd_table[fd] = new_path
+
+    @classmethod
+    def fio_move(cls, fd, new_path):
+        """fio_move"""
+        cls._move(cls._get_fd(fd).path, cls.normalize(new_path))
+
+    @classmethod
+    def fio_time_set(cls, fd, atime, modtime):
+        """fio_time_set"""
+        node = cls._get_fd(fd).node
+        node.atime = atime
+        node.mtime = modtime
+
+    @classmethod
+    def fio_read(cls, fd):
+        """fio_read"""
+        ram_fd = cls._get_fd(fd)
+        # Same result as host backend
+        end = ram_fd.node.size - 1
+        return end - ram_fd.pos
+
+    @classmethod
+    def fio_seek(cls, fd, arg):
+        """fio_seek"""
+        ram_fd = cls._get_fd(fd)
+        ram_fd.pos = max(0, ram_fd.pos + arg)
+
+    @classmethod
+    def fio_where(cls, fd):
+        """fio_where"""
+        return cls._get_fd(fd).pos
+
+    @classmethod
+    def fio_read_dir(cls, fd, init):
+        """fio_read_dir"""
+        if init:
+            node = cls._get_fd(fd).node
+            if not node.is_dir or not node.children:
+                return None
+            cls.readdir[fd] = iter(list(node.children))
+        ret_val = next(cls.readdir[fd], None)
+        if ret_val is None:
+            del cls.readdir[fd]
+            return None
+        return ret_val.encode("utf-8")
+
+    @classmethod
+    def fio_fstat_get(cls, fd):
+        """fio_fstat_get"""
+        node = cls._get_fd(fd).node
+        size = node.size
+        if node.is_dir:
+            st_mode = stat.S_IFDIR | 0o755
+        else:
+            st_mode = stat.S_IFREG | 0o644
+        return {
+            "st_dev": 0,
+            "st_nlink": 1,
+            "st_size": size,
+            "st_blksize": BLOCK_SIZE,
+            "st_blocks": (size + BLOCK_SIZE - 1) // BLOCK_SIZE,
+            "st_attrib": 0,
+            "st_mode": st_mode,
+            "st_atime": node.atime,
+            "st_mtime": node.mtime,
+        }
+
+    @classmethod
+    def fio_rename(cls, fd, new_name):
+        """fio_rename"""
+        old_path = cls._get_fd(fd).path
+        cls._move(old_path, posixpath.join(posixpath.dirname(old_path), new_name))
+
+    @classmethod
+    def export(cls, export_path):
+        """
+        Writes the current tree to export_path, as a tar file if it ends
+        with .tar, .tar.gz or .tgz else as a directory
+        """
+        paths = sorted(p for p in cls.nodes if p != "/")
+        if export_path.endswith((".tar", ".tar.gz", ".tgz")):
+            mode = "w" if export_path.endswith(".tar") else "w:gz"
+            with tarfile.open(export_path, mode) as tar:
+                for path in paths:
+                    cls._export_tar_member(tar, path, cls.nodes[path])
+        else:
+            for path in paths:
+                node = cls.nodes[path]
+                host_path = os.path.join(export_path, path.lstrip("/"))
+                if node.is_dir:
+                    os.makedirs(host_path, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(host_path), exist_ok=True)
+                    with open(host_path, "wb") as outfile:
+                        outfile.write(node.data)
+                os.utime(host_path, (node.atime, node.mtime))
+        log.info("Exported RAM filesystem to %s", export_path)
+
+    @staticmethod
+    def _export_tar_member(tar, path, node):
+        info = tarfile.TarInfo(path.lstrip("/"))
+        info.mtime = node.mtime
+        if node.is_dir:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+        else:
+            info.size = len(node.data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(bytes(node.data)))
+
+    @classmethod
+    def export_at_exit(cls):
+        """atexit hook that exports the tree if an export path is set"""
+        if cls.export_path is not None:
+            cls.export(cls.export_path)
+
+
+def get_fs_model(impl, fs_backend="host", fs_image=None, fs_export=None):
+    """
+    Returns the filesystem model to use for the dos_fs and yaf_fs handlers
+
+    impl: Model to use for the host backend
+    fs_backend: "host" to use impl, "ram" to use the RamDosFsModel
+    fs_image: Directory or archive used to seed the ram backend
+    fs_export: Where to export the ram backend's tree at exit
+    """
+    if fs_backend == "host":
+        return impl
+    if fs_backend == "ram":
+        RamDosFsModel.configure(fs_image, fs_export)
+        return RamDosFsModel
+    raise ValueError(f"Unknown fs_backend {fs_backend}, use 'host' or 'ram'")
@@ -3,9 +3,9 @@
 # certain rights in this software.
 
 import logging
-import time
 from threading import Event, Thread
 
+from halucinator import hal_clock
 from halucinator.peripheral_models import peripheral_server
 from halucinator.peripheral_models.interrupts import Interrupts
 
@@ -36,6 +36,25 @@ class TimerModel(object):
         # cls.stop_timer(name)
         Interrupts.clear_active(irq_name)
 
+    @classmethod
+    def get_checkpoint_state(cls):
+        '''
+            Returns the running timers as {name: (isr_num, rate)}
+        '''
+        return {name: (t.irq_num, t.rate)
+                for name, (stop_event, t) in list(cls.active_timers.items())
+                if not stop_event.is_set()}
+
+    @classmethod
+    def set_checkpoint_state(cls, state):
+        '''
+            Restarts the timers that were running when checkpointed
+        '''
+        cls.shutdown()
+        cls.active_timers = {}
+        for name, (isr_num, rate) in state.items():
+            cls.start_timer(name, isr_num, rate)
+
     @classmethod
     def shutdown(cls):
         for key, (stop_event, t) in list(cls.active_timers.items()):
@@ -53,10 +72,11 @@ class TimerIRQ(Thread):
 
     def run(self):
         if self.delay:
-            #delay for self.delay seconds before triggering
-            time.sleep(self.delay)
+            #delay for self.delay guest seconds before triggering
+            if hal_clock.wait(self.stopped, self.delay):
+                return
             self.delay = 0
-        while not self.stopped.wait(self.rate):
+        while not hal_clock.wait(self.stopped, self.rate):
             log.info("Sending IRQ: %s" % hex(self.irq_num))
             Interrupts.set_active_qmp(self.irq_num)
             # call a function
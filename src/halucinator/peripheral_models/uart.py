@@ -26,6 +26,8 @@ class UARTPublisher(object):
            Publishes the data to sub/pub server
         '''
         log.info("Writing: %s" % chars)
+        peripheral_server.PERIPHERAL_BYTES.inc(
+            len(chars), peripheral="UART %s" % uart_id, direction="tx")
         msg = {'id': uart_id, 'chars': chars}
         return msg
 
@@ -96,4 +98,11 @@ class UARTPublisher(object):
         log.debug("rx_data got message: %s" % str(msg))
         uart_id = msg['id']
         data = msg['chars']
+        peripheral_server.PERIPHERAL_BYTES.inc(
+            len(data), peripheral="UART %s" % uart_id, direction="rx")
         cls.rx_buffers[uart_id].extend(data)
+
+
+peripheral_server.RX_QUEUE_DEPTH.add_function(
+    lambda: {("UARTPublisher", str(uart_id)): len(buf)
+             for uart_id, buf in list(UARTPublisher.rx_buffers.items())})
@@ -224,6 +224,9 @@ class UTTYModel:
         Creates the message that Peripheral.tx_msga will send on this
         event
         """
+        peripheral_server.PERIPHERAL_BYTES.inc(
+            len(buf), peripheral=f"UTTY {interface_id}", direction="tx"
+        )
         msg = {"interface_id": interface_id, "chars": buf}
         return msg
 
@@ -241,10 +244,15 @@ class UTTYModel:
                 log.info("Adding char to: %s", interface_id)
                 char = msg["char"]
                 interface.buffer_rx_chars_qmp([char])
+                num_bytes = 1
             else:
                 char_buff = msg["char"]
                 log.info("Adding buffer to: %s", interface_id)
                 interface.buffer_rx_chars_qmp(char_buff)
+                num_bytes = len(char_buff)
+            peripheral_server.PERIPHERAL_BYTES.inc(
+                num_bytes, peripheral=f"UTTY {interface_id}", direction="rx"
+            )
         except KeyError:
             log.info("No interface attached for %s", interface_id)
 
@@ -280,3 +288,11 @@ class UTTYModel:
     #     '''
     #     interface = cls.interfaces[interface_id]
     #     return interface.get_frame_info()
+
+
+peripheral_server.RX_QUEUE_DEPTH.add_function(
+    lambda: {
+        ("UTTYModel", str(interface_id)): len(interface.rx_queue)
+        for interface_id, interface in list(UTTYModel.interfaces.items())
+    }
+)
@@ -3,9 +3,16 @@
 # the U.S. Government retains certain rights in this software.
 
 from .arm_qemu import ARMQemuTarget
+from .firmware_rpc import ARM64FirmwareRPC
 
 class ARM64QemuTarget(ARMQemuTarget):
 
+    WORD_SIZE = 8
+    NUM_REG_ARGS = 8
+    # Variadic floating point arguments are passed in v0-v7
+    FLOAT_VARARGS_IN_WORDS = False
+    RPC_CLASS = ARM64FirmwareRPC
+
     def hal_alloc(self, size):
 
         if size % 8:
@@ -42,6 +49,20 @@ class ARM64QemuTarget(ARMQemuTarget):
         else:
             raise ValueError("Invalid arg index")
 
+    def get_args(self, count):
+        '''
+            Gets the first count function arguments, reading all stack
+            arguments in a single memory read
+
+            :param count  Number of arguments to return
+            :returns      List of argument values
+        '''
+        args = [self.read_register("x%i" % idx)
+                for idx in range(min(count, self.NUM_REG_ARGS))]
+        if count > self.NUM_REG_ARGS:
+            args.extend(self._read_stack_args(count - self.NUM_REG_ARGS))
+        return args
+
     def set_args(self, args):
         '''
             Sets the value for a function argument (zero indexed)
@@ -150,6 +171,7 @@ class ARM64QemuTarget(ARMQemuTarget):
                     if bp_handler_cls is not None and ret_bp_handler is not None:
                         self.set_bp(inst_addr, bp_handler_cls, ret_bp_handler)
                 bytes_written += len(bytearr)
+            self.calls_memory_blocks[key] = mem
         else:
             mem = self.calls_memory_blocks[key]
 
@@ -13,12 +13,17 @@ import struct
 
 from avatar2 import QemuTarget
 
-from halucinator import hal_config, hal_log
+from halucinator import hal_config, hal_log, hal_metrics
 from halucinator.bp_handlers import intercepts
+from halucinator.qemu_targets.firmware_rpc import ARMFirmwareRPC
 
 log = logging.getLogger(__name__)
 hal_log = hal_log.getHalLogger()
 
+IRQS_INJECTED = hal_metrics.counter(
+    "halucinator_irqs_injected_total", "IRQs set by halucinator", ["irq", "method"]
+)
+
 
 class AllocedMemory:
     """
@@ -72,6 +77,13 @@ class ARMQemuTarget(QemuTarget):
 
     # pylint: disable=too-many-public-methods
 
+    WORD_SIZE = 4
+    BIG_ENDIAN = False
+    # Variadic floating point arguments are passed in core registers/stack
+    FLOAT_VARARGS_IN_WORDS = True
+    NUM_REG_ARGS = 4
+    RPC_CLASS = ARMFirmwareRPC
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.irq_base_addr = None
@@ -79,6 +91,7 @@ class ARMQemuTarget(QemuTarget):
         self.avatar.load_plugin("disassembler")
         self._init_halucinator_heap()
         self.calls_memory_blocks = {}
+        self.rpc = self.RPC_CLASS(self)
         self.REGISTER_IRQ_OFFSET = 4  # pylint: disable=invalid-name
 
     def read_string(self, addr, max_len=256):
@@ -104,6 +117,7 @@ class ARMQemuTarget(QemuTarget):
                 "alloced_memory",
                 "free_memory",
                 "calls_memory_blocks",
+                "rpc",
             ]
         super().dictify(ignore)
 
@@ -185,6 +199,31 @@ class ARMQemuTarget(QemuTarget):
             return self.read_memory(stack_addr, 4, 1)
         raise ValueError("Invalid arg index")
 
+    def get_args(self, count):
+        """
+        Gets the first count function arguments, reading all stack
+        arguments in a single memory read
+
+        :param count  Number of arguments to return
+        :returns      List of argument values
+        """
+        args = [
+            self.read_register(f"r{idx}")
+            for idx in range(min(count, self.NUM_REG_ARGS))
+        ]
+        if count > self.NUM_REG_ARGS:
+            args.extend(self._read_stack_args(count - self.NUM_REG_ARGS))
+        return args
+
+    def _read_stack_args(self, count):
+        """
+        Reads count argument words starting at the stack pointer
+        """
+        # pylint: disable=invalid-name
+        sp = self.read_register("sp")
+        words = self.read_memory(sp, self.WORD_SIZE, count)
+        return words if isinstance(words, list) else [words]
+
     def set_args(self, args):
         """
         Sets the value for a function argument (zero indexed)
@@ -312,6 +351,7 @@ class ARMQemuTarget(QemuTarget):
         :param irq_num:  The irq number to trigger
         """
         path = self._get_irq_path()
+        IRQS_INJECTED.inc(irq=irq_num, method="qmp")
         # pylint: disable=unexpected-keyword-arg
         self.protocols.monitor.execute_command(
             "qom-set", args={"path": path, "property": "set-irq", "value": irq_num}
@@ -335,6 +375,7 @@ class ARMQemuTarget(QemuTarget):
         """
         Set `irq_num` active using MMIO interfaces for use in bp_handlers
         """
+        IRQS_INJECTED.inc(irq=irq_num, method="bp")
         addr = self._get_irq_addr(irq_num)
         value = self.read_memory(addr, 1, 1)
         self.write_memory(addr, 1, value & 1)  # lowest bit controls state
@@ -499,6 +540,7 @@ class ARMQemuTarget(QemuTarget):
                     if bp_handler_cls is not None and ret_bp_handler is not None:
                         self.set_bp(inst_addr, bp_handler_cls, ret_bp_handler)
                 bytes_written += len(bytearr)
+            self.calls_memory_blocks[key] = mem
         else:
             mem = self.calls_memory_blocks[key]
 
@@ -522,8 +564,47 @@ class ARMQemuTarget(QemuTarget):
         :param addr(int): Address to write the branch code to
         :param branch_target: Address to branch too
         """
+        instructions = self._branch_bytes(branch_target)
+        self.write_memory(addr, 1, instructions, len(instructions), raw=True)
+
+    def _branch_bytes(self, branch_target):
         instrs = []
         instrs.append(self.assemble("ldr pc, [pc, #-4]"))  # PC is 2 instructions ahead
         instrs.append(struct.pack("<I", branch_target))  # Address of callee
-        instructions = b"".join(instrs)
-        self.write_memory(addr, 1, instructions, len(instructions), raw=True)
+        return b"".join(instrs)
+
+    def write_branches(self, branches, max_gap=256):
+        """
+        Places absolute branches like write_branch, for all of them at
+        once. Branches within max_gap bytes of each other are written with
+        one read and one write of the memory spanning them
+
+        :param branches(dict): Branch targets by the address to write them to
+        :param max_gap(int): Most bytes between branches written together
+        """
+        if type(self).write_branch is not ARMQemuTarget.write_branch:
+            # Subclasses (Thumb, A64) branch their own way, or can't
+            for addr, branch_target in sorted(branches.items()):
+                self.write_branch(addr, branch_target)
+            return
+        patches = [
+            (addr, self._branch_bytes(branch_target))
+            for addr, branch_target in sorted(branches.items())
+        ]
+        groups = []
+        for addr, patch in patches:
+            if groups and addr - groups[-1][-1][0] - len(groups[-1][-1][1]) <= max_gap:
+                groups[-1].append((addr, patch))
+            else:
+                groups.append([(addr, patch)])
+
+        for group in groups:
+            start = group[0][0]
+            if len(group) == 1:
+                self.write_memory(start, 1, group[0][1], len(group[0][1]), raw=True)
+                continue
+            end = max(addr + len(patch) for addr, patch in group)
+            data = bytearray(self.read_memory(start, 1, end - start, raw=True))
+            for addr, patch in group:
+                data[addr - start : addr - start + len(patch)] = patch
+            self.write_memory(start, 1, bytes(data), len(data), raw=True)
@@ -2,11 +2,14 @@
 # (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, 
 # the U.S. Government retains certain rights in this software.
 
-from .arm_qemu import ARMQemuTarget
+from .arm_qemu import ARMQemuTarget, IRQS_INJECTED
 
 class ARMv7mQemuTarget(ARMQemuTarget):
 
+    THUMB_ONLY = True
+
     def trigger_interrupt(self, interrupt_number, cpu_number=0):
+        IRQS_INJECTED.inc(irq=interrupt_number, method="armv7m-inject")
         self.protocols.monitor.execute_command(
             'avatar-armv7m-inject-irq',
             {'num_irq': interrupt_number, 'num_cpu': cpu_number})
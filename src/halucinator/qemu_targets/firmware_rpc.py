@@ -0,0 +1,422 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Firmware RPC, calls functions in the firmware from bp_handlers and returns
+their return values to the handler.
+
+A bp_handler that needs to call firmware functions is written as a generator
+that yields calls and gets their return values back
+    @bp_handler(["tyISR"])
+    def ty_isr(self, qemu, bp_addr):
+        count = yield qemu.rpc.call("semGive", [sema])
+        results = yield [qemu.rpc.call("tyIRd", [dev, char]) for char in data]
+        return True, None
+
+All calls yielded together run in a single resume/stop cycle using one
+generic trampoline per target.  The trampoline walks a table of calls
+written to the 'halucinator' memory region; each entry is
+    function, number of stack words, register args, stack words, 2 result words
+and a zero function address ends the table.  When the table is done the
+trampoline loops on the address of its first instruction, which has a
+breakpoint that restores the registers saved when the calls were started
+and resumes the generator with the results.
+"""
+
+import logging
+import struct
+
+from halucinator.bp_handlers.bp_handler import BPHandler, bp_handler
+
+log = logging.getLogger(__name__)
+
+
+class WideArg:  # pylint: disable=too-few-public-methods
+    """
+    A 64 bit argument.  On 32 bit targets it uses an aligned register pair
+    or stack slot like a uint64_t/double argument
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FirmwareCall:  # pylint: disable=too-few-public-methods
+    """
+    A call of a firmware function, created by FirmwareRPC.call
+    """
+
+    __slots__ = ("addr", "words", "ret64", "result")
+
+    def __init__(self, addr, words, ret64):
+        self.addr = addr
+        self.words = words
+        self.ret64 = ret64
+        self.result = None
+
+
+class _PendingCalls:  # pylint: disable=too-few-public-methods
+    """
+    Calls in flight for one generator bp_handler
+    """
+
+    def __init__(self, handler_gen, calls, batched, context, table_addr, size):
+        self.handler_gen = handler_gen
+        self.calls = calls
+        self.batched = batched
+        self.context = context
+        self.table_addr = table_addr
+        self.size = size
+
+
+class FirmwareRPC:
+    """
+    Architecture independent part of the firmware RPC.  Subclasses define
+    the trampoline and registers for the architecture.
+    """
+
+    TRAMPOLINE = None
+    TABLE_REG = None
+    # Registers restored after the calls complete
+    CONTEXT_REGS = ()
+    STACK_ALIGN = 8
+    RETURN_HANDLER = "halucinator.qemu_targets.firmware_rpc.FirmwareRPCHandler"
+
+    def __init__(self, target):
+        self.target = target
+        self.word_size = target.WORD_SIZE
+        self.num_reg_args = target.NUM_REG_ARGS
+        self.word_fmt = (">" if target.BIG_ENDIAN else "<") + (
+            "Q" if self.word_size == 8 else "I"
+        )
+        self.word_mask = (1 << (8 * self.word_size)) - 1
+        self.trampoline = None
+        self.entry = None
+        self.pending = []
+        self.tables = []  # Call table memory, one per nesting level
+        self.addr_cache = {}
+
+    def _resolve(self, callee):
+        if isinstance(callee, int):
+            return callee
+        addr = self.addr_cache.get(callee)
+        if addr is None:
+            addr = self.target.avatar.config.get_addr_for_symbol(callee)
+            if addr is None:
+                raise ValueError(f"Making call to {callee}. Address not found")
+            self.addr_cache[callee] = addr
+        return addr
+
+    def func_addr(self, addr):
+        """
+        Returns the address to branch to for function addr
+        """
+        return addr
+
+    def call(self, callee, args=(), ret64=False):
+        """
+        Creates a call to yield from a generator bp_handler
+
+        :param callee:  Address or name of the function
+        :param args:    Iterable of int or WideArg arguments
+        :param ret64:   Return value is 64 bits (r0:r1 / r3:r4 on 32 bit targets)
+        """
+        words = []
+        for arg in args:
+            if isinstance(arg, WideArg) and self.word_size == 4:
+                if len(words) % 2:
+                    words.append(0)
+                low = arg.value & 0xFFFFFFFF
+                high = (arg.value >> 32) & 0xFFFFFFFF
+                words.extend((high, low) if self.target.BIG_ENDIAN else (low, high))
+            elif isinstance(arg, WideArg):
+                words.append(arg.value & self.word_mask)
+            else:
+                words.append(arg & self.word_mask)
+        return FirmwareCall(self.func_addr(self._resolve(callee)), words, ret64)
+
+    def _install_trampoline(self):
+        """
+        Writes the trampoline to the halucinator memory and sets the
+        breakpoint that completes the calls
+        """
+        target = self.target
+        size = 256
+        self.trampoline = target.hal_alloc(size)
+        base = self.trampoline.base_addr
+        done = _as_bytes(target.assemble(f"b {base:#x}", addr=base))
+        self.entry = base + len(done)
+        body = _as_bytes(
+            target.assemble(self.TRAMPOLINE.format(done=hex(base)), addr=self.entry)
+        )
+        code = done + body
+        if len(code) > size:
+            raise ValueError("Firmware RPC trampoline too large")
+        target.write_memory(base, 1, code, len(code), raw=True)
+        target.set_bp(base, self.RETURN_HANDLER, "firmware_rpc_return")
+        log.debug("Firmware RPC trampoline at %#x, entry %#x", base, self.entry)
+
+    def _get_table(self, size):
+        """
+        Returns the address of call table memory for the current nesting
+        level, tables are reused so memory is never freed
+        """
+        depth = len(self.pending)
+        if depth == len(self.tables):
+            self.tables.append(None)
+        table = self.tables[depth]
+        if table is None or table.size < size:
+            table = self.target.hal_alloc(max(size, 256))
+            self.tables[depth] = table
+        return table.base_addr
+
+    def _build_table(self, calls):
+        words = []
+        for fw_call in calls:
+            reg_words = fw_call.words[: self.num_reg_args]
+            reg_words = reg_words + [0] * (self.num_reg_args - len(reg_words))
+            stack_words = fw_call.words[self.num_reg_args :]
+            if len(stack_words) % 2:
+                stack_words = stack_words + [0]  # Keep the stack aligned
+            words.append(fw_call.addr)
+            words.append(len(stack_words))
+            words.extend(reg_words)
+            words.extend(stack_words)
+            words.extend((0, 0))
+        words.append(0)
+        return struct.pack(self.word_fmt[0] + self.word_fmt[1] * len(words), *words)
+
+    def start(self, handler_gen, send_value=None):
+        """
+        Advances a generator bp_handler, starting the calls it yields
+
+        :returns: The (intercept, ret_value) of the handler, or
+                  (False, None) while calls are running
+        """
+        try:
+            request = handler_gen.send(send_value)
+        except StopIteration as stop:
+            return stop.value if stop.value is not None else (False, None)
+
+        batched = isinstance(request, (list, tuple))
+        calls = list(request) if batched else [request]
+        if not calls:
+            return self.start(handler_gen, [])
+
+        target = self.target
+        if self.trampoline is None:
+            self._install_trampoline()
+        context = {reg: target.read_register(reg) for reg in self.CONTEXT_REGS}
+
+        table_bytes = self._build_table(calls)
+        table_addr = self._get_table(len(table_bytes))
+        target.write_memory(table_addr, 1, table_bytes, len(table_bytes), raw=True)
+
+        self.pending.append(
+            _PendingCalls(
+                handler_gen, calls, batched, context, table_addr, len(table_bytes)
+            )
+        )
+        target.write_register(self.TABLE_REG, table_addr)
+        target.write_register("sp", context["sp"] & ~(self.STACK_ALIGN - 1))
+        target.write_register("pc", self.entry)
+        return False, None
+
+    def finish(self):
+        """
+        Called when the trampoline completes, collects the results, restores
+        the saved registers and resumes the generator
+        """
+        target = self.target
+        pending = self.pending.pop()
+        table_bytes = target.read_memory(pending.table_addr, 1, pending.size, raw=True)
+
+        word = self.word_size
+        offset = 0
+        results = []
+        for fw_call in pending.calls:
+            num_stack = len(fw_call.words[self.num_reg_args :])
+            num_stack += num_stack % 2
+            offset += (2 + self.num_reg_args + num_stack) * word
+            first, second = struct.unpack_from(
+                self.word_fmt[0] + self.word_fmt[1] * 2, table_bytes, offset
+            )
+            offset += 2 * word
+            if fw_call.ret64 and word == 4:
+                if target.BIG_ENDIAN:
+                    fw_call.result = (first << 32) | second
+                else:
+                    fw_call.result = (second << 32) | first
+            else:
+                fw_call.result = first
+            results.append(fw_call.result)
+
+        for reg, value in pending.context.items():
+            target.write_register(reg, value)
+        return self.start(
+            pending.handler_gen, results if pending.batched else results[0]
+        )
+
+
+def _as_bytes(code):
+    # Older assembler plugins return str
+    return code.encode("latin-1") if isinstance(code, str) else bytes(code)
+
+
+class ARMFirmwareRPC(FirmwareRPC):
+    """
+    Firmware RPC for ARM and Thumb-2 (Cortex-M)
+    """
+
+    # r4 table, r5 stack bytes, r6 stack/result ptr, r7 copy index
+    TRAMPOLINE = """
+    loop:
+        ldr r0, [r4]
+        cmp r0, #0
+        beq {done}
+        mov r12, r0
+        ldr r5, [r4, #4]
+        lsl r5, r5, #2
+        add r6, r4, #24
+        sub sp, sp, r5
+        mov r7, #0
+    copy:
+        cmp r7, r5
+        beq copied
+        ldr r0, [r6, r7]
+        str r0, [sp, r7]
+        add r7, r7, #4
+        b copy
+    copied:
+        ldr r0, [r4, #8]
+        ldr r1, [r4, #12]
+        ldr r2, [r4, #16]
+        ldr r3, [r4, #20]
+        blx r12
+        add sp, sp, r5
+        add r6, r6, r5
+        str r0, [r6]
+        str r1, [r6, #4]
+        add r4, r6, #8
+        b loop
+    """
+    TABLE_REG = "r4"
+    CONTEXT_REGS = tuple(f"r{idx}" for idx in range(8)) + ("r12", "sp", "lr", "pc")
+    STACK_ALIGN = 8
+
+    def func_addr(self, addr):
+        if getattr(self.target, "THUMB_ONLY", False):
+            return addr | 1
+        return addr
+
+
+class ARM64FirmwareRPC(FirmwareRPC):
+    """
+    Firmware RPC for AArch64
+    """
+
+    # x19 table, x20 stack bytes, x21 stack/result ptr, x22 copy index
+    TRAMPOLINE = """
+    loop:
+        ldr x9, [x19]
+        cbz x9, {done}
+        ldr x20, [x19, #8]
+        lsl x20, x20, #3
+        add x21, x19, #80
+        sub sp, sp, x20
+        mov x22, #0
+    copy:
+        cmp x22, x20
+        b.eq copied
+        ldr x10, [x21, x22]
+        str x10, [sp, x22]
+        add x22, x22, #8
+        b copy
+    copied:
+        ldp x0, x1, [x19, #16]
+        ldp x2, x3, [x19, #32]
+        ldp x4, x5, [x19, #48]
+        ldp x6, x7, [x19, #64]
+        blr x9
+        add sp, sp, x20
+        add x21, x21, x20
+        str x0, [x21]
+        str x1, [x21, #8]
+        add x19, x21, #16
+        b loop
+    """
+    TABLE_REG = "x19"
+    CONTEXT_REGS = tuple(f"x{idx}" for idx in range(23)) + ("x30", "sp", "pc")
+    STACK_ALIGN = 16
+
+
+class PowerPCFirmwareRPC(FirmwareRPC):
+    """
+    Firmware RPC for 32 bit PowerPC (SysV ABI)
+    """
+
+    # r14 table, r15 stack bytes, r16 stack/result ptr, r17/r18 scratch
+    # Stack args go in a new frame at 8(r1), cr6 is cleared for varargs
+    TRAMPOLINE = """
+    loop:
+        lwz 0, 0(14)
+        cmpwi 0, 0
+        beq {done}
+        mtctr 0
+        lwz 15, 4(14)
+        slwi 15, 15, 2
+        addi 16, 14, 40
+        addi 17, 15, 23
+        rlwinm 17, 17, 0, 0, 27
+        neg 17, 17
+        stwux 1, 1, 17
+        li 17, 0
+    copy:
+        cmpw 17, 15
+        beq copied
+        lwzx 0, 16, 17
+        addi 18, 17, 8
+        stwx 0, 1, 18
+        addi 17, 17, 4
+        b copy
+    copied:
+        lwz 3, 8(14)
+        lwz 4, 12(14)
+        lwz 5, 16(14)
+        lwz 6, 20(14)
+        lwz 7, 24(14)
+        lwz 8, 28(14)
+        lwz 9, 32(14)
+        lwz 10, 36(14)
+        crxor 6, 6, 6
+        bctrl
+        lwz 1, 0(1)
+        add 16, 16, 15
+        stw 3, 0(16)
+        stw 4, 4(16)
+        addi 14, 16, 8
+        b loop
+    """
+    TABLE_REG = "r14"
+    CONTEXT_REGS = (
+        ("r0", "sp")
+        + tuple(f"r{idx}" for idx in range(3, 13))
+        + tuple(f"r{idx}" for idx in range(14, 19))
+        + ("lr", "ctr", "pc")
+    )
+    STACK_ALIGN = 16
+
+
+class FirmwareRPCHandler(BPHandler):
+    """
+    Handles the breakpoint at the end of the firmware RPC trampoline
+    """
+
+    @bp_handler(["firmware_rpc_return"])
+    def firmware_rpc_return(
+        self, qemu, bp_addr
+    ):  # pylint: disable=no-self-use,unused-argument
+        """
+        Completes the calls and resumes the bp_handler that made them
+        """
+        return qemu.rpc.finish()
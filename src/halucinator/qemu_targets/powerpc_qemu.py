@@ -11,14 +11,11 @@ import yaml
 from collections import deque
 
 from avatar2 import Avatar, QemuTarget
-from capstone import *
-from keystone.keystone_const import *
-from unicorn import *
-from unicorn.arm_const import *
 
 from halucinator import hal_config, hal_log
 from halucinator.bp_handlers import intercepts
 from halucinator.bp_handlers.bp_handler import BPHandler
+from halucinator.qemu_targets.firmware_rpc import PowerPCFirmwareRPC
 
 log = logging.getLogger(__name__)
 hal_log = hal_log.getHalLogger()
@@ -61,6 +58,13 @@ class PowerPCQemuTarget(QemuTarget):
         halucinator.  Enables read/writing and returning from
         functions in a calling convention aware manner
     '''
+    WORD_SIZE = 4
+    BIG_ENDIAN = True
+    NUM_REG_ARGS = 8
+    # Hard float ABI passes floating point arguments in f1-f8
+    FLOAT_VARARGS_IN_WORDS = False
+    RPC_CLASS = PowerPCFirmwareRPC
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.irq_base_addr = None
@@ -69,6 +73,7 @@ class PowerPCQemuTarget(QemuTarget):
         # self.init_halucinator_heap()
         self.calls_memory_blocks = {}  # Look up table of allocated memory
                                        # used to perform calls
+        self.rpc = self.RPC_CLASS(self)
 
     def read_string(self, addr, max_len=256):
         s = self.read_memory(addr, 1, max_len, raw=True)
@@ -79,29 +84,33 @@ class PowerPCQemuTarget(QemuTarget):
     def dictify(self, ignore=None):
         if ignore is None:
             ignore = ['state', 'status', 'regs', 'protocols', 'log', 'avatar',
-                      'alloced_memory', 'free_memory', 'calls_memory_blocks']
+                      'alloced_memory', 'free_memory', 'calls_memory_blocks',
+                      'rpc']
         super().dictify(ignore)
 
-    # def init_halucinator_heap(self):
-    #     '''
-    #         Initializes the scratch memory in the target that halucinator
-    #         can use.  This requires that a 'halucinator' memory region
-    #         exists.
-    #     '''
+    def init_halucinator_heap(self):
+        '''
+            Initializes the scratch memory in the target that halucinator
+            can use.  This requires that a 'halucinator' memory region
+            exists.  Called on first hal_alloc as not all PowerPC configs
+            have the region.
+        '''
 
-    #     for mem_name, mem_data in self.avatar.config.memories.items():
-    #         if mem_name == 'halucinator':
-    #             heap = AllocedMemory(self, mem_data.base_addr, mem_data.size)
-    #             heap.in_use = False
-    #             self.alloced_memory = set()
-    #             self.free_memory = set()
-    #             self.free_memory.add(heap)
-    #             return
+        for mem_name, mem_data in self.avatar.config.memories.items():
+            if mem_name == 'halucinator':
+                heap = AllocedMemory(self, mem_data.base_addr, mem_data.size)
+                heap.in_use = False
+                self.alloced_memory = set()
+                self.free_memory = set()
+                self.free_memory.add(heap)
+                return
 
-    #     raise ValueError("Memory region named 'halucinator required")
+        raise ValueError("Memory region named 'halucinator required")
 
     def hal_alloc(self, size):
 
+        if not hasattr(self, 'free_memory'):
+            self.init_halucinator_heap()
         if size % 4:
             size += 4 - (size % 4) # keep aligned on 4 byte boundary
         changed_block = None
@@ -158,6 +167,22 @@ class PowerPCQemuTarget(QemuTarget):
             raise ValueError("Invalid arg index")
 
 
+    def get_args(self, count):
+        '''
+            Gets the first count function arguments, reading all stack
+            arguments in a single memory read
+
+            :param count  Number of arguments to return
+            :returns      List of argument values
+        '''
+        args = [self.read_register(f"r{idx+3}")
+                for idx in range(min(count, self.NUM_REG_ARGS))]
+        if count > self.NUM_REG_ARGS:
+            sp = self.read_register("sp")
+            words = self.read_memory(sp, self.WORD_SIZE, count - self.NUM_REG_ARGS)
+            args.extend(words if isinstance(words, list) else [words])
+        return args
+
     def set_arg(self, idx, value):
         '''
             Sets the value for a function argument (zero indexed)
@@ -361,6 +386,7 @@ class PowerPCQemuTarget(QemuTarget):
                     if bp_handler_cls is not None and ret_bp_handler is not None:
                         self.set_bp(inst_addr, bp_handler_cls, ret_bp_handler)
                 bytes_written += len(bytearr)
+            self.calls_memory_blocks[key] = mem
         else:
             mem = self.calls_memory_blocks[key]
 
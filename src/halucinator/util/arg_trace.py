@@ -0,0 +1,354 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Binary function argument traces
+
+Each call is stored as a fixed width little endian record
+    timestamp_ns (u64), intercept id (u32), num_args (u32), return addr (u64),
+    max_args argument words (u64 each)
+
+Records are written into a preallocated buffer.  When the recorder has a
+file the buffer is a memory mapped segment of that file and a new segment is
+mapped when it fills, otherwise the buffer is a ring that keeps the most
+recent records.  The header's record count is updated as records are
+added and the intercept id to function table is written to <trace>.yaml as
+functions are added, so the trace of a run that crashed can be decoded.
+
+Decode a trace with
+    hal_arg_trace <trace> [-e firmware.elf] [--csv]
+"""
+
+import argparse
+import bisect
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+import yaml
+
+MAGIC = b"HALARGT1"
+VERSION = 1
+# magic, version, record size, max args, record count
+_HEADER = struct.Struct("<8sIIIQ")
+_COUNT = struct.Struct("<Q")
+COUNT_OFFSET = _HEADER.size - _COUNT.size
+# Records start on a boundary valid for mmap offsets on all platforms
+HEADER_SIZE = 0x10000
+_RECORD_HEADER = "<QIIQ"
+RECORD_FIELDS = ("timestamp_ns", "intercept", "num_args", "ret_addr")
+
+
+def record_struct(max_args):
+    """
+    Returns the struct.Struct for records with max_args argument words
+    """
+    return struct.Struct(_RECORD_HEADER + "Q" * max_args)
+
+
+class ArgTraceRecorder:
+    """
+    Records function arguments into fixed width records
+
+    :param filename: Trace file, if None records are kept in memory ring
+    :param max_args: Number of argument words stored in each record
+    :param ring_size: Number of records in the buffer / mapped segment
+    """
+
+    def __init__(self, filename=None, max_args=6, ring_size=65536):
+        self.filename = filename
+        self.max_args = max_args
+        self.record = record_struct(max_args)
+        self.intercepts = []
+        self.count = 0
+        self.closed = False
+        if filename is None:
+            self.ring_size = ring_size
+            self.buffer = bytearray(self.record.size * ring_size)
+            self.fd = None
+        else:
+            # Segments must start on a mmap allocation boundary
+            gran = mmap.ALLOCATIONGRANULARITY
+            per_gran = gran // math.gcd(gran, self.record.size)
+            self.ring_size = -(-ring_size // per_gran) * per_gran
+            self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.segment = -1
+            self.buffer = None
+            self._map_next_segment()
+            self.header = mmap.mmap(self.fd, HEADER_SIZE, offset=0)
+            _HEADER.pack_into(
+                self.header, 0, MAGIC, VERSION, self.record.size, max_args, 0
+            )
+            self._write_intercepts()
+        self.index = 0
+        self.zero_args = (0,) * max_args
+
+    def add_intercept(self, name, addr):
+        """
+        Adds a function to the intercept table
+
+        :returns: Intercept id used in the records
+        """
+        self.intercepts.append({"name": name, "addr": addr})
+        if self.filename is not None:
+            self._write_intercepts()
+        return len(self.intercepts) - 1
+
+    def _write_intercepts(self):
+        tmp_filename = self.filename + ".yaml.tmp"
+        with open(tmp_filename, "w") as outfile:
+            yaml.safe_dump({"intercepts": self.intercepts}, outfile)
+        os.replace(tmp_filename, self.filename + ".yaml")
+
+    def _segment_bytes(self):
+        return self.record.size * self.ring_size
+
+    def _map_next_segment(self):
+        if self.buffer is not None:
+            self.buffer.close()
+        self.segment += 1
+        offset = HEADER_SIZE + self.segment * self._segment_bytes()
+        os.ftruncate(self.fd, offset + self._segment_bytes())
+        self.buffer = mmap.mmap(self.fd, self._segment_bytes(), offset=offset)
+        self.index = 0
+
+    def append(self, intercept_id, ret_addr, args):
+        """
+        Appends a record
+
+        :param intercept_id: Id returned from add_intercept
+        :param ret_addr: Return address of the call
+        :param args: Argument words, truncated to max_args
+        """
+        if self.index == self.ring_size:
+            if self.fd is None:
+                self.index = 0
+            else:
+                self._map_next_segment()
+        num_args = len(args)
+        if num_args < self.max_args:
+            args = tuple(args) + self.zero_args[num_args:]
+        elif num_args > self.max_args:
+            args = args[: self.max_args]
+            num_args = self.max_args
+        self.record.pack_into(
+            self.buffer,
+            self.index * self.record.size,
+            time.time_ns(),
+            intercept_id,
+            num_args,
+            ret_addr,
+            *args,
+        )
+        self.index += 1
+        self.count += 1
+        if self.fd is not None:
+            # After the record, so a crash never counts a partial record
+            _COUNT.pack_into(self.header, COUNT_OFFSET, self.count)
+
+    def records(self):
+        """
+        Returns the records in an in memory ring, oldest first
+        """
+        if self.fd is not None:
+            raise ValueError("Use read_trace for file backed traces")
+        if self.count < self.ring_size:
+            order = range(self.count)
+        else:
+            order = list(range(self.index, self.ring_size)) + list(range(self.index))
+        return [
+            _unpack(self.record, self.buffer, idx * self.record.size) for idx in order
+        ]
+
+    def close(self):
+        """
+        Truncates the unused end of the last segment and closes the trace
+        file
+        """
+        if self.closed or self.fd is None:
+            self.closed = True
+            return
+        self.closed = True
+        self.buffer.close()
+        self.buffer = None
+        self.header.close()
+        self.header = None
+        os.ftruncate(self.fd, HEADER_SIZE + self.count * self.record.size)
+        os.close(self.fd)
+
+
+def _unpack(record, buf, offset):
+    values = record.unpack_from(buf, offset)
+    num_args = values[2]
+    return values[:4] + (values[4 : 4 + num_args],)
+
+
+def read_header(filename):
+    """
+    Reads a trace file header
+
+    :returns: dict with record_size, max_args and count
+    """
+    with open(filename, "rb") as infile:
+        magic, version, record_size, max_args, count = _HEADER.unpack(
+            infile.read(_HEADER.size)
+        )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{filename} is not an argument trace")
+    return {"record_size": record_size, "max_args": max_args, "count": count}
+
+
+def read_intercepts(filename):
+    """
+    Reads the intercept table written with the trace
+    """
+    with open(filename + ".yaml", "r") as infile:
+        return yaml.safe_load(infile)["intercepts"]
+
+
+def read_trace(filename):
+    """
+    Yields (timestamp_ns, intercept id, num_args, ret_addr, args) records
+    """
+    header = read_header(filename)
+    record = record_struct(header["max_args"])
+    with open(filename, "rb") as infile:
+        trace = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for idx in range(header["count"]):
+                yield _unpack(record, trace, HEADER_SIZE + idx * record.size)
+        finally:
+            trace.close()
+
+
+def to_numpy(filename):
+    """
+    Loads a trace as a NumPy structured array (requires numpy)
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    header = read_header(filename)
+    dtype = np.dtype(
+        [
+            ("timestamp_ns", "<u8"),
+            ("intercept", "<u4"),
+            ("num_args", "<u4"),
+            ("ret_addr", "<u8"),
+            ("args", "<u8", (header["max_args"],)),
+        ]
+    )
+    return np.memmap(
+        filename, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(header["count"],)
+    )
+
+
+def to_dataframe(filename):
+    """
+    Loads a trace as a pandas DataFrame with a function column
+    (requires numpy and pandas)
+    """
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+
+    records = to_numpy(filename)
+    names = [intercept["name"] for intercept in read_intercepts(filename)]
+    frame = pd.DataFrame({field: records[field] for field in RECORD_FIELDS})
+    frame["function"] = pd.Categorical.from_codes(records["intercept"], names)
+    for idx in range(records.dtype["args"].shape[0]):
+        frame[f"arg{idx}"] = records["args"][:, idx]
+    return frame
+
+
+class SymbolTable:
+    """
+    Address to function name lookup from an ELF symbol table
+    """
+
+    def __init__(self, elf_filename=None):
+        self.addrs = []
+        self.names = []
+        if elf_filename is not None:
+            self._load_elf(elf_filename)
+
+    def _load_elf(self, elf_filename):
+        # pylint: disable=import-outside-toplevel
+        from elftools.elf.elffile import ELFFile
+        from elftools.elf.sections import SymbolTableSection
+
+        syms = []
+        with open(elf_filename, "rb") as infile:
+            elf = ELFFile(infile)
+            for section in elf.iter_sections():
+                if not isinstance(section, SymbolTableSection):
+                    continue
+                for sym in section.iter_symbols():
+                    if sym["st_info"]["type"] == "STT_FUNC" and sym.name:
+                        # Clear thumb bit
+                        syms.append((sym["st_value"] & ~1, sym.name))
+        syms.sort()
+        self.addrs = [addr for addr, _ in syms]
+        self.names = [name for _, name in syms]
+
+    def lookup(self, addr):
+        """
+        Returns symbol+offset for addr, or addr in hex if unknown
+        """
+        idx = bisect.bisect_right(self.addrs, addr & ~1) - 1
+        if idx < 0:
+            return hex(addr)
+        offset = addr - self.addrs[idx]
+        return f"{self.names[idx]}+{offset:#x}" if offset else self.names[idx]
+
+
+def decode(filename, symbols=None):
+    """
+    Yields a text line for each record
+
+    :param symbols: SymbolTable used to name return addresses
+    """
+    symbols = symbols if symbols is not None else SymbolTable()
+    names = [intercept["name"] for intercept in read_intercepts(filename)]
+    start = None
+    for timestamp, intercept, _, ret_addr, args in read_trace(filename):
+        start = timestamp if start is None else start
+        args_str = ", ".join(hex(arg) for arg in args)
+        yield (
+            f"{(timestamp - start) / 1e9:12.6f} {names[intercept]}({args_str})"
+            f" ret: {symbols.lookup(ret_addr)}"
+        )
+
+
+def main():
+    """
+    Decodes an argument trace to text or csv
+    """
+    parser = argparse.ArgumentParser(description="Decode an argument trace")
+    parser.add_argument("trace", help="Argument trace file")
+    parser.add_argument("-e", "--elf", help="ELF file used to name addresses")
+    parser.add_argument("--csv", action="store_true", help="Output csv")
+    args = parser.parse_args()
+
+    if args.csv:
+        header = read_header(args.trace)
+        names = [intercept["name"] for intercept in read_intercepts(args.trace)]
+        arg_cols = ",".join(f"arg{idx}" for idx in range(header["max_args"]))
+        print(f"timestamp_ns,function,num_args,ret_addr,{arg_cols}")
+        for timestamp, intercept, num_args, ret_addr, f_args in read_trace(args.trace):
+            f_args = list(f_args) + [""] * (header["max_args"] - num_args)
+            print(
+                ",".join(
+                    str(value)
+                    for value in [timestamp, names[intercept], num_args, ret_addr]
+                    + f_args
+                )
+            )
+    else:
+        symbols = SymbolTable(args.elf)
+        for line in decode(args.trace, symbols):
+            sys.stdout.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
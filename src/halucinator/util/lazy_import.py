@@ -0,0 +1,194 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Deferred imports and import time reporting
+
+Heavy or optional dependencies (IPython, scapy, ...) are imported with
+    IPython = lazy_import("IPython")
+which returns a module proxy that imports the real module on first attribute
+access.  A missing optional dependency only raises ImportError when it is
+used.
+
+ImportTimer records the time spent executing each module imported while it
+is installed, similar to python -X importtime.  Enabled with
+    halucinator --import-report ...
+"""
+
+import importlib
+import sys
+import time
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module proxy that imports the module name on first attribute access
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "deferred"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Returns module name, deferring the import until it is first used if it
+    has not already been imported
+
+    :param name: Absolute module name (e.g. scapy.all)
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+class _TimedLoader:
+    """
+    Wraps a loader to time exec_module
+    """
+
+    def __init__(self, timer, name, loader):
+        self._timer = timer
+        self._name = name
+        self._loader = loader
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.enter(self._name)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer.exit(self._name)
+
+
+class ImportTimer:
+    """
+    sys.meta_path finder that records self and cumulative import time of each
+    module imported while installed
+    """
+
+    def __init__(self):
+        self.records = []
+        self._stack = []
+        self._finding = set()
+
+    def install(self):
+        """
+        Starts timing imports
+        """
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        """
+        Stops timing imports
+        """
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        """
+        Finds name with the remaining finders and wraps its loader
+        """
+        if name in self._finding:
+            return None
+        self._finding.add(name)
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._finding.discard(name)
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(self, name, spec.loader)
+        return spec
+
+    def enter(self, name):
+        """
+        Marks start of executing module name
+        """
+        # [name, start, time spent in nested imports]
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def exit(self, name):
+        """
+        Marks end of executing module name
+        """
+        _, start, nested = self._stack.pop()
+        cumulative = time.perf_counter() - start
+        if self._stack:
+            self._stack[-1][2] += cumulative
+        self.records.append((name, cumulative - nested, cumulative, len(self._stack)))
+
+    def report(self, outfile=None, limit=30):
+        """
+        Writes the slowest imports by cumulative time
+
+        :param outfile: File to write to, default stderr
+        :param limit: Number of modules to list, None for all
+        """
+        outfile = outfile if outfile is not None else sys.stderr
+        records = sorted(self.records, key=lambda rec: rec[2], reverse=True)
+        total = sum(rec[1] for rec in self.records)
+        outfile.write(
+            f"Import time: {len(self.records)} modules, {total * 1e3:.1f} ms\n"
+        )
+        outfile.write("     self [us] |  cumulative [us] | imported package\n")
+        for name, self_time, cumulative, depth in records[:limit]:
+            outfile.write(
+                f"{self_time * 1e6:14.0f} | {cumulative * 1e6:16.0f} | "
+                f"{' ' * depth}{name}\n"
+            )
+        outfile.flush()
+
+
+_TIMER = None
+
+
+def enable_import_report():
+    """
+    Installs the global ImportTimer
+    """
+    global _TIMER  # pylint: disable=global-statement
+    if _TIMER is None:
+        _TIMER = ImportTimer().install()
+    return _TIMER
+
+
+def print_import_report(outfile=None, limit=30):
+    """
+    Stops the global ImportTimer, if enabled, and writes its report
+    """
+    if _TIMER is not None:
+        _TIMER.uninstall()
+        _TIMER.report(outfile, limit)
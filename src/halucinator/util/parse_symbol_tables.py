@@ -7,7 +7,6 @@ import argparse
 import os
 import sys
 import string
-import IPython
 from elftools.common.exceptions import ELFError
 from elftools.elf.elffile import ELFFile
 from elftools.elf.constants import E_FLAGS
@@ -0,0 +1,312 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Statistical guest PC profiler
+
+A background thread periodically reads the guest registers over a dedicated
+QMP connection (HMP `info registers`), so the guest keeps running while it
+is sampled.  Each sample is unwound into a stack either from pc and lr only,
+or by following the frame pointer chain with HMP `x` reads, and symbolized
+with the config symbol table.  Samples taken while the target is stopped in
+a bp_handler get a [bp_handler] leaf frame.
+
+Enable with `halucinator --pc-profile <Hz>` or the config options
+    options:
+      pc_profiler:
+        rate: 100         # samples per second
+        unwind: fp        # fp or lr
+        max_depth: 16
+
+On shutdown the profiler writes to the output directory
+    pc_profile.folded   collapsed stacks, input for flamegraph.pl/speedscope
+    pc_profile.txt      per function self and total sample counts
+"""
+
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from avatar2 import TargetStates
+from avatar2.protocols.qmp import QMPProtocol
+
+log = logging.getLogger(__name__)
+
+# Register names for the pc, lr and frame pointer, and the byte offsets of
+# the caller's frame pointer and return address in a frame record
+FRAME_LAYOUTS = {
+    # gcc: push {fp, lr}; add fp, sp, #4
+    "arm": ("r15", "r14", "r11", -4, 0),
+    # gcc: push {r7, lr}; mov r7, sp
+    "thumb": ("r15", "r14", "r7", 0, 4),
+    "aarch64": ("pc", "x30", "x29", 0, 8),
+    # r1 back chain, lr is saved in the caller's frame at +4
+    "ppc": ("nip", "lr", "r1", 0, 4),
+}
+
+_REG_EQ = re.compile(r"\b([A-Za-z][A-Za-z0-9]*)\s*=\s*([0-9a-fA-F]{8,16})\b")
+_PPC_SPR = re.compile(r"\b(NIP|LR)\s+([0-9a-fA-F]{8,16})\b")
+_PPC_GPR = re.compile(r"\bGPR(\d\d)((?:[ \t]+[0-9a-fA-F]{8,16})+)")
+_REG_NUM = re.compile(r"^([a-z]+?)0*(\d+)$")
+_MEM_WORD = re.compile(r"0x([0-9a-fA-F]+)")
+
+
+def _reg_name(name):
+    name = name.lower()
+    match = _REG_NUM.match(name)
+    if match:
+        return f"{match.group(1)}{int(match.group(2))}"
+    return name
+
+
+def parse_info_registers(text):
+    """
+    Parses QEMU's `info registers` output for ARM, AArch64 and PowerPC
+
+    :returns: dict of lower case register name (r0, x29, pc, lr, ...) to value
+    """
+    regs = {}
+    for name, value in _REG_EQ.findall(text):
+        regs[_reg_name(name)] = int(value, 16)
+    for name, value in _PPC_SPR.findall(text):
+        regs[name.lower()] = int(value, 16)
+    for first, row in _PPC_GPR.findall(text):
+        for idx, value in enumerate(row.split()):
+            regs[f"r{int(first) + idx}"] = int(value, 16)
+    return regs
+
+
+def frame_layout_for(target):
+    """
+    Returns the FRAME_LAYOUTS key for an halucinator qemu target
+    """
+    if type(target).__name__.startswith("PowerPC"):
+        return "ppc"
+    if target.WORD_SIZE == 8:
+        return "aarch64"
+    if getattr(target, "THUMB_ONLY", False):
+        return "thumb"
+    return "arm"
+
+
+class SymbolIndex:
+    """
+    Address to symbol name lookup over HalSymbolConfig entries
+
+    :param symbols: Iterable of objects with name, addr and size
+    """
+
+    def __init__(self, symbols):
+        syms = sorted((sym.addr, sym.size, sym.name) for sym in symbols)
+        self.addrs = [addr for addr, _, _ in syms]
+        self.syms = syms
+
+    def lookup(self, addr):
+        """
+        Returns the name of the symbol containing addr, or addr in hex
+        """
+        idx = bisect.bisect_right(self.addrs, addr) - 1
+        if idx >= 0:
+            sym_addr, size, name = self.syms[idx]
+            if size == 0 or addr < sym_addr + size:
+                return name
+        return f"{addr:#x}"
+
+
+class PCSampler:
+    """
+    Samples the guest PC and stack from a background thread
+
+    :param target: halucinator qemu target
+    :param symbols: List of HalSymbolConfig used to name addresses
+    :param rate: Samples per second
+    :param unwind: "fp" to follow frame pointers, "lr" for pc and lr only
+    :param max_depth: Max frames per sample
+    :param qmp_port: Port for the QMP connection used for sampling
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+        self, target, symbols, rate=100, unwind="fp", max_depth=16, qmp_port=None
+    ):
+        if unwind not in ("fp", "lr"):
+            raise ValueError(f"Invalid pc_profiler unwind {unwind}, use fp or lr")
+        self.target = target
+        self.symbols = SymbolIndex(symbols)
+        self.interval = 1.0 / rate
+        self.unwind = unwind
+        self.max_depth = max_depth
+        self.qmp_port = qmp_port
+        self.arch = frame_layout_for(target)
+        self.layout = FRAME_LAYOUTS[self.arch]
+        # Clear the thumb bit
+        self.addr_mask = ~0 if self.arch == "ppc" else ~1
+        self.unit = "g" if target.WORD_SIZE == 8 else "w"
+        self.stacks = Counter()
+        self.samples = 0
+        self.qmp = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_qemu_args(self):
+        """
+        Adds the QMP server used for sampling to the QEMU command line, must be
+        called before avatar.init_targets
+        """
+        self.target.additional_args.extend(
+            ["-qmp", f"tcp:127.0.0.1:{self.qmp_port},server,nowait"]
+        )
+
+    def start(self):
+        """
+        Connects to QMP and starts sampling
+        """
+        self.qmp = QMPProtocol(self.qmp_port, origin=self.target)
+        self.qmp.connect()
+        self._thread = threading.Thread(
+            target=self._run, name="halucinator-pc-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _hmp(self, command):
+        return self.qmp.execute_command(
+            "human-monitor-command", {"command-line": command}
+        )
+
+    def _read_words(self, addr, count):
+        text = self._hmp(f"x /{count}{self.unit}x {addr:#x}")
+        return [int(word, 16) for word in _MEM_WORD.findall(text.partition(":")[2])]
+
+    def _walk_frames(self, frame):
+        """
+        Yields return addresses following the frame pointer chain
+        """
+        _, _, _, next_off, ret_off = self.layout
+        word = self.target.WORD_SIZE
+        for _ in range(self.max_depth):
+            if frame == 0 or frame % word:
+                return
+            if self.arch == "ppc":
+                next_frame = self._read_words(frame, 1)[0]
+                ret_addr = self._read_words(next_frame + ret_off, 1)[0]
+            else:
+                start = frame + min(next_off, ret_off)
+                words = self._read_words(start, 2)
+                next_frame = words[(next_off - min(next_off, ret_off)) // word]
+                ret_addr = words[(ret_off - min(next_off, ret_off)) // word]
+            if ret_addr == 0:
+                return
+            yield ret_addr
+            # Stacks grow down, callers' frames are at higher addresses
+            if next_frame <= frame:
+                return
+            frame = next_frame
+
+    def sample(self):
+        """
+        Takes one sample, returns the stack as list of addresses, leaf first
+        """
+        pc_reg, lr_reg, fp_reg, _, _ = self.layout
+        regs = parse_info_registers(self._hmp("info registers"))
+        stack = [regs[pc_reg]]
+        if lr_reg in regs:
+            stack.append(regs[lr_reg])
+        if self.unwind == "fp" and fp_reg in regs:
+            try:
+                for idx, ret_addr in enumerate(self._walk_frames(regs[fp_reg])):
+                    # Leaf frames may not have saved lr yet
+                    if idx == 0 and ret_addr == stack[-1]:
+                        continue
+                    stack.append(ret_addr)
+                    if len(stack) >= self.max_depth:
+                        break
+            except (IndexError, ValueError):
+                pass
+        return stack
+
+    def _symbolize(self, stack):
+        # Return addresses are looked up at the call instruction
+        names = [self.symbols.lookup(stack[0] & self.addr_mask)]
+        for ret_addr in stack[1:]:
+            names.append(self.symbols.lookup((ret_addr & self.addr_mask) - 1))
+        # lr is stale once a non-leaf function has made a call
+        if len(names) > 1 and names[1] == names[0]:
+            del names[1]
+        return names
+
+    def _run(self):
+        next_time = time.monotonic()
+        while not self._stop.is_set():
+            stopped = self.target.state == TargetStates.STOPPED
+            try:
+                names = self._symbolize(self.sample())
+            except Exception:  # pylint: disable=broad-except
+                log.debug("PC sample failed", exc_info=True)
+                names = None
+            if names:
+                if stopped:
+                    names.insert(0, "[bp_handler]")
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+            next_time += self.interval
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                next_time = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def function_counts(self):
+        """
+        Returns (self counts, total counts), Counters of function name to
+        number of samples where it is the leaf / anywhere on the stack
+        """
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for name in set(frames):
+                total_counts[name] += count
+        return self_counts, total_counts
+
+    def report(self, limit=None):
+        """
+        Returns the per function sample count table
+        """
+        self_counts, total_counts = self.function_counts()
+        samples = self.samples or 1
+        lines = [
+            f"PC profile: {self.samples} samples",
+            f"{'self':>8} {'self %':>7} {'total':>8} {'total %':>7}  function",
+        ]
+        for name, count in self_counts.most_common(limit):
+            lines.append(
+                f"{count:>8} {100.0 * count / samples:>7.1f} "
+                f"{total_counts[name]:>8} "
+                f"{100.0 * total_counts[name] / samples:>7.1f}  {name}"
+            )
+        return "\n".join(lines)
+
+    def write(self, output_dir):
+        """
+        Writes pc_profile.folded and pc_profile.txt to output_dir
+        """
+        with open(os.path.join(output_dir, "pc_profile.folded"), "w") as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write(f"{stack} {count}\n")
+        with open(os.path.join(output_dir, "pc_profile.txt"), "w") as outfile:
+            outfile.write(self.report() + "\n")
+        log.info("%s", self.report(limit=10))
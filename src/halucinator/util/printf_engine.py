@@ -0,0 +1,333 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+printf emulation for bp_handlers
+
+Format strings are compiled once into a FormatPlan that records the literal
+text, each conversion and the argument words it consumes.  Plans and strings
+that live in read only memory are cached by guest address, and all argument
+words for a call are fetched with a single target.get_args call.
+"""
+
+import logging
+import re
+import struct
+
+log = logging.getLogger(__name__)
+
+# %[flags][width][.precision][length]conversion
+_SPEC_RE = re.compile(
+    r"%(?P<flags>[-+ #0]*)(?P<width>\*|\d+)?(?:\.(?P<precision>\*|\d*))?"
+    r"(?P<length>hh|h|ll|l|j|z|t|L|q)?(?P<conv>[diouxXeEfFgGaAcspn%])"
+)
+
+INT_CONVS = "diouxXc"
+FLOAT_CONVS = "eEfFgGaA"
+WIDE_INT_LENGTHS = ("ll", "j", "q")
+INT_LENGTH_BITS = {"hh": 8, "h": 16}
+
+
+class ConversionSpec:  # pylint: disable=too-few-public-methods
+    """
+    A single % conversion in a format string
+    """
+
+    __slots__ = ("flags", "width", "precision", "length", "conv", "text")
+
+    def __init__(self, match):
+        self.flags = match.group("flags")
+        width = match.group("width")
+        self.width = width if width == "*" or width is None else int(width)
+        precision = match.group("precision")
+        if precision is None:
+            self.precision = None
+        elif precision == "*":
+            self.precision = "*"
+        else:
+            self.precision = int(precision or 0)
+        self.length = match.group("length") or ""
+        self.conv = match.group("conv")
+        self.text = match.group(0)
+
+    def is_wide(self, word_size):
+        """
+        True if the value uses two argument words on this target
+        """
+        if word_size >= 8:
+            return False
+        if self.conv in FLOAT_CONVS:
+            return True
+        return self.conv in INT_CONVS and self.length in WIDE_INT_LENGTHS
+
+
+class FormatPlan:
+    """
+    Compiled printf format string
+
+    :param fmt: Format string
+    :param word_size: Size of an argument word on the target in bytes
+    :param align_wide: 64 bit values start on an even argument word (ARM EABI)
+    :param arg_base: Argument index of the first word after the format string
+    :param float_words: Floating point values are passed in argument words,
+        if False they are in FP registers, so they take no words and are
+        left unformatted
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, fmt, word_size=4, align_wide=True, arg_base=1, float_words=True):
+        self.fmt = fmt
+        self.word_size = word_size
+        self.has_unsupported = False
+        self.pieces = []  # str literals and (ConversionSpec, word indexes)
+        word = 0
+        pos = 0
+        for match in _SPEC_RE.finditer(fmt):
+            if match.start() > pos:
+                self.pieces.append(fmt[pos : match.start()])
+            pos = match.end()
+            spec = ConversionSpec(match)
+            if spec.conv == "%":
+                self.pieces.append("%")
+                continue
+            if spec.conv in FLOAT_CONVS and not float_words:
+                self.pieces.append(spec.text)
+                self.has_unsupported = True
+                continue
+            star_words = []
+            if spec.width == "*":
+                star_words.append(word)
+                word += 1
+            if spec.precision == "*":
+                star_words.append(word)
+                word += 1
+            if spec.is_wide(word_size):
+                if align_wide and (arg_base + word) % 2:
+                    word += 1
+                value_words = (word, word + 1)
+                word += 2
+            else:
+                value_words = (word,)
+                word += 1
+            self.pieces.append((spec, star_words, value_words))
+        if pos < len(fmt):
+            self.pieces.append(fmt[pos:])
+        self.num_words = word
+
+    def render(self, words, read_string, big_endian=False):
+        """
+        Renders the format using the argument words
+
+        :param words: Argument words following the format argument
+        :param read_string: Callable that reads a string from a guest address
+        :param big_endian: Word order of 64 bit values split across two words
+        """
+        out = []
+        for piece in self.pieces:
+            if isinstance(piece, str):
+                out.append(piece)
+                continue
+            spec, star_words, value_words = piece
+            width = spec.width
+            precision = spec.precision
+            stars = iter(star_words)
+            if width == "*":
+                width = _to_signed(words[next(stars)], 32)
+            if precision == "*":
+                precision = _to_signed(words[next(stars)], 32)
+                if precision < 0:
+                    precision = None
+            if len(value_words) == 2:
+                low, high = words[value_words[0]], words[value_words[1]]
+                if big_endian:
+                    low, high = high, low
+                raw = (high << 32) | low
+            else:
+                raw = words[value_words[0]]
+            out.append(self._convert(spec, width, precision, raw, read_string))
+        return "".join(out)
+
+    def _convert(
+        self, spec, width, precision, raw, read_string
+    ):  # pylint: disable=too-many-arguments,too-many-branches
+        flags = spec.flags
+        if isinstance(width, int) and width < 0:
+            flags += "-"
+            width = -width
+        conv = spec.conv
+        if conv == "n":
+            return ""
+        bits = 32
+        if spec.is_wide(self.word_size) or (
+            self.word_size >= 8 and spec.length in ("l", "ll", "j", "z", "t", "q")
+        ):
+            bits = 64
+        bits = INT_LENGTH_BITS.get(spec.length, bits)
+
+        if conv in "di":
+            value = _to_signed(raw, bits)
+        elif conv in "ouxX":
+            value = raw & ((1 << bits) - 1)
+        elif conv == "c":
+            value = chr(raw & 0xFF)
+        elif conv == "s":
+            value = read_string(raw) if raw else "(null)"
+        elif conv == "p":
+            value = raw
+            conv = "x"
+            flags += "#"
+        elif conv in FLOAT_CONVS:
+            if self.word_size >= 8 or spec.is_wide(self.word_size):
+                value = struct.unpack("<d", struct.pack("<Q", raw))[0]
+            else:
+                value = struct.unpack("<f", struct.pack("<I", raw & 0xFFFFFFFF))[0]
+            if conv in "aA":
+                text = value.hex()
+                text = text.upper() if conv == "A" else text
+                return _pad(text, flags, width)
+        else:
+            value = raw
+
+        py_fmt = "%" + flags
+        if width is not None:
+            py_fmt += str(width)
+        if precision is not None and conv != "c":
+            py_fmt += "." + str(precision)
+        py_fmt += conv
+        return py_fmt % value
+
+
+def _to_signed(value, bits):
+    value &= (1 << bits) - 1
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+
+def _pad(text, flags, width):
+    if width is None:
+        return text
+    if "-" in flags:
+        return text.ljust(width)
+    return text.rjust(width)
+
+
+MAX_PLANS = 1024
+
+
+class PrintfEngine:
+    """
+    Formats guest printf calls, caching compiled plans and strings found in
+    read only memory
+
+    Floating point varargs are read from the integer argument words, which
+    matches the ARM and PowerPC soft float calling conventions.  Targets
+    whose calling convention passes them in FP registers (AArch64, hard
+    float PowerPC) set FLOAT_VARARGS_IN_WORDS False, and their floating
+    point conversions are left unformatted.
+
+    :param target: Halucinator QEMU target
+    :param word_size: Argument word size, defaults to the target's WORD_SIZE
+    :param max_string: Maximum length of strings read from the guest
+    :param float_words: Floating point varargs are in argument words,
+        defaults to the target's FLOAT_VARARGS_IN_WORDS
+    """
+
+    def __init__(self, target, word_size=None, max_string=256, float_words=None):
+        self.target = target
+        if word_size is None:
+            word_size = getattr(target, "WORD_SIZE", 4)
+        self.word_size = word_size
+        if float_words is None:
+            float_words = getattr(target, "FLOAT_VARARGS_IN_WORDS", True)
+        self.float_words = float_words
+        self.max_string = max_string
+        self.big_endian = getattr(target, "BIG_ENDIAN", False)
+        self.plans = {}
+        self.ro_strings = {}
+        self.ro_ranges = _read_only_ranges(target)
+
+    def is_read_only(self, addr):
+        """
+        True if addr is in a memory region without write permission
+        """
+        for base, end in self.ro_ranges:
+            if base <= addr < end:
+                return True
+        return False
+
+    def read_string(self, addr):
+        """
+        Reads a string, caching it when it comes from read only memory
+        """
+        try:
+            return self.ro_strings[addr]
+        except KeyError:
+            pass
+        value = self.target.read_string(addr, self.max_string)
+        if self.is_read_only(addr):
+            self.ro_strings[addr] = value
+        return value
+
+    def get_plan(self, fmt_addr, arg_base=1):
+        """
+        Returns the compiled FormatPlan for the format string at fmt_addr
+
+        :param arg_base: Argument index of the first value after the format
+        """
+        fmt = self.read_string(fmt_addr)
+        key = (fmt_addr, fmt, arg_base)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = FormatPlan(
+                fmt, self.word_size, self.word_size < 8, arg_base, self.float_words
+            )
+            if plan.has_unsupported:
+                log.warning(
+                    "Floating point arguments are passed in FP registers on "
+                    "this target, not formatting them in %r",
+                    fmt,
+                )
+            if len(self.plans) >= MAX_PLANS:
+                self.plans.clear()
+            self.plans[key] = plan
+        return plan
+
+    def format(self, fmt_arg=0):
+        """
+        Formats the printf call currently stopped at
+
+        :param fmt_arg: Argument index of the format string
+        :returns: Formatted string
+        """
+        fmt_addr = self.target.get_arg(fmt_arg)
+        plan = self.get_plan(fmt_addr, fmt_arg + 1)
+        if plan.num_words:
+            words = get_args(self.target, fmt_arg + 1 + plan.num_words)[fmt_arg + 1 :]
+        else:
+            words = []
+        return plan.render(words, self.read_string, self.big_endian)
+
+
+def get_args(target, count):
+    """
+    Returns the first count arguments of the current function using the
+    targets batched get_args if it has one
+    """
+    if hasattr(target, "get_args"):
+        return target.get_args(count)
+    return [target.get_arg(idx) for idx in range(count)]
+
+
+def _read_only_ranges(target):
+    try:
+        memories = target.avatar.config.memories.values()
+    except AttributeError:
+        return []
+    return [
+        (mem.base_addr, mem.base_addr + mem.size)
+        for mem in memories
+        if mem.permissions is not None
+        and "w" not in mem.permissions
+        and mem.emulate is None
+    ]
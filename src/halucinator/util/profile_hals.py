@@ -3,10 +3,8 @@
 # certain rights in this software.
 
 import yaml
-from avatar2 import Avatar, GDBTarget, ARM_CORTEX_M3, TargetStates
 import logging
 import os
-from IPython import embed
 import sqlite3
 import hashlib
 import pickle
@@ -160,6 +158,8 @@ def handle_bp(avatar, message):
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
+    from avatar2 import Avatar, GDBTarget, ARM_CORTEX_M3
+    from IPython import embed
     p = ArgumentParser()
     p.add_argument("-e", '--elf', required=True,
                    help='Elf file to profile')
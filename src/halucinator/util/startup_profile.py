@@ -0,0 +1,169 @@
+# Copyright 2021 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS,
+# the U.S. Government retains certain rights in this software.
+"""
+Startup phase timing
+
+Phases of a launch are wrapped with
+    with startup_profile.phase("init_targets"):
+        ...
+and each records monotonic start and end times relative to when this module
+was imported.  Phases may nest (e.g. each intercept registration inside
+register_intercepts).  The results are written as JSON to
+<output dir>/startup_profile.json and the summary table is printed by
+    halucinator --startup-profile ...
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+
+class StartupProfiler:
+    """
+    Records nested, named phases with monotonic timestamps
+    """
+
+    def __init__(self):
+        self.t0 = time.monotonic_ns()
+        self.wall_start = time.time()
+        self.events = []
+        self._depth = 0
+
+    def _now(self):
+        return time.monotonic_ns() - self.t0
+
+    @contextlib.contextmanager
+    def phase(self, name, **info):
+        """
+        Context manager that records the time spent in the block as phase name
+
+        :param info: Extra JSON serializable values stored with the phase
+        """
+        event = {"name": name, "depth": self._depth, "start_ns": self._now()}
+        event.update(info)
+        self.events.append(event)
+        self._depth += 1
+        try:
+            yield event
+        finally:
+            self._depth -= 1
+            event["end_ns"] = self._now()
+            event["duration_ns"] = event["end_ns"] - event["start_ns"]
+
+    def mark(self, name, **info):
+        """
+        Records a point in time
+        """
+        now = self._now()
+        event = {
+            "name": name,
+            "depth": self._depth,
+            "start_ns": now,
+            "end_ns": now,
+            "duration_ns": 0,
+        }
+        event.update(info)
+        self.events.append(event)
+
+    def total_ns(self):
+        """
+        Returns the time from start to the end of the last finished phase
+        """
+        return max((e.get("end_ns", 0) for e in self.events), default=0)
+
+    def to_dict(self):
+        """
+        Returns the profile as a JSON serializable dict
+        """
+        return {
+            "wall_start": self.wall_start,
+            "pid": os.getpid(),
+            "total_ns": self.total_ns(),
+            "events": [e for e in self.events if "end_ns" in e],
+        }
+
+    def write(self, filename):
+        """
+        Writes the profile to filename as JSON
+        """
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(filename, "w") as outfile:
+            json.dump(self.to_dict(), outfile, indent=1)
+
+    def summary(self):
+        """
+        Returns the summary table, phases with the same name and depth are
+        combined into one row
+        """
+        rows = {}
+        for event in self.events:
+            if "end_ns" not in event:
+                continue
+            key = (event["depth"], event["name"])
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {
+                    "start": event["start_ns"],
+                    "count": 0,
+                    "total": 0,
+                    "max": 0,
+                }
+            row["count"] += 1
+            row["total"] += event["duration_ns"]
+            row["max"] = max(row["max"], event["duration_ns"])
+
+        total = self.total_ns() or 1
+        lines = [f"{'phase':<40} {'count':>6} {'total ms':>10} {'max ms':>10} {'%':>6}"]
+        for (depth, name), row in sorted(rows.items(), key=lambda r: r[1]["start"]):
+            lines.append(
+                f"{'  ' * depth + name:<40.40} {row['count']:>6} "
+                f"{row['total'] / 1e6:>10.2f} {row['max'] / 1e6:>10.2f} "
+                f"{100.0 * row['total'] / total:>6.1f}"
+            )
+        lines.append(f"{'startup total':<40} {'':>6} {total / 1e6:>10.2f}")
+        return "\n".join(lines)
+
+
+_PROFILER = StartupProfiler()
+
+
+def get_profiler():
+    """
+    Returns the global StartupProfiler
+    """
+    return _PROFILER
+
+
+def phase(name, **info):
+    """
+    Records a phase on the global profiler, see StartupProfiler.phase
+    """
+    return _PROFILER.phase(name, **info)
+
+
+def mark(name, **info):
+    """
+    Records a point in time on the global profiler
+    """
+    _PROFILER.mark(name, **info)
+
+
+def write(filename):
+    """
+    Writes the global profile to filename as JSON
+    """
+    _PROFILER.write(filename)
+
+
+def print_summary(outfile=None):
+    """
+    Prints the global profile's summary table
+    """
+    outfile = outfile if outfile is not None else sys.stdout
+    outfile.write("Startup Profile\n" + _PROFILER.summary() + "\n")
+    outfile.flush()
@@ -32,13 +32,19 @@ setup(name='halucinator',
             'halucinator = halucinator.main:main',
             'qemulog2trace = tools.qemu_to_trace:main',
             'hal_make_addr= halucinator.util.elf_sym_hal_getter:main',
+            'hal_arg_trace=halucinator.util.arg_trace:main',
             'hal_dev_uart=halucinator.external_devices.uart:main',
             'hal_dev_virt_hub=halucinator.external_devices.ethernet_virt_hub:main',
             'hal_dev_eth_wireless=halucinator.external_devices.ethernet_wireless:main',
             'hal_dev_host_eth=halucinator.external_devices.host_ethernet:main',
             'hal_dev_host_eth_server=halucinator.external_devices.host_ethernet_server:main',
             'hal_dev_802_15_4=halucinator.external_devices.IEEE802_15_4:main',
-            'hal_dev_irq_trigger=halucinator.external_devices.trigger_interrupt:main'
+            'hal_dev_irq_trigger=halucinator.external_devices.trigger_interrupt:main',
+            'hal_zmq_broker=halucinator.external_devices.zmq_broker:main',
+            'hal_dev_eth_switch=halucinator.external_devices.ethernet_switch:main',
+            'hal_dev_host_bridge=halucinator.external_devices.host_bridge:main',
+            'hal_dev_radio_medium=halucinator.external_devices.radio_medium:main',
+            'hal_lockstep=halucinator.lockstep:main'
         ]},
       requires=['avatar2',
                 'zeromq',
@@ -0,0 +1,79 @@
+"""
+Test writing the branches of ELF program intercepts on ARM targets
+"""
+
+import struct
+
+import pytest
+
+# hal_config imports the QEMU targets, they can't be imported first
+pytest.importorskip("halucinator.hal_config")
+arm_qemu = pytest.importorskip("halucinator.qemu_targets.arm_qemu")
+
+LDR_PC = b"\x04\xf0\x1f\xe5"  # ldr pc, [pc, #-4]
+
+
+def make_target(cls, size=0x1000):
+    """
+    Returns a cls instance, without an avatar, on a fake memory of size
+    bytes that counts its reads and writes
+    """
+    target = cls.__new__(cls)
+    target.memory = bytearray(b"\xaa" * size)
+    target.accesses = []
+
+    def read_memory(addr, wordsize, num_words, raw=False):
+        assert wordsize == 1 and raw
+        target.accesses.append(("read", addr, num_words))
+        return bytes(target.memory[addr : addr + num_words])
+
+    def write_memory(addr, wordsize, value, num_words, raw=False):
+        assert wordsize == 1 and raw and len(value) == num_words
+        target.accesses.append(("write", addr, num_words))
+        target.memory[addr : addr + num_words] = value
+
+    target.read_memory = read_memory
+    target.write_memory = write_memory
+    target.assemble = lambda asm: LDR_PC
+    return target
+
+
+def test_write_branches_batches_close_patches():
+    """
+    Branches close together are written at once, and the memory between
+    them is kept
+    """
+    branches = {0x100: 0x8000, 0x110: 0x8100, 0x800: 0x8200}
+    batched = make_target(arm_qemu.ARMQemuTarget)
+    batched.write_branches(branches, max_gap=0x20)
+    single = make_target(arm_qemu.ARMQemuTarget)
+    for addr, branch_target in branches.items():
+        single.write_branch(addr, branch_target)
+
+    assert batched.memory == single.memory
+    assert batched.memory[0x110:0x118] == LDR_PC + struct.pack("<I", 0x8100)
+    assert batched.accesses == [
+        ("read", 0x100, 0x18),
+        ("write", 0x100, 0x18),
+        ("write", 0x800, 8),
+    ]
+
+
+def test_write_branches_uses_subclass_write_branch():
+    """
+    Targets that branch their own way aren't patched with ARM instructions
+    """
+
+    class ThumbTarget(arm_qemu.ARMQemuTarget):
+        """
+        Target whose branches are written by its write_branch
+        """
+
+        def write_branch(self, addr, branch_target, options=None):
+            self.written.append((addr, branch_target))
+
+    target = make_target(ThumbTarget)
+    target.written = []
+    target.write_branches({0x110: 2, 0x100: 1})
+    assert target.written == [(0x100, 1), (0x110, 2)]
+    assert target.accesses == []
@@ -2,7 +2,7 @@
 Test the BPStruct Class
 """
 
-from halucinator.bp_handlers.bp_handler import BPStruct
+from halucinator.bp_handlers.bp_handler import BPStruct, BPPointer
 
 
 class TestStruct1(BPStruct):
@@ -17,6 +17,60 @@ class TestStruct1(BPStruct):
     }
 
 
+class TestNested(BPStruct):
+    """
+    Test structure with nested structs, arrays and a pointer
+    """
+
+    FORMAT = {
+        "header": TestStruct1,
+        "values": ("<H", 3),
+        "table": (TestStruct1, 2),
+        "p_next": BPPointer(TestStruct1),
+    }
+
+
+def test_build_buffer_none_fields():
+    """
+    None fields are filled with the default value and do not discard
+    the fields before them
+    """
+    test_struct = TestStruct1()
+    test_struct.test_le_U32 = 0x12345678
+    buffer = test_struct.build_buffer(b"\xff")
+    assert buffer == b"xV4\x12" + b"\xff" * 12
+    assert len(buffer) == len(test_struct)
+
+
+def test_parse_build_round_trip():
+    """
+    Nested structs and arrays parse and build to the same buffer
+    """
+    buffer = bytes(range(len(TestNested())))
+    nested = TestNested()
+    nested.parse_buffer(buffer)
+    assert nested.header.test_le_U32 == 0x03020100
+    assert nested.header.test_be_i16 == 0x0405
+    assert nested.values == [0x1110, 0x1312, 0x1514]
+    assert nested.table[1].test_name == bytes(range(0x2C, 0x36))
+    assert nested.p_next == 0x39383736
+    assert nested.build_buffer() == buffer
+
+
+def test_parse_array():
+    """
+    Consecutive structs are parsed from one buffer
+    """
+    test_struct = TestStruct1()
+    test_struct.test_le_U32 = 1
+    test_struct.test_be_i16 = -2
+    test_struct.test_name = b"name"
+    table = TestStruct1.parse_array(test_struct.build_buffer() * 3)
+    assert len(table) == 3
+    assert table[2].test_be_i16 == -2
+    assert table[2].test_name == b"name" + b"\x00" * 6
+
+
 if __name__ == "__main__":
     test_struct = BPStruct(le_U32="<I", be_i16=">h", name="10s")
     print(test_struct)
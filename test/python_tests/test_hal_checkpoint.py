@@ -0,0 +1,171 @@
+"""
+Test checkpoint chains of a base and incremental checkpoints
+"""
+
+import os
+import threading
+from types import SimpleNamespace
+
+from halucinator import hal_checkpoint
+
+BASE_ADDR = 0x20000000
+PAGE_SIZE = 256
+
+
+class FakeArch:  # pylint: disable=too-few-public-methods
+    """
+    Architecture with the registers a checkpoint saves
+    """
+
+    registers = {"r0": 0, "pc": 15}
+
+
+class FakeAvatar:  # pylint: disable=too-few-public-methods
+    """
+    Avatar holding the target's architecture
+    """
+
+    arch = FakeArch()
+
+
+class FakeProtocols:  # pylint: disable=too-few-public-methods
+    """
+    Protocols without a QEMU monitor, so memory is read from the target
+    """
+
+    monitor = None
+
+
+class FakeTarget:
+    """
+    Stopped target with one RAM and the registers
+    """
+
+    def __init__(self, size):
+        self.avatar = FakeAvatar()
+        self.protocols = FakeProtocols()
+        self.ram = bytearray(size)
+        self.regs = {"r0": 0, "pc": 0x1000}
+
+    def read_memory(self, address, wordsize, num_words, raw=False):
+        """
+        Returns num_words bytes of the RAM at address
+        """
+        assert wordsize == 1 and raw
+        offset = address - BASE_ADDR
+        return bytes(self.ram[offset : offset + num_words])
+
+    def read_register(self, reg):
+        """
+        Returns the value of reg
+        """
+        return self.regs[reg]
+
+
+def test_load_chain_base_and_incrementals(tmp_path):
+    """
+    Restoring the newest of a chain gives the memory and registers of the
+    last checkpoint, built from the base and every incremental
+    """
+    target = FakeTarget(4 * PAGE_SIZE)
+    directory = str(tmp_path / "checkpoints")
+    checkpointer = hal_checkpoint.Checkpointer(
+        target,
+        [("ram", BASE_ADDR, len(target.ram))],
+        directory,
+        page_size=PAGE_SIZE,
+    )
+    target.ram[:4] = b"base"
+    checkpointer.checkpoint()
+    target.ram[PAGE_SIZE : PAGE_SIZE + 5] = b"first"
+    checkpointer.checkpoint()
+    target.ram[3 * PAGE_SIZE : 3 * PAGE_SIZE + 6] = b"second"
+    target.regs["pc"] = 0x2000
+    checkpointer.checkpoint()
+    checkpointer.close()
+
+    files, memories, checkpoint = hal_checkpoint.load_chain(directory)
+    assert [os.path.basename(name) for name in files] == [
+        "ckpt-000000.base",
+        "ckpt-000001.incr",
+        "ckpt-000002.incr",
+    ]
+    assert memories == {BASE_ADDR: target.ram}
+    assert checkpoint["index"] == 2
+    assert checkpoint["registers"] == target.regs
+    # Each incremental holds only the page changed since its parent
+    last = hal_checkpoint.read_checkpoint(files[-1])
+    assert list(last["pages"][BASE_ADDR]) == [3]
+
+
+def test_load_chain_of_older_checkpoint(tmp_path):
+    """
+    An older checkpoint of the chain restores the memory as it was then
+    """
+    target = FakeTarget(2 * PAGE_SIZE)
+    directory = str(tmp_path)
+    checkpointer = hal_checkpoint.Checkpointer(
+        target,
+        [("ram", BASE_ADDR, len(target.ram))],
+        directory,
+        page_size=PAGE_SIZE,
+        compression="lzma",
+    )
+    checkpointer.checkpoint()
+    target.ram[0] = 1
+    first = checkpointer.checkpoint()
+    expected = bytearray(target.ram)
+    target.ram[PAGE_SIZE] = 2
+    checkpointer.checkpoint()
+    checkpointer.close()
+
+    files, memories, checkpoint = hal_checkpoint.load_chain(first)
+    assert files[-1] == first
+    assert memories == {BASE_ADDR: expected}
+    assert checkpoint["kind"] == hal_checkpoint.INCREMENTAL
+
+
+def test_model_state_round_trip():
+    """
+    Picklable model attributes are restored, others are skipped
+    """
+
+    class Model:  # pylint: disable=too-few-public-methods
+        """
+        Peripheral model with a picklable and an unpicklable attribute
+        """
+
+        frames = [b"one", b"two"]
+        lock = threading.Lock()
+
+    state = hal_checkpoint.get_model_state(Model)
+    assert set(state) == {"frames"}
+    Model.frames = []
+    hal_checkpoint.set_model_state(Model, state)
+    assert Model.frames == [b"one", b"two"]
+
+
+def test_poll_waits_for_firmware_calls(tmp_path):
+    """
+    No checkpoint is taken while firmware calls are pending, the one due is
+    taken once they return
+    """
+    target = FakeTarget(PAGE_SIZE)
+    target.rpc = SimpleNamespace(pending=[object()])
+    checkpointer = hal_checkpoint.Checkpointer(
+        target,
+        [("ram", BASE_ADDR, len(target.ram))],
+        str(tmp_path),
+        interval=0,
+        page_size=PAGE_SIZE,
+    )
+    hal_checkpoint._CHECKPOINTER = checkpointer  # pylint: disable=protected-access
+    try:
+        hal_checkpoint.poll(target)
+        assert checkpointer.index == 0
+        target.rpc.pending.clear()
+        hal_checkpoint.poll(target)
+        assert checkpointer.index == 1
+    finally:
+        hal_checkpoint.stop()
+    assert os.listdir(tmp_path) == ["ckpt-000000.base"]
@@ -0,0 +1,125 @@
+"""
+Test the shared images of read-only memories
+"""
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from halucinator import hal_shared_memory
+
+
+@pytest.fixture(name="options")
+def fixture_options():
+    """
+    Restores the sharing options after each test
+    """
+    saved = dict(hal_shared_memory._OPTIONS)  # pylint: disable=protected-access
+    yield hal_shared_memory._OPTIONS  # pylint: disable=protected-access
+    hal_shared_memory._OPTIONS.clear()  # pylint: disable=protected-access
+    hal_shared_memory._OPTIONS.update(saved)  # pylint: disable=protected-access
+
+
+def make_memory(**kwargs):
+    """
+    Returns a memory config with the fields is_shared reads
+    """
+    fields = {
+        "name": "flash",
+        "file": "firmware.bin",
+        "size": 0x1000,
+        "permissions": "r-x",
+        "emulate": None,
+        "shared": None,
+    }
+    fields.update(kwargs)
+    return SimpleNamespace(**fields)
+
+
+def test_is_shared(options):  # pylint: disable=unused-argument
+    """
+    Only read-only, file backed, not emulated memories are shared, as
+    enabled by the option or the memory's shared
+    """
+    hal_shared_memory.configure({"enabled": False})
+    assert not hal_shared_memory.is_shared(make_memory())
+    assert hal_shared_memory.is_shared(make_memory(shared=True))
+    hal_shared_memory.configure({"enabled": True})
+    assert hal_shared_memory.is_shared(make_memory())
+    assert not hal_shared_memory.is_shared(make_memory(shared=False))
+    assert not hal_shared_memory.is_shared(make_memory(permissions="rw-"))
+    assert not hal_shared_memory.is_shared(make_memory(file=None))
+    assert not hal_shared_memory.is_shared(make_memory(emulate="GenericPeripheral"))
+
+
+def test_configure_rejects_unknown(options):  # pylint: disable=unused-argument
+    """
+    Misspelt options are errors
+    """
+    with pytest.raises(ValueError):
+        hal_shared_memory.configure({"enable": True})
+
+
+def test_backing_file_shared_by_content(tmp_path):
+    """
+    Files with the same first size bytes share one padded image
+    """
+    page_size = os.statvfs(tmp_path).f_bsize
+    first = tmp_path / "first.bin"
+    second = tmp_path / "second.bin"
+    first.write_bytes(b"firmware")
+    second.write_bytes(b"firmware")
+    images = tmp_path / "images"
+    images.mkdir()
+    path = hal_shared_memory.backing_file(str(first), page_size, str(images))
+    assert hal_shared_memory.backing_file(str(second), page_size, str(images)) == path
+    with open(path, "rb") as infile:
+        assert infile.read() == b"firmware" + bytes(page_size - 8)
+    assert os.listdir(images) == [os.path.basename(path)]
+
+    second.write_bytes(b"other")
+    assert hal_shared_memory.backing_file(str(second), page_size, str(images)) != path
+
+
+def test_backing_file_page_size(tmp_path):
+    """
+    Sizes that aren't whole pages of the directory can't be mapped
+    """
+    image = tmp_path / "firmware.bin"
+    image.write_bytes(b"firmware")
+    with pytest.raises(ValueError):
+        hal_shared_memory.backing_file(str(image), 100, str(tmp_path))
+
+
+def test_add_backend_falls_back(tmp_path, options):
+    """
+    A memory that can't be shared adds no backend, and is loaded privately
+    """
+    image = tmp_path / "firmware.bin"
+    image.write_bytes(b"firmware")
+    options["directory"] = str(tmp_path)
+    qemu = SimpleNamespace(additional_args=[])
+    memory = make_memory(file=str(image), size=100)
+    assert hal_shared_memory.add_backend(qemu, memory) is None
+    assert not qemu.additional_args
+
+    memory.size = os.statvfs(tmp_path).f_bsize
+    backend = hal_shared_memory.add_backend(qemu, memory)
+    assert backend == "hal-shared-flash"
+    assert qemu.additional_args[0] == "-object"
+    assert qemu.additional_args[1].startswith(
+        f"memory-backend-file,id={backend},size={memory.size},"
+    )
+
+
+def test_configure_warns_private_copies(
+    options, caplog
+):  # pylint: disable=unused-argument
+    """
+    Memories that would be shared are reported as loaded privately
+    """
+    memories = [make_memory(), make_memory(name="ram", permissions="rw-")]
+    hal_shared_memory.configure({"enabled": True}, memories)
+    assert "flash" in caplog.text
+    assert "ram" not in caplog.text
@@ -0,0 +1,171 @@
+"""
+Test the RAM backed filesystem model
+"""
+
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from halucinator.peripheral_models.ram_fs_model import ERROR, RamDosFsModel
+
+O_CREAT = 0x0200
+O_RDWR = 0x0002
+FSTAT_DIR = 0x4000
+
+
+@pytest.fixture(name="ram_fs")
+def fixture_ram_fs():
+    """
+    RamDosFsModel that can be configured again by each test
+    """
+    RamDosFsModel._configured = False  # pylint: disable=protected-access
+    yield RamDosFsModel
+    RamDosFsModel._configured = False  # pylint: disable=protected-access
+    RamDosFsModel.image = None
+    RamDosFsModel.reset()
+
+
+def write_file(ram_fs, path, data):
+    """
+    Creates path with contents data
+    """
+    _, fd = ram_fs.creat_or_open(path, O_CREAT | O_RDWR, 0)
+    ram_fs.write(fd, data)
+    ram_fs.close(fd)
+
+
+def read_file(ram_fs, path):
+    """
+    Returns the contents of path, None if it can't be opened
+    """
+    _, fd = ram_fs.creat_or_open(path, 0, 0)
+    if fd == ERROR:
+        return None
+    data = ram_fs.read(fd, 1024)
+    ram_fs.close(fd)
+    return data
+
+
+def test_seed_tar_dot_relative(ram_fs, tmp_path):
+    """
+    Members of a tar made with `tar -C dir .` are seeded without the ./
+    """
+    image = str(tmp_path / "image.tar")
+    with tarfile.open(image, "w") as tar:
+        for name in (".", "./a"):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        info = tarfile.TarInfo("./a/f.txt")
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b"hello"))
+    ram_fs.configure(image)
+    assert "/./a/f.txt" not in ram_fs.nodes
+    assert read_file(ram_fs, "/a/f.txt") == b"hello"
+
+
+def test_seed_zip_dot_relative(ram_fs, tmp_path):
+    """
+    Zip members with a ./ prefix are seeded without it
+    """
+    image = str(tmp_path / "image.zip")
+    with zipfile.ZipFile(image, "w") as archive:
+        archive.writestr("./a/f.txt", b"hello")
+    ram_fs.configure(image)
+    assert read_file(ram_fs, "/a/f.txt") == b"hello"
+
+
+def test_seed_dir_is_copy_on_write(ram_fs, tmp_path):
+    """
+    Writes stay in memory and never change the seed directory
+    """
+    (tmp_path / "d").mkdir()
+    (tmp_path / "d" / "f.txt").write_bytes(b"seed")
+    ram_fs.configure(str(tmp_path))
+    write_file(ram_fs, "/d/f.txt", b"edit")
+    assert read_file(ram_fs, "/d/f.txt") == b"edit"
+    assert (tmp_path / "d" / "f.txt").read_bytes() == b"seed"
+
+
+def test_move_dir_onto_empty_dir(ram_fs):
+    """
+    Moving a directory onto an existing empty directory keeps its children
+    """
+    ram_fs.configure()
+    write_file(ram_fs, "/src/sub/f.txt", b"data")
+    _, fd = ram_fs.creat_or_open("/dst", 0, FSTAT_DIR)
+    ram_fs.close(fd)
+    _, fd = ram_fs.creat_or_open("/src", 0, FSTAT_DIR)
+    ram_fs.fio_move(fd, "/dst")
+    ram_fs.close(fd)
+    assert "/src" not in ram_fs.nodes
+    assert read_file(ram_fs, "/dst/sub/f.txt") == b"data"
+    assert list(ram_fs.nodes["/dst"].children) == ["sub"]
+
+
+def test_move_errors(ram_fs):
+    """
+    Moves that os.rename refuses raise OSError and change nothing
+    """
+    ram_fs.configure()
+    write_file(ram_fs, "/src/f.txt", b"data")
+    write_file(ram_fs, "/full/g.txt", b"other")
+    _, fd = ram_fs.creat_or_open("/src", 0, FSTAT_DIR)
+    with pytest.raises(OSError):
+        ram_fs.fio_move(fd, "/full")
+    with pytest.raises(OSError):
+        ram_fs.fio_move(fd, "/src/inner")
+    with pytest.raises(NotADirectoryError):
+        ram_fs.fio_move(fd, "/full/g.txt")
+    ram_fs.close(fd)
+    assert read_file(ram_fs, "/src/f.txt") == b"data"
+    assert read_file(ram_fs, "/full/g.txt") == b"other"
+
+
+def test_move_file_replaces_file(ram_fs):
+    """
+    Moving a file onto a file replaces it, open descriptors follow the move
+    """
+    ram_fs.configure()
+    write_file(ram_fs, "/a.txt", b"a")
+    write_file(ram_fs, "/b.txt", b"b")
+    _, fd = ram_fs.creat_or_open("/a.txt", O_RDWR, 0)
+    ram_fs.fio_rename(fd, "b.txt")
+    assert ram_fs.fd_table[fd] == "/b.txt"
+    ram_fs.close(fd)
+    assert read_file(ram_fs, "/a.txt") is None
+    assert read_file(ram_fs, "/b.txt") == b"a"
+
+
+def test_configure_is_shared(ram_fs, tmp_path):
+    """
+    Configuring again for a second handler keeps the tree and open files,
+    a different image is an error
+    """
+    ram_fs.configure()
+    write_file(ram_fs, "/f.txt", b"data")
+    _, fd = ram_fs.creat_or_open("/f.txt", 0, 0)
+    ram_fs.configure()
+    assert read_file(ram_fs, "/f.txt") == b"data"
+    assert fd in ram_fs.fds
+    with pytest.raises(ValueError):
+        ram_fs.configure(os.fspath(tmp_path))
+
+
+def test_make_dir(ram_fs, tmp_path, monkeypatch):
+    """
+    Device directories are made in the RAM tree, not on the host
+    """
+    monkeypatch.chdir(tmp_path)
+    ram_fs.configure()
+    ram_fs.make_dir("/ata0/data")
+    ram_fs.make_dir("/ata0")
+    ram_fs.make_dir("/")
+    assert ram_fs.nodes["/ata0/data"].is_dir
+    assert list(ram_fs.nodes["/ata0"].children) == ["data"]
+    write_file(ram_fs, "/ata0/data/f.txt", b"data")
+    assert read_file(ram_fs, "/ata0/data/f.txt") == b"data"
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,100 @@
+"""
+Test the indexed symbol store of the config
+"""
+
+import random
+
+from halucinator.config.symbols_config import HalSymbolConfig, HalSymbolStore
+
+
+def linear_get_name(symbols, addr):
+    """
+    The first symbol containing addr, as found by searching the list
+    """
+    for sym in symbols:
+        if sym.addr <= addr <= sym.addr + sym.size:
+            return sym.name
+    return None
+
+
+def make_symbols(count, seed):
+    """
+    Returns count symbols that overlap and share names and addresses
+    """
+    rand = random.Random(seed)
+    return [
+        HalSymbolConfig(
+            "test.yaml",
+            f"sym{rand.randrange(count // 2)}",
+            rand.randrange(0, 0x400, 4),
+            rand.choice((0, 4, 16, 0x100)),
+        )
+        for _ in range(count)
+    ]
+
+
+def test_get_addr_first_added():
+    """
+    A name added twice resolves to its first address, unknown names to None
+    """
+    store = HalSymbolStore([HalSymbolConfig("a.yaml", "main", 0x100)])
+    store += [HalSymbolConfig("b.yaml", "main", 0x200)]
+    store.append(HalSymbolConfig("b.yaml", "other", 0x300))
+    assert store.get_addr("main") == 0x100
+    assert store.get_addr("other") == 0x300
+    assert store.get_addr("missing") is None
+    assert len(store) == 3
+
+
+def test_get_name_matches_linear_search():
+    """
+    Address lookups return the symbol a search of the list returns,
+    including after symbols are added
+    """
+    symbols = make_symbols(200, 0)
+    store = HalSymbolStore(symbols[:100])
+    for addr in range(0, 0x520, 2):
+        assert store.get_name(addr) == linear_get_name(symbols[:100], addr)
+    store.extend(symbols[100:])
+    for addr in range(0, 0x520, 2):
+        assert store.get_name(addr) == linear_get_name(symbols, addr)
+
+
+def test_get_name_includes_last_byte():
+    """
+    A symbol contains its address up to addr + size
+    """
+    store = HalSymbolStore([HalSymbolConfig("a.yaml", "func", 0x100, 0x10)])
+    assert store.get_name(0x100) == "func"
+    assert store.get_name(0x110) == "func"
+    assert store.get_name(0x111) is None
+    assert store.get_name(0xFF) is None
+
+
+def test_indexes_follow_list_changes():
+    """
+    Changing the list other than by appending keeps the lookups in sync
+    """
+    store = HalSymbolStore(
+        [
+            HalSymbolConfig("a.yaml", "main", 0x100, 0x10),
+            HalSymbolConfig("a.yaml", "helper", 0x200, 0x10),
+        ]
+    )
+    assert store.get_name(0x104) == "main"
+    store.insert(0, HalSymbolConfig("b.yaml", "main", 0x300))
+    assert store.get_addr("main") == 0x300
+    store[0] = HalSymbolConfig("b.yaml", "start", 0x100, 0x10)
+    assert store.get_addr("main") == 0x100
+    assert store.get_name(0x104) == "start"
+    del store[0]
+    assert store.get_addr("start") is None
+    assert store.get_name(0x104) == "main"
+    store.remove(store[0])
+    assert store.get_addr("main") is None
+    assert store.get_name(0x104) is None
+    store[:] = [HalSymbolConfig("c.yaml", "main", 0x400)]
+    assert store.get_addr("main") == 0x400
+    assert store.get_addr("helper") is None
+    store.pop()
+    assert store.get_name(0x400) is None